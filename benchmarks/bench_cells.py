@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import pytest
+import numpy as np
+
+from smm.framework.cells import CellIndex, latlng_to_cells
+from smm.framework.loaders import CellParquetLoader
+from conftest import SIZES, synthetic_points
+
+RESOLUTIONS = {"h3": 9, "s2": 15}
+
+
+@pytest.fixture(scope="module", params=list(RESOLUTIONS))
+def index(request):
+    mask, resolution = request.param, RESOLUTIONS[request.param]
+    # Copy, the synthetic layers are cached and shared with the other benchmarks
+    gdf = synthetic_points(SIZES[-1]).copy()
+    cells = latlng_to_cells(gdf.geometry.y.values, gdf.geometry.x.values, mask, resolution)
+    # Region ids like srai, hex for H3 and tokens for S2
+    gdf["region_id"] = [format(int(c), "x") if mask == "h3" else format(int(c), "016x").rstrip("0") for c in cells]
+    return CellIndex.from_frame(gdf, mask, resolution, columns=["value", "weight"])
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_cell_lookup(benchmark, index, n):
+    gdf = synthetic_points(n, seed=7)
+    lat, lng = gdf.geometry.y.values, gdf.geometry.x.values
+    result = benchmark(index.lookup, lat, lng)
+    assert np.isfinite(result["value"]).any()
+
+
+@pytest.fixture(scope="module")
+def cell_file(tmp_path_factory):
+    gdf = synthetic_points(SIZES[-1]).copy()
+    cells = latlng_to_cells(gdf.geometry.y.values, gdf.geometry.x.values, "h3", RESOLUTIONS["h3"])
+    gdf["region_id"] = [format(int(c), "x") for c in cells]
+    path = str(tmp_path_factory.mktemp("cells") / "cells.cpq")
+    CellParquetLoader(path, mask="h3").set(gdf.drop(columns="category")).save()
+    return path
+
+
+@pytest.mark.parametrize("geometry", [False, True])
+def bench_cell_storage_read(benchmark, cell_file, geometry):
+    _read = lambda: CellParquetLoader(cell_file).content if geometry else CellParquetLoader(cell_file).cells
+    assert len(benchmark(_read)) == SIZES[-1]
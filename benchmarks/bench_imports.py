@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+from smm.common.config import FRAMEWORK_ROOT
+
+# Heavy backends, which are imported on first use only
+LAZY_MODULES = ["srai", "geofileops", "rasterio", "rioxarray", "fiona", "sqlglot", "bs4", "sqlalchemy"]
+MODULES = ["smm.common.config", "smm.framework.persistent", "smm.core.osm.setup"]
+
+
+def _import(module):
+    '''Imports the module in a fresh interpreter and returns the lazy modules it loaded.'''
+    code = f"import sys, json, {module}; print(json.dumps(sorted(m for m in {LAZY_MODULES!r} if m in sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code],
+                            cwd=os.path.dirname(FRAMEWORK_ROOT),
+                            capture_output=True,
+                            text=True,
+                            check=True)
+    return json.loads(result.stdout)
+
+
+@pytest.mark.parametrize("module", MODULES)
+def bench_import(benchmark, module):
+    loaded = benchmark.pedantic(_import, args=(module,), rounds=5, iterations=1)
+    assert loaded == [], f"{module} imports {loaded} eagerly."
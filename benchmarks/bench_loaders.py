@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+
+from smm.framework.loaders import loader_classes
+from conftest import SIZES, BOUNDS, synthetic_points, synthetic_polygons
+
+# Text based formats are far too slow for the large layers
+MAX_ROWS = {".geojson": 10**6, ".kml": 10**5, ".gml": 10**5}
+RASTER_EXTENSIONS = (".tif", ".geotiff")
+VECTOR_DRIVERS = {".gpkg": "GPKG", ".geojson": "GeoJSON", ".shp": "ESRI Shapefile", ".kml": "KML", ".gml": "GML"}
+# The abstract base loaders have no extension, cell storage needs tesselation results, see bench_cells.py
+EXTENSIONS = sorted(set(loader_classes.keys()) - {".cpq", None})
+
+
+def _skip_large(extension, n):
+    if n > MAX_ROWS.get(extension, n):
+        pytest.skip(f"{extension} is not benchmarked above {MAX_ROWS[extension]} rows.")
+
+
+def _write_native(extension, n, path):
+    '''Writes the fixture file with the native driver, independent of the loader under test.'''
+    if extension in RASTER_EXTENSIONS:
+        side = int(np.sqrt(n))
+        with rasterio.open(path, "w", driver="GTiff", height=side, width=side, count=1, dtype="float32",
+                           crs="EPSG:4326", transform=from_bounds(*BOUNDS, side, side)) as dst:
+            dst.write(np.random.default_rng(0).random((1, side, side), dtype="float32"))
+    elif extension == ".gpq":
+        synthetic_points(n).to_parquet(path)
+    else:
+        synthetic_polygons(n).to_file(path, driver=VECTOR_DRIVERS[extension])
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def bench_loader_read(benchmark, extension, n, tmp_dir):
+    _skip_large(extension, n)
+    path = os.path.join(tmp_dir, "layer" + extension)
+    _write_native(extension, n, path)
+    loader = benchmark(lambda: loader_classes[extension](path).load())
+    assert loader.has_content()
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("extension", EXTENSIONS)
+def bench_loader_write(benchmark, extension, n, tmp_dir):
+    _skip_large(extension, n)
+    gdf = synthetic_polygons(n)
+    path = os.path.join(tmp_dir, "layer" + extension)
+    benchmark(lambda: loader_classes[extension](path).set(gdf).save())
+    assert os.path.isfile(path)
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("spatial_sort", [None, "hilbert", "h3"])
+def bench_loader_read_bbox(benchmark, spatial_sort, n, tmp_dir):
+    '''Bbox filtered read of a tenth of the area, row groups are skipped by their bbox statistics.'''
+    path = os.path.join(tmp_dir, f"layer_{spatial_sort}.gpq")
+    loader_classes[".gpq"](path, spatial_sort=spatial_sort, row_group_size=max(n // 100, 1000)).set(
+        synthetic_polygons(n)).save()
+    w, h = (BOUNDS[2] - BOUNDS[0]) / np.sqrt(10), (BOUNDS[3] - BOUNDS[1]) / np.sqrt(10)
+    bbox = (BOUNDS[0], BOUNDS[1], BOUNDS[0] + w, BOUNDS[1] + h)
+    gdf = benchmark(lambda: loader_classes[".gpq"](path).read_bbox(bbox))
+    assert len(gdf) > 0
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import pytest
+
+from smm.common.config import FRAMEWORK_ROOT, TEST_ROOT
+from smm.core.osm.parser import MapnikSqlParser
+
+MAPNIK_FILE = os.path.join(FRAMEWORK_ROOT, "core", "osm", "config", "mapnik.xml")
+GOLDEN_FILE = os.path.join(TEST_ROOT, "mapnik_sql_golden.json")
+LAYERS = ["amenity-points", "landcover", "buildings", "landuse-overlay"]
+
+
+@pytest.fixture(scope="module")
+def parser():
+    _parser = MapnikSqlParser(MAPNIK_FILE)
+    _parser.load_mapnik()
+    return _parser
+
+
+def bench_load_mapnik(benchmark):
+    info = benchmark.pedantic(lambda: MapnikSqlParser(MAPNIK_FILE).load_mapnik(), rounds=3, iterations=1)
+    assert "amenity-points" in info
+
+
+@pytest.mark.parametrize("layer", LAYERS)
+def bench_parse_mapnik_sql(benchmark, parser, layer):
+    sql = benchmark.pedantic(parser.get_description(layer)["sql"], rounds=3, iterations=1)
+    assert "osm_id" in sql
+
+
+def bench_parse_mapnik_sql_all(benchmark):
+    _parser = MapnikSqlParser(MAPNIK_FILE)
+    layers = [(name, sql) for name, sql, _ in _parser.iter_mapnik()]
+    with open(GOLDEN_FILE, encoding="utf-8") as f:
+        golden = json.load(f)
+    result = benchmark.pedantic(lambda: {name: _parser.parse_mapnik_sql(sql, label=name) for name, sql in layers},
+                                rounds=3,
+                                iterations=1)
+    assert result == golden
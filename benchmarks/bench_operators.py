@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import numpy as np
+import pandas as pd
+import shapely
+import pytest
+
+from smm.framework.persistent import BaseDataLayer, BaseLayerTypes
+from smm.framework.operators import (SpatialTesselatorMeta, TesselationMethodsMeta, SpatialJoinMeta,
+                                     SpatialDiscretizer)
+from smm.framework.crosswalk import Crosswalk
+from conftest import SIZES, synthetic_points, synthetic_polygons
+
+RESOLUTIONS = {TesselationMethodsMeta.h3: [6, 8, 10], TesselationMethodsMeta.s2: [10, 13, 16]}
+METRIC_CRS = "EPSG:25832"
+
+
+def _layer(name, gdf, tmp_dir):
+    return BaseDataLayer(name, BaseLayerTypes.places, path=os.path.join(tmp_dir, name + ".gpq"), data=gdf)
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("mask,resolution", [(m, r) for m, res in RESOLUTIONS.items() for r in res])
+def bench_tesselate(benchmark, mask, resolution, n, tmp_dir):
+    layer = _layer("points", synthetic_points(n), tmp_dir)
+    operator = SpatialTesselatorMeta(mask=mask, resolution=resolution)
+    result = benchmark.pedantic(operator.apply, args=(layer, ), rounds=3, iterations=1)
+    assert len(result) > 0
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_join(benchmark, n, tmp_dir):
+    base = _layer("polygons", synthetic_polygons(n).to_crs(METRIC_CRS), tmp_dir)
+    operator = SpatialJoinMeta(_layer("points", synthetic_points(n), tmp_dir), tmp_dir=tmp_dir)
+    result = benchmark.pedantic(operator.apply, args=(base, ), rounds=3, iterations=1)
+    assert len(result) > 0
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_discretize_intersection(benchmark, n, tmp_dir):
+    source = synthetic_polygons(n)
+    mask = synthetic_polygons(max(n // 100, 10), seed=7)
+    operator = SpatialDiscretizer(tmp_dir=tmp_dir)
+    result = benchmark.pedantic(operator.area_intersection,
+                                args=(source, mask),
+                                kwargs=dict(crs=METRIC_CRS),
+                                rounds=3,
+                                iterations=1)
+    assert len(result) > 0
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("columns", [1, 50])
+def bench_crosswalk_apply(benchmark, n, columns):
+    '''Reapportioning scenario columns with a precomputed crosswalk instead of an overlay per run.'''
+    source = synthetic_polygons(n).to_crs(METRIC_CRS)
+    mask = synthetic_polygons(max(n // 100, 10), seed=7).to_crs(METRIC_CRS)
+    _source, _mask = shapely.STRtree(mask.geometry.values).query(source.geometry.values, predicate="intersects")
+    area = shapely.area(shapely.intersection(source.geometry.values[_source], mask.geometry.values[_mask]))
+    intersection = pd.DataFrame(dict(l1_fid=_mask + 1, l2_fid=_source + 1, intersect_area=area))
+    intersection["l1_l2_scale"] = area / intersection.groupby("l2_fid")["intersect_area"].transform("sum")
+    crosswalk = Crosswalk.from_intersection(intersection, source.index, mask.index)
+    scenarios = pd.DataFrame(np.random.default_rng(0).random((n, columns)), columns=[f"y{i}" for i in range(columns)])
+    result = benchmark(crosswalk.apply, scenarios, extensive=list(scenarios.columns))
+    assert result.shape == (len(mask), columns)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from smm.framework.persistent import PersistentManager, BaseDataLayer, DataLayer, BaseLayerTypes
+from smm.framework.operators import SpatialTesselatorMeta, TesselationMethodsMeta, SpatialJoinMeta
+from conftest import SIZES, synthetic_points
+
+
+def _materialize(root, gdf):
+    '''Builds, evaluates and saves a config like the tutorial: base layer, tesselation and join.'''
+    pm = PersistentManager(os.path.join(root, "bench" + PersistentManager.extension))
+    pm.add(BaseDataLayer("base_layer", BaseLayerTypes.places, path=os.path.join(root, "base_layer.gpq"), data=gdf))
+    tesselation = DataLayer("base_h3",
+                            pm.get("base_layer"),
+                            operator=SpatialTesselatorMeta(mask=TesselationMethodsMeta.h3, resolution=8))
+    tesselation.make_persistent(os.path.join(root, "base_h3.gpq"))
+    join = DataLayer("join_base_h3", tesselation, operator=SpatialJoinMeta(pm.get("base_layer"), tmp_dir=root))
+    join.make_persistent(os.path.join(root, "join_base_h3.gpq"))
+    pm.add(join)
+    pm.materialize().save()
+    return pm
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_materialize(benchmark, n, tmp_dir):
+    gdf = synthetic_points(n)
+    pm = benchmark.pedantic(_materialize, args=(tmp_dir, gdf), rounds=1, iterations=1)
+    assert len(pm.get("join_base_h3").content) > 0
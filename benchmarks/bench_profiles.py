@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+import numpy as np
+import pandas as pd
+
+from smm.core.osm.profiles import DemandProfileEngine, WEEK_HOURS
+from conftest import SIZES, synthetic_points
+
+SHAPES = {"G0": np.tile(np.r_[np.full(7, .1), np.ones(11), np.full(6, .1)], (3, 1)), "H0": np.ones((3, 24))}
+
+
+def capacities(n: int) -> pd.DataFrame:
+    rng = np.random.default_rng(3)
+    columns = ["employee_saturday_factor", "employee_sunday_factor", "visitor_saturday_factor", "visitor_sunday_factor"]
+    factors = {c: rng.choice([0., .5, 1., 1.2], n).astype(np.float32) for c in columns}
+    return pd.DataFrame(dict(employees=rng.uniform(0, 50, n).astype(np.float32),
+                             visitors=rng.uniform(0, 500, n).astype(np.float32),
+                             SLP=rng.choice(["G0", "H0", "G4", None], n),
+                             **factors))
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_profiles_write(benchmark, tmp_dir, n):
+    engine = DemandProfileEngine(SHAPES, chunksize=50000)
+    cap = capacities(n)
+    result = benchmark(engine.profiles, cap, os.path.join(tmp_dir, "profiles.npy"))
+    assert result.shape == (n, WEEK_HOURS)
+
+
+@pytest.mark.parametrize("n", SIZES)
+def bench_profiles_aggregate(benchmark, n):
+    engine = DemandProfileEngine(SHAPES, chunksize=50000)
+    cap, points = capacities(n), synthetic_points(n)
+    cells, profiles = benchmark(engine.aggregate, cap, points.geometry, 8)
+    assert profiles.shape == (len(cells), WEEK_HOURS)
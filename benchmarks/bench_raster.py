@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from smm.framework.raster import RasterExporter
+from conftest import SIZES, synthetic_polygons
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("aggregation", RasterExporter.aggregations)
+def bench_export_raster(benchmark, aggregation, n, tmp_dir):
+    path = os.path.join(tmp_dir, "raster.tif")
+    exporter = RasterExporter(50, aggregation=aggregation)
+    benchmark.pedantic(exporter.export, args=(synthetic_polygons(n), "value", path), rounds=1, iterations=1)
+    assert os.path.getsize(path) > 0
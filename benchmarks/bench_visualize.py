@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+import os
+import pytest
+
+from smm.framework.visualize import TileExporter
+from conftest import SIZES, synthetic_points, synthetic_polygons
+
+
+@pytest.mark.parametrize("n", SIZES)
+@pytest.mark.parametrize("data", [synthetic_points, synthetic_polygons])
+def bench_export_tiles(benchmark, data, n, tmp_dir):
+    path = os.path.join(tmp_dir, "tiles.pmtiles")
+    exporter = TileExporter(min_zoom=0, max_zoom=12, columns=["value", "category"])
+    benchmark.pedantic(exporter.export, args=(data(n), path), rounds=1, iterations=1)
+    assert os.path.getsize(path) > 0
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+
+import os
+from functools import lru_cache
+import numpy as np
+import geopandas as gpd
+import shapely
+import pytest
+
+# Row counts of the synthetic layers, e.g. SMM_BENCH_SIZES=1e4,1e5,1e6,1e7 for the full suite
+SIZES = [int(float(s)) for s in os.environ.get("SMM_BENCH_SIZES", "1e4,1e5").split(",")]
+SEED = 42
+# Munich area, same region as the bundled tutorial data
+BOUNDS = (11.36, 48.06, 11.72, 48.25)
+
+
+@lru_cache(maxsize=4)
+def synthetic_points(n: int, seed: int = SEED) -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(BOUNDS[0], BOUNDS[2], n)
+    y = rng.uniform(BOUNDS[1], BOUNDS[3], n)
+    return gpd.GeoDataFrame(
+        {
+            "value": rng.integers(0, 1000, n),
+            "weight": rng.random(n),
+            "category": rng.choice(["amenity_school", "shop_bakery", "building_yes", "landuse_retail"], n),
+        },
+        geometry=shapely.points(x, y),
+        crs="EPSG:4326")
+
+
+@lru_cache(maxsize=4)
+def synthetic_polygons(n: int, seed: int = SEED) -> gpd.GeoDataFrame:
+    '''Random squares with a size, so that the polygons cover the area roughly once.'''
+    rng = np.random.default_rng(seed)
+    size = np.sqrt((BOUNDS[2] - BOUNDS[0]) * (BOUNDS[3] - BOUNDS[1]) / n)
+    x = rng.uniform(BOUNDS[0], BOUNDS[2] - size, n)
+    y = rng.uniform(BOUNDS[1], BOUNDS[3] - size, n)
+    return gpd.GeoDataFrame(
+        {
+            "value": rng.integers(0, 1000, n),
+            "weight": rng.random(n),
+            "category": rng.choice(["residential", "commercial", "industrial", "retail"], n),
+        },
+        geometry=shapely.box(x, y, x + size * rng.uniform(0.5, 1.5, n), y + size * rng.uniform(0.5, 1.5, n)),
+        crs="EPSG:4326")
+
+
+
+@pytest.fixture
+def tmp_dir(tmp_path):
+    return str(tmp_path)
@@ -9,12 +9,14 @@ __email__ = "david.ziegler@tum.de"
 __status__ = "Production"
 __annotations__ = "Yaml config manager that deals with in Yaml imports and environment variable inserts as well as UTF-8"
 
-import os, re
+import os, re, copy, pickle, threading
 import tempfile
+from contextlib import contextmanager
 from typing import Any
 from piny import MatcherWithDefaults, YamlLoader, ValidationError, LoadingError
 from piny.loaders import yaml
 from dotmap import DotMap
+from .storage import atomic_path
 
 FRAMEWORK_ROOT = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 TEST_ROOT = os.path.join(FRAMEWORK_ROOT, "..", "tests")
@@ -22,6 +24,20 @@ TMP_ROOT = tempfile.gettempdir()
 os.environ["PROJECT_DIR_PATH"] = FRAMEWORK_ROOT
 
 
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _changed(files, env):
+    '''
+    Checks if any of the files (path: mtime) or environment variables (name: value) changed since they were recorded.
+    '''
+    return any(_mtime(f) != m for f, m in files.items()) or any(os.environ.get(k) != v for k, v in env.items())
+
+
 class UTFYamlLoader(YamlLoader):
 
     def load(self, **params) -> Any:
@@ -44,6 +60,9 @@ class UTFYamlLoader(YamlLoader):
 
 class MatcherWithDefaultsExt(MatcherWithDefaults):
     matcher = re.compile(r"\$\{([a-zA-Z_$0-9]+)(:-.*)?(:\?.*)?\}")
+    # Parsed include files by path with their mtime and the files and environment variables they depend on
+    _include_cache = {}
+    _tracking = threading.local()
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -59,14 +78,52 @@ class MatcherWithDefaultsExt(MatcherWithDefaults):
     def include(self, matcher, node):
         yml_path, sub = (node.value.split("|") + [""])[:2]
         node.value = yml_path.strip()
-        yml = YamlLoader(path=self.constructor(None, node), matcher=MatcherWithDefaultsExt).load()
-
-        return self._navigate_deep(yml, sub.strip())
+        yml = self._load_include(os.path.abspath(self.constructor(None, node)))
+
+        # Copy, as the same include can be inserted at several places of the config
+        return copy.deepcopy(self._navigate_deep(yml, sub.strip()))
+
+    @classmethod
+    @contextmanager
+    def track(cls):
+        '''
+        Records the files and environment variables read while loading within the block, including nested includes.
+        '''
+        frames = cls._tracking.__dict__.setdefault("frames", [])
+        frame = dict(files={}, env={})
+        frames.append(frame)
+        try:
+            yield frame
+        finally:
+            frames.pop()
+
+    @classmethod
+    def _record(cls, files=None, env=None):
+        for frame in getattr(cls._tracking, "frames", []):
+            frame["files"].update(files or {})
+            frame["env"].update(env or {})
+
+    @classmethod
+    def _load_include(cls, path):
+        '''
+        Parses an included file once, later includes of the same file reuse it as long as neither the file, its own
+        includes nor the environment variables used in them changed.
+        '''
+        cached = cls._include_cache.get(path)
+        if cached is None or _changed({path: cached["mtime"], **cached["files"]}, cached["env"]):
+            mtime = _mtime(path)
+            with cls.track() as frame:
+                yml = YamlLoader(path=path, matcher=MatcherWithDefaultsExt).load()
+            cached = cls._include_cache[path] = dict(mtime=mtime, yml=yml, **frame)
+        cls._record(files={path: cached["mtime"], **cached["files"]}, env=cached["env"])
+        return cached["yml"]
 
     @staticmethod
     def constructor(loader, node):
         match = MatcherWithDefaultsExt.matcher.match(node.value)
         variable, default, error = match.groups()    # type: ignore
+        if variable != 'CONFIG_BASE_DIR':
+            MatcherWithDefaultsExt._record(env={variable: os.environ.get(variable)})
 
         if default:
             # lstrip() is dangerous!
@@ -89,18 +146,66 @@ class MatcherWithDefaultsExt(MatcherWithDefaults):
 
 
 class ConfigManager(object):
-
-    def __init__(self, path):
+    '''
+    Loads a yaml config with includes and environment variables. With snapshot=True, the resolved config is stored
+    in a pickle sidecar next to the config, which is reused as long as none of the included files and referenced
+    environment variables changed.
+    '''
+    # Format of the snapshot, increase on changes to invalidate existing snapshots
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, path, snapshot=False):
         self._path = path
         self._config = None
+        self._dotmap = None
+        self.snapshot = snapshot
+
+    @property
+    def snapshot_file(self):
+        return self._path + ".smmcache"
 
-    def load(self, environment_vars=None):
+    def _read_snapshot(self):
+        if not os.path.isfile(self.snapshot_file):
+            return None
+        try:
+            with open(self.snapshot_file, "rb") as f:
+                snapshot = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+        if snapshot.get("version") != self.SNAPSHOT_VERSION or _changed(snapshot["files"], snapshot["env"]):
+            return None
+        return snapshot
+
+    def _write_snapshot(self, files, env):
+        try:
+            with atomic_path(self.snapshot_file) as tmp_file:
+                with open(tmp_file, "wb") as f:
+                    pickle.dump(dict(version=self.SNAPSHOT_VERSION, files=files, env=env, config=self._config), f)
+        except OSError:
+            # Snapshots are optional, e.g. for configs in read-only directories
+            pass
+
+    def load(self, environment_vars=None, use_cache=True):
         if environment_vars is not None:
             for k, v in environment_vars.items():
                 os.environ[k] = v
-        self._config = UTFYamlLoader(path=self._path, matcher=MatcherWithDefaultsExt).load()
+        self._dotmap = None
+        snapshot = self._read_snapshot() if self.snapshot and use_cache else None
+        if snapshot is not None:
+            self._config = snapshot["config"]
+            return self
+
+        path = os.path.abspath(self._path)
+        mtime = _mtime(path)
+        with MatcherWithDefaultsExt.track() as frame:
+            self._config = UTFYamlLoader(path=self._path, matcher=MatcherWithDefaultsExt).load()
+        if self.snapshot:
+            self._write_snapshot({**frame["files"], path: mtime}, frame["env"])
         return self
 
     @property
     def config(self):
-        return DotMap(self._config, _dynamic=False)
+        # Built once per load, changes to the DotMap are kept until the next load
+        if self._dotmap is None:
+            self._dotmap = DotMap(self._config, _dynamic=False)
+        return self._dotmap
@@ -1,17 +1,112 @@
-import os
+import os, io, re, time, json, uuid, hashlib, threading
 import psycopg2
-from sqlalchemy import create_engine
-from sqlalchemy.engine.url import URL
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from psycopg2 import pool as pgpool
+import numpy as np
+import pandas as pd
+import shapely
+from psycopg2 import sql as psql
+
+
+re_identifier = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+re_explainable = re.compile(
+    r"^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|CREATE\s+(TABLE|MATERIALIZED\s+VIEW)(\s+IF\s+NOT\s+EXISTS)?\s+\S+\s+AS\b)",
+    re.IGNORECASE)
+
+
+def render_sql(sql, placeholders=None, identifiers=False):
+    '''
+    Replaces $key placeholders in a single pass, so that inserted values are not substituted again. Dollar quotes
+    ($$, $func$) and parameters ($1) are left untouched, keys are matched longest first (e.g. $table in
+    $table_idx). With identifiers=True all values have to be plain SQL identifiers (schema and table names).
+    '''
+    placeholders = placeholders or {}
+    if not placeholders:
+        return sql
+    if identifiers:
+        for key, value in placeholders.items():
+            assert re_identifier.match(value), f"Placeholder ${key} is no valid identifier: {value!r}"
+    keys = "|".join(re.escape(k) for k in sorted(placeholders, key=len, reverse=True))
+    return re.sub(r"(?<!\$)\$(" + keys + r")(?![A-Za-z0-9_]*\$)", lambda m: placeholders[m.group(1)], sql)
+
+
+def split_sql(sql):
+    '''
+    Splits a script into its statements, semicolons in strings, quoted identifiers, dollar quotes and comments are
+    respected.
+    '''
+    statements, start, i, n = [], 0, 0, len(sql)
+    while i < n:
+        c = sql[i]
+        if c in ("'", '"'):
+            i = sql.find(c, i + 1)
+            while i != -1 and sql[i + 1:i + 2] == c:
+                i = sql.find(c, i + 2)
+            i = n if i == -1 else i + 1
+        elif sql.startswith("--", i):
+            i = sql.find("\n", i)
+            i = n if i == -1 else i + 1
+        elif sql.startswith("/*", i):
+            i = sql.find("*/", i + 2)
+            i = n if i == -1 else i + 2
+        elif c == "$" and re.match(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$", sql[i:]):
+            tag = re.match(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$", sql[i:]).group(0)
+            i = sql.find(tag, i + len(tag))
+            i = n if i == -1 else i + len(tag)
+        elif c == ";":
+            statements.append(sql[start:i].strip())
+            start = i = i + 1
+        else:
+            i += 1
+    statements.append(sql[start:].strip())
+    # Drop empty and comment-only statements
+    return [st for st in statements if split_sql.re_comments.sub("", st).strip()]
+
+
+split_sql.re_comments = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
 
 
 class DBBase(object):
+    # Postgres column types by numpy dtype kind
+    pg_types = {
+        "b": "boolean",
+        "i": "bigint",
+        "u": "bigint",
+        "f": "double precision",
+        "M": "timestamp",
+        "m": "interval",
+        "O": "text",
+        "U": "text",
+        "S": "text"
+    }
+
+    #Fixes upload errors
+    keepalive_kwargs = {
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 5,
+        "keepalives_count": 5,
+    }
 
     def __init__(self):
         super().__init__()
         self.conn = None
+        self.pool = None
+        self.retries = 3
+        self._engine = None
+        self._engine_kwargs = {}
+        self._slots = None
+        self._conn_lock = threading.RLock()
 
     def getSqlAlchemyCon(self):
-        return create_engine(self.con_url)
+        '''
+        Returns the SQLAlchemy engine of this database, which is created once and shared by all callers.
+        '''
+        if self._engine is None:
+            from sqlalchemy import create_engine
+            self._engine = create_engine(self.con_url, pool_pre_ping=True, **self._engine_kwargs)
+        return self._engine
 
     def switchSchemaTarget(self, target):
         return \
@@ -21,6 +116,7 @@ class DBBase(object):
         """
 
     def setConn(self, conn):
+        from sqlalchemy.engine.url import URL
         self.conn = conn
         self.con_url = str(
             URL(drivername="postgresql",
@@ -31,28 +127,51 @@ class DBBase(object):
                 database=conn.info.dbname))
         return self
 
-    def setupDB(self, host, port, username, password, database, extensions=None):
+    def setupDB(self,
+                host,
+                port,
+                username,
+                password,
+                database,
+                extensions=None,
+                minconn=1,
+                maxconn=8,
+                statement_timeout=None,
+                retries=3):
+        '''
+        Connects to the database and sets up a pool of up to maxconn connections, which are shared by threads through
+        getConnection. statement_timeout (in ms) applies to every pooled connection and the SQLAlchemy engine, queries
+        are retried up to `retries` times if the server dropped the connection.
+        '''
+        from sqlalchemy.engine.url import URL
+        assert 0 < minconn <= maxconn, "Requires 0 < minconn <= maxconn."
         self.host = f"{host}:{port}"
         self.username = username
         self.password = password
         self.database = database
+        self.retries = retries
         extensions = extensions or []
 
-        #Fixes upload errors
-        keepalive_kwargs = {
-            "keepalives": 1,
-            "keepalives_idle": 30,
-            "keepalives_interval": 5,
-            "keepalives_count": 5,
-        }
-
-        #Check extensions
+        connect_kwargs = dict(self.keepalive_kwargs)
+        if statement_timeout is not None:
+            connect_kwargs["options"] = f"-c statement_timeout={int(statement_timeout)}"
+        self.pool = pgpool.ThreadedConnectionPool(minconn,
+                                                  maxconn,
+                                                  dbname=database,
+                                                  user=username,
+                                                  password=password,
+                                                  host=host,
+                                                  port=port,
+                                                  **connect_kwargs)
+        #ThreadedConnectionPool raises if exhausted, threads wait for a free slot instead
+        self._slots = threading.BoundedSemaphore(maxconn)
+        #Dedicated connection for callers of self.conn, e.g. pandas.read_sql
         self.conn = psycopg2.connect(dbname=database,
                                      user=username,
                                      password=password,
                                      host=host,
                                      port=port,
-                                     **keepalive_kwargs)
+                                     **connect_kwargs)
         self.con_url = str(
             URL.create(drivername="postgresql",
                        host=host,
@@ -60,23 +179,276 @@ class DBBase(object):
                        username=username,
                        password=password,
                        database=database).render_as_string(hide_password=False))
+        self._engine = None
+        self._engine_kwargs = dict(pool_size=maxconn, max_overflow=0, connect_args=connect_kwargs)
+
+        #Check extensions
         sql = ["SET SCHEMA 'public';"]
         for e in extensions:
             sql.append(f"CREATE EXTENSION IF NOT EXISTS {e};")
         sql = "\n".join(sql)
-        with self.conn.cursor() as curs:
-            curs.execute(sql)
-        self.conn.commit()
+        self.executeSQL(sql)
         return self
 
-    def executeSQL(self, sql, placeholders={}):
-        for key, value in placeholders.items():
-            sql = sql.replace(f"${key}", value)
-        with self.conn.cursor() as curs:
-            curs.execute(sql)
-        self.conn.commit()
+    def closeDB(self):
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+        if self._engine is not None:
+            self._engine.dispose()
+            self._engine = None
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        return self
+
+    @contextmanager
+    def getConnection(self, statement_timeout=None):
+        '''
+        Checks out a connection of the pool, waiting until one is free. The connection is rolled back on errors and
+        returned to the pool afterwards, connections dropped by the server are discarded. Without a pool (setConn)
+        self.conn is handed out to one thread at a time.
+        '''
+        if self.pool is None:
+            assert self.conn is not None, "Please setup the database first."
+            with self._conn_lock:
+                yield from self._checkout(self.conn, statement_timeout, reset=False)
+            return
+        with self._slots:
+            conn = self.pool.getconn()
+            try:
+                yield from self._checkout(conn, statement_timeout, reset=True)
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+
+    def _checkout(self, conn, statement_timeout, reset):
+        if statement_timeout is not None:
+            with conn.cursor() as curs:
+                curs.execute("SET statement_timeout = %s", (int(statement_timeout), ))
+            conn.commit()
+        try:
+            yield conn
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            #Pooled connections are handed back without session settings like search_path
+            if (reset or statement_timeout is not None) and not conn.closed:
+                conn.rollback()
+                with conn.cursor() as curs:
+                    curs.execute("RESET ALL" if reset else "SET statement_timeout TO DEFAULT")
+                conn.commit()
+
+    def withConnection(self, fn, retries=None, statement_timeout=None):
+        '''
+        Calls fn(conn) with a pooled connection. If the server dropped the connection (the call failed and the
+        connection is closed), it is discarded and fn is retried on a new one with exponential backoff.
+        '''
+        retries = self.retries if retries is None else retries
+        attempt = 0
+        while True:
+            with self.getConnection(statement_timeout=statement_timeout) as conn:
+                try:
+                    return fn(conn)
+                except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                    if not conn.closed or attempt >= retries:
+                        raise
+            attempt += 1
+            time.sleep(min(2**attempt, 30))
+
+    def executeSQL(self, sql, placeholders={}, statement_timeout=None):
+        sql = render_sql(sql, placeholders, identifiers=True)
+
+        def _execute(conn):
+            with conn.cursor() as curs:
+                curs.execute(sql)
+            conn.commit()
+
+        self.withConnection(_execute, statement_timeout=statement_timeout)
+        return self
+
+    def _pgColumns(self, df, dtypes=None):
+        dtypes = dtypes or {}
+        columns = {}
+        for column, dtype in df.dtypes.items():
+            if column in dtypes:
+                columns[column] = dtypes[column]
+            elif dtype.name == "geometry":
+                srid = df[column].values.crs.to_epsg() if df[column].values.crs is not None else 0
+                columns[column] = f"geometry(Geometry, {srid or 0})"
+            elif isinstance(dtype, pd.CategoricalDtype):
+                columns[column] = self.pg_types.get(dtype.categories.dtype.kind, "text")
+            else:
+                columns[column] = self.pg_types.get(getattr(dtype, "kind", "O"), "text")
+        return columns
+
+    def _csvChunk(self, df):
+        df = pd.DataFrame(df)
+        for column, dtype in df.dtypes.items():
+            if dtype.name == "geometry":
+                srid = df[column].values.crs.to_epsg() if df[column].values.crs is not None else 0
+                geoms = shapely.set_srid(np.asarray(df[column].values), srid or 0)
+                df[column] = shapely.to_wkb(geoms, hex=True, include_srid=True)
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False, na_rep="\\N")
+        buffer.seek(0)
+        return buffer
+
+    def bulkUpload(self, data, table, schema="public", dtypes=None, if_exists="replace", index=False, chunksize=100000):
+        '''
+        Uploads a (Geo)DataFrame or a data layer with COPY ... FROM STDIN into a staging table, which then replaces
+        (if_exists="replace") or is appended to (if_exists="append") the target table in one transaction. Geometries
+        are transferred as hex EWKB, dtypes allows to override the postgres column types.
+        '''
+        assert if_exists in ("replace", "append", "fail"), "if_exists has to be one of replace, append or fail."
+        df = getattr(data, "content", data)
+        if index:
+            df = df.reset_index()
+        columns = self._pgColumns(df, dtypes=dtypes)
+        target = psql.Identifier(schema, table)
+        staging = psql.Identifier(schema, f"{table}__staging")
+        column_names = psql.SQL(", ").join(psql.Identifier(c) for c in columns)
+
+        def _upload(conn):
+            with conn.cursor() as curs:
+                curs.execute(psql.SQL("SELECT to_regclass(%s) IS NOT NULL"), (f'"{schema}"."{table}"', ))
+                exists = curs.fetchone()[0]
+                if exists and if_exists == "fail":
+                    raise ValueError(f"Table {schema}.{table} already exists.")
+                curs.execute(psql.SQL("DROP TABLE IF EXISTS {}").format(staging))
+                curs.execute(
+                    psql.SQL("CREATE TABLE {} ({})").format(
+                        staging,
+                        psql.SQL(", ").join(
+                            psql.SQL("{} {}").format(psql.Identifier(c), psql.SQL(t)) for c, t in columns.items())))
+                copy = psql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')").format(staging, column_names)
+                for i in range(0, len(df), chunksize):
+                    curs.copy_expert(copy.as_string(conn), self._csvChunk(df.iloc[i:i + chunksize]))
+                if exists and if_exists == "append":
+                    curs.execute(
+                        psql.SQL("INSERT INTO {} ({}) SELECT {} FROM {}").format(target, column_names, column_names,
+                                                                                 staging))
+                    curs.execute(psql.SQL("DROP TABLE {}").format(staging))
+                else:
+                    curs.execute(psql.SQL("DROP TABLE IF EXISTS {}").format(target))
+                    curs.execute(psql.SQL("ALTER TABLE {} RENAME TO {}").format(staging, psql.Identifier(table)))
+            conn.commit()
+
+        self.withConnection(_upload)
+        return self
+
+    def fetchChunks(self, sql, chunksize=100000, setup_sql=None):
+        '''
+        Streams the result of a single select statement in DataFrame chunks over a named (server-side) cursor, so
+        that only one chunk is held in client memory. Statements like "SET search_path" go into setup_sql.
+        '''
+        with self.getConnection() as conn:
+            try:
+                if setup_sql is not None:
+                    with conn.cursor() as curs:
+                        curs.execute(setup_sql)
+                with conn.cursor(name=f"smm_{uuid.uuid4().hex}") as curs:
+                    curs.itersize = chunksize
+                    curs.execute(sql.strip().rstrip(";"))
+                    columns = None
+                    while True:
+                        rows = curs.fetchmany(chunksize)
+                        if columns is None:
+                            columns = [c.name for c in curs.description]
+                        if not rows:
+                            break
+                        yield pd.DataFrame.from_records(rows, columns=columns)
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+
+
+class SQLStepRunner(object):
+    '''
+    Runs named SQL steps as a dependency graph, independent steps concurrently on separate pooled connections.
+    Finished steps are recorded with the checksum of their SQL in a state table, so that a rerun (e.g. after a crash)
+    skips them and only runs missing, failed or changed steps.
+    '''
+
+    def __init__(self, db: DBBase, schema="public", state_table="smm_setup_state") -> None:
+        self.db = db
+        self.state_table = psql.Identifier(schema, state_table)
+        self.steps = {}
+
+    def add(self, name, sql, depends=None):
+        depends = list(depends or [])
+        assert name not in self.steps, f"Step {name} is already defined."
+        for d in depends:
+            # Dependencies have to be added first, which keeps the graph acyclic
+            assert d in self.steps, f"Unknown dependency {d} of step {name}."
+        self.steps[name] = dict(sql=sql, depends=depends, checksum=hashlib.sha256(sql.encode("utf-8")).hexdigest())
         return self
 
+    def finished(self):
+        '''
+        Returns the recorded steps with the checksum of their SQL.
+        '''
+
+        def _finished(conn):
+            with conn.cursor() as curs:
+                curs.execute(
+                    psql.SQL("""CREATE TABLE IF NOT EXISTS {} (
+                                  step text PRIMARY KEY,
+                                  checksum text NOT NULL,
+                                  finished_at timestamptz NOT NULL DEFAULT now())""").format(self.state_table))
+                curs.execute(psql.SQL("SELECT step, checksum FROM {}").format(self.state_table))
+                rows = curs.fetchall()
+            conn.commit()
+            return dict(rows)
+
+        return self.db.withConnection(_finished)
+
+    def _run_step(self, name):
+        step = self.steps[name]
+
+        def _execute(conn):
+            with conn.cursor() as curs:
+                curs.execute(step["sql"])
+                curs.execute(
+                    psql.SQL("""INSERT INTO {} (step, checksum) VALUES (%s, %s)
+                                ON CONFLICT (step) DO UPDATE
+                                SET checksum = EXCLUDED.checksum, finished_at = now()""").format(self.state_table),
+                    (name, step["checksum"]))
+            conn.commit()
+
+        self.db.withConnection(_execute)
+        return name
+
+    def run(self, max_workers=None, force=False):
+        '''
+        Runs all steps which are not finished yet (all with force=True) and returns their names. If a step fails, no
+        further steps are started, the running ones are awaited and the error is raised.
+        '''
+        if max_workers is None:
+            max_workers = self.db.pool.maxconn if self.db.pool is not None else 1
+        finished = {} if force else self.finished()
+        pending = [n for n, step in self.steps.items() if finished.get(n) != step["checksum"]]
+        done = set(self.steps) - set(pending)
+        executed, running, error = [], {}, None
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending or running:
+                for name in [n for n in pending if all(d in done for d in self.steps[n]["depends"])]:
+                    pending.remove(name)
+                    running[executor.submit(self._run_step, name)] = name
+                completed, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in completed:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                        executed.append(name)
+                    except Exception as e:
+                        error = error or e
+                        pending = []
+        if error is not None:
+            raise error
+        return executed
+
 
 class SQLTemplateManager:
 
@@ -92,10 +464,108 @@ class SQLTemplateManager:
         # Substitute placeholders
         #sql_template = sql_template.replace("{}", "")    # Replace all {}-sequences without specifiers
         if replacements is not None:
-            sql = sql_template
-            for k, v in replacements.items():
-                sql = sql.replace("$" + k, v)
+            sql = render_sql(sql_template, replacements)
         else:
             sql = sql_template
 
         return sql
+
+
+class SQLBundle(object):
+    '''
+    Exports SQL steps for offline execution (e.g. on air-gapped hosts) into a directory:
+    NN_<step>.sql per step, manifest.json with order, dependencies and checksums, bundle.psql which runs all steps
+    from its own directory (psql -1 -f <dir>/bundle.psql for a single transaction from anywhere) and
+    bundle_explain.psql, which additionally captures EXPLAIN (ANALYZE, BUFFERS) and \\timing per statement into
+    explain_report.txt.
+    '''
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.steps = {}
+
+    def add(self, name, sql, depends=None, placeholders=None):
+        name = name or f"step_{len(self.steps)}"
+        depends = list(depends or [])
+        assert name not in self.steps, f"Step {name} is already defined."
+        for d in depends:
+            assert d in self.steps, f"Unknown dependency {d} of step {name}."
+        sql = render_sql(sql, placeholders, identifiers=True)
+        self.steps[name] = dict(file=f"{len(self.steps)}_{name}.sql",
+                                sql=sql,
+                                depends=depends,
+                                checksum=hashlib.sha256(sql.encode("utf-8")).hexdigest())
+        return self
+
+    def write(self, transactional=False):
+        '''
+        Writes the bundle, with transactional=True bundle.psql runs in one transaction even without psql -1.
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        manifest = []
+        for name, step in self.steps.items():
+            with open(os.path.join(self.path, step["file"]), mode="w", encoding="utf-8") as f:
+                f.write(step["sql"])
+            manifest.append(dict(step=name, file=step["file"], depends=step["depends"], checksum=step["checksum"]))
+        with open(os.path.join(self.path, "manifest.json"), mode="w", encoding="utf-8") as f:
+            json.dump(dict(steps=manifest), f, indent=2)
+
+        bundle = ["\\set ON_ERROR_STOP on"]
+        bundle += ["BEGIN;"] if transactional else []
+        bundle += [f"\\echo {name}\n\\ir {step['file']}" for name, step in self.steps.items()]
+        bundle += ["COMMIT;"] if transactional else []
+        with open(os.path.join(self.path, "bundle.psql"), mode="w", encoding="utf-8") as f:
+            f.write("\n".join(bundle) + "\n")
+
+        explain = ["\\set ON_ERROR_STOP on", "\\timing on", "\\o explain_report.txt"]
+        for name, step in self.steps.items():
+            for i, statement in enumerate(split_sql(step["sql"])):
+                explain.append(f"\\qecho '-- {name} [{i}]'")
+                prefix = "EXPLAIN (ANALYZE, BUFFERS) " if re_explainable.match(statement) else ""
+                explain.append(prefix + statement + ";")
+        explain.append("\\o")
+        with open(os.path.join(self.path, "bundle_explain.psql"), mode="w", encoding="utf-8") as f:
+            f.write("\n".join(explain) + "\n")
+        return self
+
+    def explain(self, db: DBBase, report=None):
+        '''
+        Runs the steps against a database and captures EXPLAIN (ANALYZE, BUFFERS) of every explainable statement,
+        other statements (indexes, CLUSTER, functions) are timed only. Each step commits. Returns the report as
+        list of statements with wall time, planning/execution time and shared buffers, sorted by wall time, and
+        writes it as json if a report path is given.
+        '''
+        records = []
+
+        def _run(conn, name, i, statement):
+            record = dict(step=name, statement=i, sql=statement[:200])
+            with conn.cursor() as curs:
+                _start = time.perf_counter()
+                if re_explainable.match(statement):
+                    curs.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement)
+                    # No plan, if e.g. CREATE ... IF NOT EXISTS skipped an existing relation
+                    row = curs.fetchone()
+                    plan = row[0][0] if row else {}
+                    record.update(planning_time=plan.get("Planning Time"),
+                                  execution_time=plan.get("Execution Time"),
+                                  shared_hit_blocks=plan.get("Plan", {}).get("Shared Hit Blocks"),
+                                  shared_read_blocks=plan.get("Plan", {}).get("Shared Read Blocks"),
+                                  plan=plan)
+                else:
+                    curs.execute(statement)
+                record["wall_time"] = time.perf_counter() - _start
+            records.append(record)
+
+        for name, step in self.steps.items():
+
+            def _step(conn):
+                for i, statement in enumerate(split_sql(step["sql"])):
+                    _run(conn, name, i, statement)
+                conn.commit()
+
+            db.withConnection(_step, retries=0)
+        records = sorted(records, key=lambda r: r["wall_time"], reverse=True)
+        if report is not None:
+            with open(report, mode="w", encoding="utf-8") as f:
+                json.dump(records, f, indent=2, default=str)
+        return records
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+__annotations__ = "File system helpers for crash-safe and concurrency-safe writes"
+
+import os, time, uuid, json
+from contextlib import contextmanager
+
+
+class ConcurrentModificationError(Exception):
+    pass
+
+
+class LockTimeoutError(Exception):
+    pass
+
+
+@contextmanager
+def atomic_path(path):
+    '''
+    Yields a temporary path next to the target, which is renamed onto the target once the block succeeded.
+    The extension is kept, so that format detection by extension (e.g. geofileops, fiona) still works.
+    '''
+    path = os.path.abspath(path)
+    _dir, _file = os.path.split(path)
+    _base, _ext = os.path.splitext(_file)
+    tmp_path = os.path.join(_dir, f".{_base}.{uuid.uuid4().hex[:8]}.tmp{_ext}")
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+class FileLock(object):
+    '''
+    Inter-process lock based on an exclusively created lock file, which works on posix and windows.
+    Locks older than `stale` seconds are considered left over from a crashed process and are broken.
+    '''
+
+    def __init__(self, path, timeout: float = 60., stale: float = 3600., poll: float = 0.1) -> None:
+        self.path = path + ".lock"
+        self.timeout = timeout
+        self.stale = stale
+        self.poll = poll
+        self._fd = None
+
+    def acquire(self):
+        _start = time.monotonic()
+        while True:
+            try:
+                self._fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(self._fd, json.dumps(dict(pid=os.getpid(), time=time.time())).encode("utf-8"))
+                return self
+            except FileExistsError:
+                if self._is_stale():
+                    self._break()
+                    continue
+                if self.timeout is not None and time.monotonic() - _start > self.timeout:
+                    raise LockTimeoutError(f"Could not acquire lock '{self.path}' within {self.timeout}s.")
+                time.sleep(self.poll)
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+            self._break()
+
+    def _is_stale(self):
+        try:
+            return time.time() - os.path.getmtime(self.path) > self.stale
+        except FileNotFoundError:
+            return False
+
+    def _break(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
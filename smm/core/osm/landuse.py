@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+__author__ = "David Ziegler"
+__copyright__ = "Copyright 2021, David Ziegler"
+__credits__ = ["David Ziegler"]
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+__maintainer__ = "David Ziegler"
+__email__ = "david.ziegler@tum.de"
+__status__ = "Production"
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union
+from ...framework.loaders import FileLoader
+from .mappings import category_vocabulary
+
+# Landuse tags, which are kept as POIs of a building (see osm_landuse_extract.sql)
+LANDUSE_POI_TAGS = [
+    "industrial", "education", "retail", "commercial", "residential", "allotments", "cemetery", "grass", "meadow",
+    "forest"
+]
+
+
+def boundary_tiles(boundary, tile_size=1.):
+    '''
+    Splits a boundary GeoDataFrame into a grid of square tiles of tile_size degrees (EPSG:4326), clipped to the
+    boundary. Returns a dict of tile name and geometry, tiles outside of the boundary are dropped.
+    '''
+    shape = shapely.union_all(boundary.to_crs(4326).geometry.values)
+    minx, miny, maxx, maxy = shape.bounds
+    xs = np.arange(minx, maxx, tile_size)
+    ys = np.arange(miny, maxy, tile_size)
+    xx, yy = [a.ravel() for a in np.meshgrid(xs, ys)]
+    tiles = shapely.intersection(shapely.box(xx, yy, xx + tile_size, yy + tile_size), shape)
+    return {f"tile_{i}": tile for i, tile in enumerate(tiles) if not tile.is_empty}
+
+
+def cumulative_area(area, max_area, poi_no, groups):
+    '''
+    Vectorized area_aggregator(area, max_area, poi_no) OVER (PARTITION BY groups ORDER BY poi_no DESC): visited in
+    descending poi_no, every POI gets min((area - assigned) / poi_no, max_area) of the remaining building area.
+    Rows have to be sorted by groups and descending poi_no, the loop runs over the POI positions, not the rows.
+    '''
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    lengths = np.diff(np.r_[starts, len(groups)])
+    cum = np.empty(len(groups), dtype=float)
+    state = np.full(len(starts), -1.)
+    for j in range(lengths.max() if len(lengths) else 0):
+        active = lengths > j
+        rows = starts[active] + j
+        _state = state[active]
+        first = _state == -1.
+        #LEAST ignores NULLs
+        step = np.fmin((area[rows] - np.where(first, 0., _state)) / poi_no[rows], max_area[rows])
+        state[active] = np.where(first, step, _state + step)
+        cum[rows] = state[active]
+    return cum
+
+
+class LandUseEngine(object):
+    '''
+    Offline equivalent of osm_landuse_extract.sql (OSM_POI_SETUP.query_landuse) over GeoDataFrames or files instead
+    of PostGIS. Inputs are the framework layers planet_osm_landuse (osm_id, feature, geom), planet_osm_poi_polygons
+    (way_id, area, features, center), planet_osm_polygon (osm_id, way) and the planet_osm_poi_meta mappings
+    (OSM_POI_SETUP.framework_mappings), geometries in EPSG:3857 like osm2pgsql. The category columns of the result
+    are categoricals of the meta vocabulary (see mappings.category_vocabulary).
+    '''
+    crs = "EPSG:3857"
+
+    def __init__(self,
+                 meta: pd.DataFrame,
+                 landuse: gpd.GeoDataFrame,
+                 poi_polygons: gpd.GeoDataFrame,
+                 polygons: gpd.GeoDataFrame,
+                 category: str = "landuse_munich_mappings") -> None:
+        assert category in meta.columns, f"Unknown mapping {category}."
+        self.meta = meta.reset_index(drop=True)
+        self.category = category
+        self.vocabulary = category_vocabulary(self.meta, category)
+        self.landuse = self._geo(landuse, "geom")
+        self.poi_polygons = self._geo(poi_polygons, "center")
+        self.polygons = self._geo(polygons, "way")
+
+    @classmethod
+    def from_files(cls, meta, landuse, poi_polygons, polygons, **kwargs):
+        _read = lambda x: FileLoader(x).content if isinstance(x, str) else x
+        return cls(_read(meta), _read(landuse), _read(poi_polygons), _read(polygons), **kwargs)
+
+    def _geo(self, gdf, geometry):
+        if gdf.geometry.name != geometry:
+            gdf = gdf.rename_geometry(geometry)
+        return gdf.to_crs(self.crs) if gdf.crs is not None else gdf.set_crs(self.crs)
+
+    def _match_meta(self, features: pd.Series):
+        '''
+        Pairs of (feature position, meta row) for (OSM_tag ISNULL AND OSM_key = feature) OR full_category = feature.
+        '''
+        meta = self.meta
+        _features = pd.DataFrame(dict(feature=features.to_numpy(), _row=np.arange(len(features))))
+        by_key = _features.merge(pd.DataFrame(dict(feature=meta.loc[meta["OSM_tag"].isna(), "OSM_key"])).reset_index(),
+                                 on="feature")
+        by_category = _features.merge(pd.DataFrame(dict(feature=meta["full_category"])).reset_index(), on="feature")
+        pairs = pd.concat([by_key, by_category], ignore_index=True).drop_duplicates(["_row", "index"])
+        pairs = pairs.sort_values(["_row", "index"])
+        return pairs["_row"].to_numpy(), pairs["index"].to_numpy()
+
+    def extract(self, boundary) -> gpd.GeoDataFrame:
+        '''
+        Landuse extraction of a boundary (shapely geometry in EPSG:4326 or GeoDataFrame), with the columns of
+        query_landuse.
+        '''
+        if isinstance(boundary, gpd.GeoDataFrame):
+            boundary = shapely.union_all(boundary.to_crs(4326).geometry.values)
+        shape = gpd.GeoSeries([boundary], crs=4326).to_crs(self.crs).iloc[0]
+        meta = self.meta
+
+        #Landuse polygons in the boundary (bbox) with their category
+        landuse = self.landuse.iloc[np.sort(self.landuse.sindex.query(shape))]
+        _rows, _meta = self._match_meta(landuse["feature"])
+        landuse_shapes = landuse.geometry.values[_rows]
+        landuse_categories = meta[self.category].to_numpy()[_meta]
+
+        #Buildings with center in the boundary and the category of the first landuse containing the center
+        pois = self.poi_polygons.iloc[np.sort(self.poi_polygons.sindex.query(shape, predicate="intersects"))]
+        _poi, _landuse = shapely.STRtree(landuse_shapes).query(pois.geometry.values, predicate="intersects")
+        # DISTINCT ON (way_id) keeps any landuse, take the first one for reproducible results
+        _order = np.lexsort((_landuse, _poi))
+        _poi, _landuse = _poi[_order], _landuse[_order]
+        landuse_category = pd.Series(landuse_categories[_landuse], index=_poi).groupby(level=0).first()
+        pois = pois.assign(landuse_category=landuse_category.reindex(np.arange(len(pois))).to_numpy())
+
+        #Building geometries
+        polygons = self.polygons.iloc[np.sort(self.polygons.sindex.query(shape))]
+        pois = pois.merge(pd.DataFrame(dict(way_id=polygons["osm_id"].to_numpy(), geom=polygons.geometry.values)),
+                          on="way_id")
+
+        #One row per feature and matching mapping
+        features = pois["features"].explode()
+        distinct = features.groupby(level=0).nunique().reindex(pois.index).to_numpy()
+        buildings = pois.loc[features.index].reset_index(drop=True).assign(feature=features.to_numpy(),
+                                                                          distinct=distinct[features.index])
+        _rows, _meta = self._match_meta(buildings["feature"])
+        b = buildings.iloc[_rows].reset_index(drop=True)
+        m = meta.iloc[_meta].reset_index(drop=True)
+        key, tag = m["OSM_key"], m["OSM_tag"]
+        keep = (key.notna() & (key != "") & ((key != "landuse") | tag.isin(LANDUSE_POI_TAGS))).to_numpy()
+        b, m = b[keep].reset_index(drop=True), m[keep].reset_index(drop=True)
+
+        area = b["area"].to_numpy(dtype=float)
+        max_area = np.where(b["distinct"].to_numpy() == 1, area,
+                            np.fmin(area, m["Maximum_area"].fillna(pd.Series(area)).to_numpy(dtype=float)))
+        is_building_yes = ((m["OSM_key"] == "building") & (m["OSM_tag"] == "yes")).to_numpy()
+        categories = np.where(is_building_yes,
+                              b["landuse_category"].fillna(m[self.category]).to_numpy(), m[self.category].to_numpy())
+        df = pd.DataFrame(
+            dict(osm_id=b["way_id"].to_numpy(),
+                 area=area,
+                 max_area=max_area,
+                 employees_sqm=m["Employees_per_sqm"].fillna(0).to_numpy(dtype=float),
+                 visitors_sqm=m["Visitor_per_sqm_per_day"].fillna(0).to_numpy(dtype=float),
+                 full_categories=categories,
+                 osm_feature=b["feature"].to_numpy(),
+                 geom=b["geom"].to_numpy()))
+
+        #ROW_NUMBER() OVER (PARTITION BY osm_id ORDER BY max_area DESC), then accumulate by descending poi_no
+        df = df.sort_values(["osm_id", "max_area"], ascending=[True, False], kind="stable", na_position="first")
+        df["poi_no"] = df.groupby("osm_id").cumcount() + 1
+        df = df.iloc[::-1].sort_values("osm_id", kind="stable")
+        groups = df["osm_id"].to_numpy()
+        cum = cumulative_area(df["area"].to_numpy(), df["max_area"].to_numpy(), df["poi_no"].to_numpy(), groups)
+        first = np.r_[True, groups[1:] != groups[:-1]]
+        df["area"] = np.where(first, cum, cum - np.r_[np.nan, cum[:-1]])
+        df["visitor_capacity"] = df["area"] * df["employees_sqm"] + df["area"] * df["visitors_sqm"]
+        df = df[["osm_id", "geom", "full_categories", "osm_feature", "visitor_capacity", "area"]]
+        return gpd.GeoDataFrame(self.vocabulary.encode(df.reset_index(drop=True)), geometry="geom", crs=self.crs)
+
+    def extract_tiles(self,
+                      boundary: Union[gpd.GeoDataFrame, dict],
+                      tile_size: float = 0.1,
+                      max_workers: int = None) -> gpd.GeoDataFrame:
+        '''
+        Extracts a boundary GeoDataFrame split into tiles (see boundary_tiles) or a dict of boundaries concurrently.
+        Buildings extracted by several tiles are kept for the first tile only.
+        '''
+        tiles = boundary_tiles(boundary, tile_size=tile_size) if isinstance(boundary, gpd.GeoDataFrame) else boundary
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(self.extract, tiles.values()))
+        if not results:
+            return self.extract(shapely.Polygon())
+        df = pd.concat([r.assign(_tile=i) for i, r in enumerate(results)], ignore_index=True)
+        df = df[df.groupby("osm_id")["_tile"].transform("min") == df["_tile"]].drop(columns="_tile")
+        #Tiles with values missing in the vocabulary have other categories
+        return gpd.GeoDataFrame(self.vocabulary.encode(df.reset_index(drop=True)), geometry="geom", crs=self.crs)
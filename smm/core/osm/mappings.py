@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+__author__ = "David Ziegler"
+__copyright__ = "Copyright 2021, David Ziegler"
+__credits__ = ["David Ziegler"]
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+__maintainer__ = "David Ziegler"
+__email__ = "david.ziegler@tum.de"
+__status__ = "Production"
+
+import json
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+from ...framework.categories import CategoryVocabulary
+
+
+class MappingEngine(object):
+    '''
+    Assigns categories to OSM key/tag pairs based on json mappings like landuse_munich_mappings.json. Per key, a dict
+    maps the tags, where "*" matches any non-empty tag and "!*" a missing tag. A plain value maps the missing tag only.
+    All mappings are flattened into one lookup table and resolved with index lookups instead of row-wise calls.
+    '''
+    ANY = "*"
+    EMPTY = "!*"
+
+    def __init__(self, mappings: Dict[str, dict]) -> None:
+        self.names = list(mappings.keys())
+        self.lookup = self.flatten(mappings)
+
+    @classmethod
+    def from_files(cls, files: List[str]):
+        mappings = {}
+        for file in files:
+            with open(file) as f:
+                mappings.update(json.load(f))
+        return cls(mappings)
+
+    @classmethod
+    def flatten(cls, mappings: Dict[str, dict]) -> pd.DataFrame:
+        '''
+        Flattens the mappings into rows of (mapping, OSM_key, OSM_tag, wildcard, value), the tag is None for
+        wildcard rows.
+        '''
+        rows = []
+        for name, mapping in mappings.items():
+            for key, _map in mapping.items():
+                if isinstance(_map, dict):
+                    for tag, value in _map.items():
+                        wildcard = tag if tag in (cls.ANY, cls.EMPTY) else ""
+                        rows.append((name, key, None if wildcard else tag, wildcard, value))
+                else:
+                    rows.append((name, key, None, cls.EMPTY, _map))
+        return pd.DataFrame.from_records(rows, columns=["mapping", "OSM_key", "OSM_tag", "wildcard", "value"])
+
+    def apply(self, df: pd.DataFrame, key: str = "OSM_key", tag: str = "OSM_tag") -> pd.DataFrame:
+        '''
+        Returns a column per mapping with the category of each row of df, None if no mapping applies.
+        '''
+        keys, tags = df[key], df[tag]
+        empty = (tags.isna() | (tags == "")).to_numpy()
+        pairs = pd.MultiIndex.from_arrays([keys, tags])
+        result = {name: np.full(len(df), None, dtype=object) for name in self.names}
+        for name, lookup in self.lookup.groupby("mapping", sort=False):
+            exact = lookup[lookup["wildcard"] == ""].set_index(["OSM_key", "OSM_tag"])["value"]
+            any_tag = lookup[lookup["wildcard"] == self.ANY].set_index("OSM_key")["value"]
+            no_tag = lookup[lookup["wildcard"] == self.EMPTY].set_index("OSM_key")["value"]
+
+            values = result[name]
+            hit = ~empty & keys.isin(any_tag.index).to_numpy()
+            values[hit] = keys[hit].map(any_tag).to_numpy()
+            hit = ~empty & pairs.isin(exact.index)
+            values[hit] = exact.reindex(pairs[hit]).to_numpy()
+            hit = empty & keys.isin(no_tag.index).to_numpy()
+            values[hit] = keys[hit].map(no_tag).to_numpy()
+        return pd.DataFrame(result, index=df.index, columns=self.names)
+
+
+def category_vocabulary(meta: pd.DataFrame, category: str = "landuse_munich_mappings") -> CategoryVocabulary:
+    '''
+    Category vocabulary of planet_osm_poi_meta (OSM_POI_SETUP.framework_mappings) for the string columns of the
+    mappings and the landuse extraction, where full_categories are values of the category mapping and osm_feature
+    either keys or full categories.
+    '''
+    columns = [c for c in meta.columns if c != "jsonb" and pd.api.types.is_string_dtype(meta[c])]
+    aliases = dict(full_categories=[category], osm_feature=["OSM_key", "full_category"])
+    return CategoryVocabulary.from_frame(meta, columns, aliases=aliases)
@@ -9,25 +9,14 @@ __maintainer__ = "David Ziegler"
 __email__ = "david.ziegler@tum.de"
 __status__ = "Production"
 
-import re, itertools
-import sqlfluff
-from collections import defaultdict, Iterable
-from bs4 import BeautifulSoup
+import os, re, json, hashlib, itertools
+from collections import defaultdict
+from lxml import etree
 from more_itertools import unique_justseen
-from sqlglot import parse_one, parse, exp
-from sqlglot.dialects import postgres
-from sqlglot.tokens import Tokenizer, TokenType
-from sqlglot.trie import new_trie
-from jsonpath_ng import jsonpath
-from jsonpath_ng.ext import parse
-
-
-def flatten(xs):
-    for x in xs:
-        if isinstance(x, Iterable) and not isinstance(x, (str, bytes)):
-            yield from flatten(x)
-        else:
-            yield x
+from ...common.storage import atomic_path
+
+# Version of the parsing and sql rewriting, increase on changes to invalidate compiled caches
+PARSER_VERSION = 3
 
 
 def remove_duplicates(k):
@@ -39,98 +28,99 @@ class MapnikSqlParser(object):
 
     re_outer_clamps = re.compile(r"\(((?:[^()]*\([^()]*\))*[^()]*?)\)")
     re_color_hash = re.compile(r"#[0-9a-f]{3,6}")
-    re_inside_clamps = re.compile(r"\((?P<content>[.\s\S]+)\)")
-    re_way_replace = re.compile(
-        r"(?P<content>[^\w\d](way,))(?=(?:(?!osm_id)(?:[\s\S]))*?(?:[^\w\d]way|$))"
-    )
-
-    def __init__(self, mapnik_file):
-
-        class PSQL(postgres.Postgres):
-
-            def __init__(self) -> None:
-                super().__init__()
-
-            class Tokenizer(postgres.Postgres.Tokenizer):
-
-                def __new__(cls):
-                    cls.KEYWORD_TRIE = new_trie(
-                        key.upper() for key in {
-                            **cls.KEYWORDS,
-                            **{
-                                comment: TokenType.COMMENT
-                                for comment in cls._COMMENTS
-                            },
-                            **{
-                                quote: TokenType.QUOTE
-                                for quote in cls._QUOTES
-                            },
-                            **{
-                                bit_string: TokenType.BIT_STRING
-                                for bit_string in cls._BIT_STRINGS
-                            },
-                            **{
-                                hex_string: TokenType.HEX_STRING
-                                for hex_string in cls._HEX_STRINGS
-                            },
-                            **{
-                                byte_string: TokenType.BYTE_STRING
-                                for byte_string in cls._BYTE_STRINGS
-                            },
-                        }
-                        if " " in key or any(single in key
-                                             for single in cls.SINGLE_TOKENS))
-                    return super().__new__(cls)
 
+    #Sql rewriting of parse_mapnik_sql, placeholders like !bbox! are parsed as identifiers __bbox__
+    dialect = "postgres"
+    re_placeholder = re.compile(r"!(.*?)!")
+    re_placeholder_identifier = re.compile(r"__\S+__")
+    select_replacements = {"__scale_denominator__": 1}
+    osm_tables = {"planet_osm_point": "point", "planet_osm_polygon": "polygon"}
+    building_feature = ("'building_'::text || CASE WHEN _.building IS NOT NULL AND _.way_area IS NOT NULL "
+                        "THEN _.building ELSE NULL::text END")
+
+    def __init__(self, mapnik_file, cache_dir=None):
         self.mapnik_file = mapnik_file
         self.mapnik_info = {}
         self.mapnik_loaded = False
+        self.cache_dir = cache_dir
+        self._compiled = None
+        #Compiled layers not yet written to the cache
+        self._dirty = False
+
+    def _rule_properties_bs4(self, _rule):
+        _rule_properties = {"MaxScale": None, "MinScale": None, "Filter": None, "Styles": None}
+
+        _styles = _rule.findChildren()
+
+        #Find MaxScaleDenominator
+        __filter = _rule.find("MaxScaleDenominator")
+        if __filter is not None:
+            _rule_properties["MaxScale"] = int(__filter.text)
+            _styles = __filter.fetchNextSiblings()
+
+        #Find MinScaleDenominator
+        __filter = _rule.find("MinScaleDenominator")
+        if __filter is not None:
+            _rule_properties["MinScale"] = int(__filter.text)
+            _styles = __filter.fetchNextSiblings()
+
+        #Find Filter
+        __filter = _rule.find("Filter")
+        if __filter is not None:
+            _rule_properties["Filter"] = self.re_outer_clamps.findall(__filter.text)
+            _rule_properties["Filter"] = [_e for _e in _rule_properties["Filter"] if "way_pixels" not in _e]
+            _styles = __filter.fetchNextSiblings()
+
+        #Scan for styles
+        _rule_properties["Styles"] = frozenset(
+            frozenset([_f.name]) | frozenset(self.re_color_hash.findall(str(_f))) for _f in _styles)
+        return _rule_properties
+
+    def _rule_properties_etree(self, _rule):
+        '''
+        Same as _rule_properties_bs4 for lxml elements, e.g. findChildren() is recursive and .text contains the text
+        of all descendants in BeautifulSoup.
+        '''
+        _rule_properties = {"MaxScale": None, "MinScale": None, "Filter": None, "Styles": None}
+        _text = lambda e: "".join(e.itertext())
+        _next_siblings = lambda e: [_e for _e in e.itersiblings() if isinstance(_e.tag, str)]
+
+        _styles = [_e for _e in _rule.iterdescendants() if isinstance(_e.tag, str)]
+
+        #Find MaxScaleDenominator
+        __filter = _rule.find(".//MaxScaleDenominator")
+        if __filter is not None:
+            _rule_properties["MaxScale"] = int(_text(__filter))
+            _styles = _next_siblings(__filter)
+
+        #Find MinScaleDenominator
+        __filter = _rule.find(".//MinScaleDenominator")
+        if __filter is not None:
+            _rule_properties["MinScale"] = int(_text(__filter))
+            _styles = _next_siblings(__filter)
+
+        #Find Filter
+        __filter = _rule.find(".//Filter")
+        if __filter is not None:
+            _rule_properties["Filter"] = self.re_outer_clamps.findall(_text(__filter))
+            _rule_properties["Filter"] = [_e for _e in _rule_properties["Filter"] if "way_pixels" not in _e]
+            _styles = _next_siblings(__filter)
+
+        #Scan for styles
+        _rule_properties["Styles"] = frozenset(
+            frozenset([_f.tag])
+            | frozenset(self.re_color_hash.findall(etree.tostring(_f, encoding="unicode", with_tail=False)))
+            for _f in _styles)
+        return _rule_properties
 
     def parse_mapnik_styles(self, styles):
         _style_mapper = defaultdict(list)
         _rule_collection = []
         for _style in styles:
-            for _rule in _style.findAll("Rule"):
-                _rule_properties = {
-                    "MaxScale": None,
-                    "MinScale": None,
-                    "Filter": None,
-                    "Styles": None
-                }
-
-                _styles = _rule.findChildren()
-
-                #Find MaxScaleDenominator
-                __filter = _rule.find("MaxScaleDenominator")
-                if __filter is not None:
-                    _rule_properties["MaxScale"] = int(__filter.text)
-                    _styles = __filter.fetchNextSiblings()
-
-                #Find MinScaleDenominator
-                __filter = _rule.find("MinScaleDenominator")
-                if __filter is not None:
-                    _rule_properties["MinScale"] = int(__filter.text)
-                    _styles = __filter.fetchNextSiblings()
-
-                #Find Filter
-                __filter = _rule.find("Filter")
-                if __filter is not None:
-                    _rule_properties["Filter"] = self.re_outer_clamps.findall(
-                        __filter.text)
-                    _rule_properties["Filter"] = [
-                        _e for _e in _rule_properties["Filter"]
-                        if "way_pixels" not in _e
-                    ]
-                    _styles = __filter.fetchNextSiblings()
-
-                #Scan for styles
-                _rule_properties["Styles"] = frozenset(
-                    frozenset([_f.name])
-                    | frozenset(self.re_color_hash.findall(str(_f)))
-                    for _f in _styles)
-
-                #Eliminate doublets
-                _rule_collection.append(_rule_properties)
+            if isinstance(_style, etree._Element):
+                _rule_collection += [self._rule_properties_etree(_rule) for _rule in _style.iter("Rule")]
+            else:
+                _rule_collection += [self._rule_properties_bs4(_rule) for _rule in _style.findAll("Rule")]
 
         #Sort and filter on unique
         _rule_collection = sorted(
@@ -147,21 +137,6 @@ class MapnikSqlParser(object):
 
         return _style_mapper
 
-    def sqlfluff_back_to_string(self, ast) -> str:
-        actual_ast = ast['file']
-
-        def bla(x):
-            if isinstance(x, str):
-                yield x
-            elif isinstance(x, list):
-                for l in x:
-                    yield from bla(l)
-            elif isinstance(x, dict):
-                for k, v in x.items():
-                    yield from bla(v)
-
-        return "".join(bla(actual_ast))
-
     def remove_comments(self, sql):
         # Remove single-line comments
         sql = re.sub(r'--.*?\n', '\n', sql)
@@ -173,353 +148,166 @@ class MapnikSqlParser(object):
         r = re.search(r'\((.*)\)', expr, re.DOTALL)
         return r.group(1) if r else expr
 
-    def get_ast_select_parents(self, sql_ast, filter: str):
-        all_select = parse(rf'$..select_statement[?(@..{filter})]').find(
-            sql_ast)
-        outer_select = parse(
-            rf'$..select_statement[?(@..select_statement..{filter})]').find(
-                sql_ast)
-        inner_select = [
-            a for a in all_select
-            if a.id_pseudopath not in (o.id_pseudopath for o in outer_select)
-        ]
-        return inner_select, outer_select
-
-    def remove_ast_section(self, sql_ast, filter_query, seperators=''):
-        # Filter elements
-        if isinstance(filter_query, str):
-            filter_elements = parse(filter_query).find(sql_ast)
-        else:
-            filter_elements = filter_query
-
-        # Filter groups
-        contexts = {}
-        filter_groups = defaultdict(list)
-        for filter_element in filter_elements:
-            contexts[str(
-                filter_element.context.id_pseudopath)] = filter_element.context
-            filter_groups[str(
-                filter_element.context.id_pseudopath)].append(filter_element)
-
-        for k, _ in filter_groups.items():
-            filter_groups[k] += parse(seperators).find(contexts[k].value)
-            filter_groups[k] = sorted(filter_groups[k],
-                                      key=lambda x: x.path.index)
-
-        remove = defaultdict(list)
-        for k, _filter_elements in filter_groups.items():
-            _context = contexts[k].value
-            _prev_idx = 0
-            for j, _filter_element in enumerate(_filter_elements):
-                _idx = _context.index(_filter_element.value)
-                _idx_next = (_context.index(_filter_elements[j + 1].value) if
-                             (j +
-                              1 < len(_filter_elements)) else len(_context))
-
-                if _idx == _idx_next:
-                    remove[k] += range(_prev_idx, len(_context))
-                else:
-                    _next_is_seperator = ((j + 1 < len(_filter_elements))
-                                          and (_filter_elements[j + 1]
-                                               not in filter_elements))
-                    if _next_is_seperator:
-                        remove[k] += range(_prev_idx, _idx_next + 1)
-                    else:
-                        remove[k] += range(_prev_idx, _idx_next)
-                    _prev_idx = _idx_next
-
-        for ctx, lst in remove.items():
-            identifiers = []
-
-            # Get identifiers that will be deleted and then delete them
-            for idx in sorted(set(lst), reverse=True):
-                identifiers += [
-                    x.value for x in parse(
-                        r'$.select_clause_element.*.naked_identifier').find(
-                            contexts[ctx].value[idx])
-                ]
-                del contexts[ctx].value[idx]
-            if len(contexts[ctx].value) == 0:
-                for k in list(contexts[ctx].context.value.keys()):
-                    del contexts[ctx].context.value[k]
-        return sql_ast
-
-    def replace_ast_section(self, sql_ast, filter_query, replacements: dict):
-        # Filter elements
-        if isinstance(filter_query, str):
-            matches = parse(filter_query).find(sql_ast)
-        else:
-            matches = filter_query
-
-        for m in matches:
-            _path = str(m.path) if not isinstance(
-                m.path, jsonpath.Index) else m.path.index
-            m.context.value[_path] = replacements.get(str(m.value), m.value)
-
-        return sql_ast
-
-    def add_ast_select_section(self, sql_ast, filter_query, add_query,
-                               elements):
-        if isinstance(filter_query, str):
-            filter_elements = parse(filter_query).find(sql_ast)
-        else:
-            filter_elements = filter_query
-        for fe in filter_elements:
-            for match in parse(add_query).find(fe.context.value):
-                identifiers = [
-                    x.value for x in parse(
-                        r'$.select_clause_element.*.naked_identifier').find(
-                            match.value)
-                ]
-                is_wildcard = (len(
-                    parse(r'$.[*].select_clause_element.wildcard_expression').
-                    find(match.value)) > 0)
-                # If just a single select was given, extend to multi select
-                if isinstance(match.value, dict):
-                    for k, v in match.context.value.items():
-                        if v == match.value:
-                            match.context.value[k] = [{
-                                _k: _v
-                            } for _k, _v in match.value.items()]
-                            match.value = match.context.value[k]
-                            break
-                for element in elements:
-                    if isinstance(match.value, list):
-                        if not is_wildcard and parse(
-                                '$.select_clause_element.*.naked_identifier'
-                        ).find(element)[0].value not in identifiers:
-                            match.value += [{
-                                'comma': ','
-                            }, {
-                                'whitespace': ' '
-                            }, element]
-        return sql_ast
+    @staticmethod
+    def _select_clause(node):
+        '''
+        Returns the closest select of a node and the clause of the select the node is part of (e.g. where,
+        expressions for the select list).
+        '''
+        from sqlglot import exp
+        while node.parent is not None and not isinstance(node.parent, exp.Select):
+            node = node.parent
+        return node.parent, node.arg_key
+
+    @staticmethod
+    def _add_select_columns(select, columns):
+        if select.is_star:
+            return
+        _names = set(select.named_selects)
+        for column in columns:
+            if column.alias_or_name not in _names:
+                select.append("expressions", column)
 
     def parse_mapnik_sql(self, sql, label=None):
         """ 
         This parser parses the mapnik sql statements and changes them to be usable directly as materialized view inside the database, e.g., for deriving landuse
          """
+        from sqlglot import parse_one, exp
         _sql = f"{self.remove_outer_curly_bracket(sql)}"
         _sql = self.remove_comments(_sql)
-        _sql_ast = sqlfluff.parse(re.sub(r'!(.*?)!', r'__\1__', _sql),
-                                  dialect="postgres")
-        #Replace scale denominator against smallest to achieve highest resolution/include all elements
-        _sql_ast = self.replace_ast_section(
-            _sql_ast,
-            r'$..select_clause..@[?(@.naked_identifier =~ ".*__[\\S]+__.*")].naked_identifier',
-            replacements={'__scale_denominator__': "1"})
-        #Remove "where" placeholder entries to not filter over a certain region or depending on the zoom factor, but to include all results
-        _sql_ast = self.remove_ast_section(
-            _sql_ast,
-            r'$..where_clause.expression[?(@..naked_identifier =~ ".*__[\\S]+__.*")]',
-            seperators=r'$.@[?(@.binary_operator =~ "AND|OR")]')
+        _sql_ast = parse_one(self.re_placeholder.sub(r'__\1__', _sql), read=self.dialect)
+
+        #Collect all changes in a single pass, the tree is modified afterwards
+        _wheres, _replace, _features = {}, [], []
+        _inner, _outer = defaultdict(dict), defaultdict(dict)
+        for node in _sql_ast.walk(bfs=False):
+            if isinstance(node, exp.Column) and self.re_placeholder_identifier.search(node.name):
+                _select, _clause = self._select_clause(node)
+                if _clause == "where":
+                    _wheres[id(_select)] = _select
+                elif _clause == "expressions" and node.name in self.select_replacements:
+                    _replace.append(node)
+            elif isinstance(node, exp.Table) and node.name in self.osm_tables:
+                #The closest select reads the table, all selects around it pass its rows through
+                _type = self.osm_tables[node.name]
+                _selects = []
+                _parent = node.parent
+                while _parent is not None:
+                    if isinstance(_parent, exp.Select):
+                        _selects.append(_parent)
+                    _parent = _parent.parent
+                if _selects:
+                    _inner[_type][id(_selects[0])] = _selects[0]
+                    _outer[_type].update((id(_s), _s) for _s in _selects[1:])
+            elif isinstance(node, exp.Alias) and node.alias == "feature" and isinstance(node.this, exp.Coalesce):
+                _features.append(node.this)
 
+        #Remove "where" placeholder entries to not filter over a certain region or depending on the zoom factor, but to include all results
+        for _select in _wheres.values():
+            _select.set("where", None)
+        #Replace scale denominator against smallest to achieve highest resolution/include all elements
+        for node in _replace:
+            node.replace(exp.Literal.number(self.select_replacements[node.name]))
         #Add osm_id and osm_type to the query to differentiate between the different sources and to make sure that this information is existing fo further processing
-        for _type in ('point', 'polygon'):
-            inner_select, outer_select = self.get_ast_select_parents(
-                _sql_ast,
-                f'table_reference.naked_identifier = "planet_osm_{_type}"')
-            _sql_ast = self.add_ast_select_section(
-                _sql_ast, outer_select, r'$[*].select_clause', [{
-                    'select_clause_element': {
-                        'column_reference': {
-                            'naked_identifier': 'osm_id'
-                        }
-                    }
-                }, {
-                    'select_clause_element': {
-                        'column_reference': {
-                            'naked_identifier': 'osm_type'
-                        }
-                    }
-                }])
-            _sql_ast = self.add_ast_select_section(
-                _sql_ast, inner_select, r'$[*].select_clause', [{
-                    'select_clause_element': {
-                        'column_reference': {
-                            'naked_identifier': 'osm_id'
-                        }
-                    }
-                }, {
-                    'select_clause_element': {
-                        'column_reference': {
-                            'quoted_literal': f"'{_type}'"
-                        },
-                        'whitespace': ' ',
-                        'alias_expression': {
-                            'keyword': 'AS',
-                            'whitespace': ' ',
-                            'naked_identifier': 'osm_type'
-                        }
-                    }
-                }])
+        for _type in self.osm_tables.values():
+            for _select in _outer[_type].values():
+                self._add_select_columns(_select, [exp.column("osm_id"), exp.column("osm_type")])
+            for _id, _select in _inner[_type].items():
+                if _id not in _outer[_type]:
+                    self._add_select_columns(
+                        _select, [exp.column("osm_id"), exp.alias_(exp.Literal.string(_type), "osm_type")])
         #Inset building feature to consider living areas for amenity-filtering, which completes the landuse filtering approach.
-        if label == "amenity-points":
-            feature_end = parse(
-                r'$..select_clause[?(@..alias_expression.naked_identifier = "feature")].select_clause_element[?(@..function_name_identifier = "COALESCE")].bracketed[?(@.end_bracket = ")")]'
-            ).find(_sql_ast)
-            if len(feature_end) > 0:
-                additional_content = [{
-                    'comma': ','
-                }, {
-                    'whitespace': ' '
-                }, {
-                    'newline': '\n'
-                }, {
-                    'expression': [{
-                        'cast_expression': {
-                            'quoted_literal': "'building_'",
-                            'casting_operator': '::',
-                            'data_type': {
-                                'keyword': 'text'
-                            }
-                        }
-                    }, {
-                        'whitespace': ' '
-                    }, {
-                        'binary_operator': [{
-                            'pipe': '|'
-                        }, {
-                            'pipe': '|'
-                        }]
-                    }, {
-                        'newline': '\n'
-                    }, {
-                        'whitespace': ' '
-                    }, {
-                        'case_expression': [{
-                            'keyword': 'CASE'
-                        }, {
-                            'newline': '\n'
-                        }, {
-                            'whitespace': ' '
-                        }, {
-                            'when_clause': [{
-                                'keyword': 'WHEN'
-                            }, {
-                                'whitespace': ' '
-                            }, {
-                                'expression': [{
-                                    'column_reference': [{
-                                        'naked_identifier':
-                                        '_'
-                                    }, {
-                                        'dot': '.'
-                                    }, {
-                                        'naked_identifier':
-                                        'building'
-                                    }]
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'keyword': 'IS'
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'keyword': 'NOT'
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'null_literal': 'NULL'
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'binary_operator': 'AND'
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'column_reference': [{
-                                        'naked_identifier':
-                                        '_'
-                                    }, {
-                                        'dot': '.'
-                                    }, {
-                                        'naked_identifier':
-                                        'way_area'
-                                    }]
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'keyword': 'IS'
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'keyword': 'NOT'
-                                }, {
-                                    'whitespace': ' '
-                                }, {
-                                    'null_literal': 'NULL'
-                                }]
-                            }, {
-                                'whitespace': ' '
-                            }, {
-                                'keyword': 'THEN'
-                            }, {
-                                'whitespace': ' '
-                            }, {
-                                'expression': {
-                                    'column_reference': [{
-                                        'naked_identifier':
-                                        '_'
-                                    }, {
-                                        'dot': '.'
-                                    }, {
-                                        'naked_identifier':
-                                        'building'
-                                    }]
-                                }
-                            }]
-                        }, {
-                            'newline': '\n'
-                        }, {
-                            'whitespace': ' '
-                        }, {
-                            'else_clause': {
-                                'keyword': 'ELSE',
-                                'whitespace': ' ',
-                                'expression': {
-                                    'cast_expression': {
-                                        'null_literal': 'NULL',
-                                        'casting_operator': '::',
-                                        'data_type': {
-                                            'keyword': 'text'
-                                        }
-                                    }
-                                }
-                            }
-                        }, {
-                            'newline': '\n'
-                        }, {
-                            'whitespace': ' '
-                        }, {
-                            'keyword': 'END'
-                        }]
-                    }]
-                }, {
-                    'newline': '\n'
-                }, {
-                    'whitespace': ' '
-                }]
-                feature_end = feature_end[0]
-                for i, element in enumerate(additional_content):
-                    feature_end.context.value.insert(
-                        feature_end.path.index + i, element)
-
-        return self.sqlfluff_back_to_string(_sql_ast)
+        if label == "amenity-points" and len(_features) > 0:
+            _features[0].append("expressions", parse_one(self.building_feature, read=self.dialect))
+
+        return _sql_ast.sql(dialect=self.dialect, pretty=True)
 
     def get_description(self, name):
         return self.mapnik_info.get(name, None)
 
-    def load_mapnik(self):
+    @property
+    def cache_file(self):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, os.path.basename(self.mapnik_file) + ".smmcache")
+
+    def cache_key(self):
+        with open(self.mapnik_file, "rb") as f:
+            return f"{hashlib.sha256(f.read()).hexdigest()}-{PARSER_VERSION}"
+
+    @staticmethod
+    def _dump_styles(styles):
+        return [[sorted(sorted(_s) for _s in _styles), _filters] for _styles, _filters in styles.items()]
+
+    @staticmethod
+    def _load_styles(styles):
+        _style_mapper = defaultdict(list)
+        for _styles, _filters in styles:
+            _style_mapper[frozenset(frozenset(_s) for _s in _styles)] = _filters
+        return _style_mapper
+
+    def _read_cache(self, key):
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, encoding="utf-8") as f:
+                compiled = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return compiled if compiled.get("key") == key else None
+
+    def _write_cache(self):
+        if self.cache_file is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with atomic_path(self.cache_file) as tmp_file:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(self._compiled, f)
+        self._dirty = False
+
+    def compiled_sql(self, name, write=True):
+        '''
+        Returns the rewritten sql of a layer, either from the compiled cache or by parsing and storing it. With
+        write=False a newly parsed layer is only marked for the next cache write.
+        '''
+        _layer = self._compiled["layers"][name]
+        if _layer["sql"] is None:
+            _layer["sql"] = self.parse_mapnik_sql(_layer["table"], label=name)
+            self._dirty = True
+        if write and self._dirty:
+            self._write_cache()
+        return _layer["sql"]
+
+    def compile(self, names=None):
         '''
-        Loads the mapnik information and sql statements and parses them.
+        Rewrites the sql of the given (default: all) layers ahead of time, so later runs only read the cache. The
+        cache is written once after all layers.
         '''
+        for name in (names or list(self.mapnik_info.keys())):
+            self.compiled_sql(name, write=False)
+        if self._dirty:
+            self._write_cache()
+        return self
+
+    def _set_info(self, names=None):
+        for _name, _layer in self._compiled["layers"].items():
+            if names is not None and _name not in names:
+                continue
+            self.mapnik_info[_name] = {
+                "sql": lambda _name=_name: self.compiled_sql(_name),
+                "styles": self._load_styles(_layer["styles"])
+            }
+
+    def _iter_mapnik_bs4(self, names=None):
+        from bs4 import BeautifulSoup
         bs = BeautifulSoup(open(self.mapnik_file), 'xml')
 
         layers = bs.findAll('Layer')
         for _layer in layers:
             #Extract sql
             _name = _layer.attrs["name"]
+            if names is not None and _name not in names:
+                continue
             _sql = _layer.findAll('Parameter', {"name": "table"})[0].get_text()
 
             #Extract styles
@@ -529,24 +317,88 @@ class MapnikSqlParser(object):
             while _layer.name == 'Style':
                 _styles.append(_layer)
                 _layer = _layer.findPreviousSibling()
-            #Todo, getter & setter
-            self.mapnik_info[_name] = {
-                "sql":
-                lambda _sql=_sql, _name=_name: self.parse_mapnik_sql(
-                    _sql, label=_name),
-                "styles":
-                self.parse_mapnik_styles(_styles)
-            }
+            yield _name, _sql, self.parse_mapnik_styles(_styles)
+
+    def _iter_mapnik_etree(self, names=None):
+        _names = None if names is None else set(names)
+        _styles = []
+        root = None
+        for event, element in etree.iterparse(self.mapnik_file, events=("start", "end")):
+            if root is None:
+                root = element
+            if event != "end" or element.getparent() is not root:
+                continue
+            if element.tag == "Style":
+                _styles.append(element)
+            elif element.tag == "Layer":
+                _name = element.get("name")
+                if _names is None or _name in _names:
+                    _sql = next("".join(_p.itertext()) for _p in element.iter("Parameter") if _p.get("name") == "table")
+                    yield _name, _sql, self.parse_mapnik_styles(reversed(_styles))
+                    if _names is not None:
+                        _names.discard(_name)
+                        if len(_names) == 0:
+                            break
+                #Free the processed part of the tree
+                _styles = []
+                element.clear()
+                while element.getprevious() is not None:
+                    del root[0]
+            else:
+                _styles = []
+
+    def iter_mapnik(self, names=None, engine="lxml"):
+        '''
+        Yields name, sql and parsed styles of the (given) layers. The lxml engine streams the mapnik file in a single
+        pass, the bs4 engine loads the whole document and is kept as reference.
+        '''
+        assert engine in ("lxml", "bs4"), "Unknown engine, use either lxml or bs4."
+        if engine == "lxml":
+            yield from self._iter_mapnik_etree(names=names)
+        else:
+            yield from self._iter_mapnik_bs4(names=names)
+
+    def load_mapnik(self, use_cache=True, names=None, engine="lxml"):
+        '''
+        Loads the mapnik information and sql statements and parses them. With a cache directory set, the parsed
+        styles and rewritten sql are stored in a compiled cache keyed by the mapnik file hash and parser version.
+        If names are given, only these layers are loaded.
+        '''
+        key = self.cache_key()
+        self._compiled = (self._read_cache(key) if use_cache else None) or dict(key=key, complete=False, layers={})
+        _layers = self._compiled["layers"]
+        if names is None and not self._compiled["complete"]:
+            _parsed = {}
+            for _name, _sql, _styles in self.iter_mapnik(engine=engine):
+                _parsed[_name] = _layers.get(_name) or {
+                    "table": _sql,
+                    "styles": self._dump_styles(_styles),
+                    "sql": None
+                }
+            self._compiled.update(complete=True, layers=_parsed)
+            self._write_cache()
+        elif names is not None and any(_name not in _layers for _name in names):
+            for _name, _sql, _styles in self.iter_mapnik([_n for _n in names if _n not in _layers], engine=engine):
+                _layers[_name] = {"table": _sql, "styles": self._dump_styles(_styles), "sql": None}
+            self._write_cache()
+        self._set_info(names)
 
         self.mapnik_loaded = True
         return self.mapnik_info
 
-
 if __name__ == '__main__':
     import os
     _dir = os.path.dirname(__file__)
 
     _mn = MapnikSqlParser(os.path.join(_dir, "config", "mapnik.xml"))
+    #Streaming ingestion has to match the reference implementation on the bundled file
+    assert list(_mn.iter_mapnik(engine="lxml")) == list(_mn.iter_mapnik(engine="bs4"))
+    #Rewritten sql of all layers has to match the golden outputs
+    from ...common.config import TEST_ROOT
+    with open(os.path.join(TEST_ROOT, "mapnik_sql_golden.json"), encoding="utf-8") as f:
+        _golden = json.load(f)
+    for _name, _sql, _ in _mn.iter_mapnik():
+        assert _mn.parse_mapnik_sql(_sql, label=_name) == _golden[_name], _name
     _mn.load_mapnik()
     _sql = _mn.get_description("amenity-points")
     _sql = _sql["sql"]()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+__author__ = "David Ziegler"
+__copyright__ = "Copyright 2021, David Ziegler"
+__credits__ = ["David Ziegler"]
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+__maintainer__ = "David Ziegler"
+__email__ = "david.ziegler@tum.de"
+__status__ = "Production"
+
+import os, json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from typing import Dict, Optional
+from ...common.storage import atomic_path
+
+HOURS = 24
+# Day type (weekday, saturday, sunday) of the days of a week starting on monday
+DAY_TYPES = np.array([0, 0, 0, 0, 0, 1, 2])
+WEEK_HOURS = len(DAY_TYPES) * HOURS
+# Capacity columns, see DemandProfileEngine.capacities
+CAPACITY_COLUMNS = [
+    "employees", "visitors", "employee_saturday_factor", "employee_sunday_factor", "visitor_saturday_factor",
+    "visitor_sunday_factor", "SLP"
+]
+
+
+class DemandProfileEngine(object):
+    '''
+    Expands the daily employee and visitor capacities of buildings into weekly profiles of WEEK_HOURS float32 values
+    (monday 0:00 to sunday 23:00). Saturdays and sundays are scaled by the factors of planet_osm_poi_meta, the hours
+    of a day follow the daily shape of the SLP class of the building. shapes maps SLP classes to (3, 24) arrays for
+    weekday, saturday and sunday (e.g. from the BDEW standard load profiles), which are normalized per day. Classes
+    without shape are spread evenly over the day. Buildings are processed in chunks of chunksize rows, so that only
+    chunksize x WEEK_HOURS values are held in memory at once.
+    '''
+
+    def __init__(self, shapes: Optional[Dict[str, np.ndarray]] = None, chunksize: int = 100000) -> None:
+        self.chunksize = chunksize
+        self.classes = sorted(shapes or {})
+        #Last row is the flat shape of unknown classes
+        table = [np.asarray(shapes[c], dtype=float).reshape(len(np.unique(DAY_TYPES)), HOURS) for c in self.classes]
+        table = np.array(table + [np.ones((len(np.unique(DAY_TYPES)), HOURS))])
+        self.shapes = (table / table.sum(axis=2, keepdims=True)).astype(np.float32)
+
+    @staticmethod
+    def capacities(landuse: pd.DataFrame, meta: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Capacities (CAPACITY_COLUMNS) of the rows of a landuse extraction (query_landuse or LandUseEngine), where
+        osm_feature is resolved to the first matching row of planet_osm_poi_meta like in the extraction. Employees
+        and visitors are the area times the per sqm values, so that they sum up to visitor_capacity. Missing factors
+        don't scale the day.
+        '''
+        meta = meta.reset_index(drop=True)
+        by_key = meta.loc[meta["OSM_tag"].replace("", np.nan).isna(), "OSM_key"]
+        by_category = meta["full_category"]
+        lookup = pd.concat([pd.Series(by_key.index, index=by_key.to_numpy()),
+                            pd.Series(by_category.index, index=by_category.to_numpy())])
+        lookup = lookup[lookup.index.notna()].groupby(level=0).min()
+        rows = landuse["osm_feature"].astype(object).map(lookup).to_numpy()
+        found = ~pd.isna(rows)
+        m = meta.reindex(np.where(found, rows, -1)).reset_index(drop=True)
+        area = landuse["area"].to_numpy(dtype=float)
+        _factor = lambda c: m[c].fillna(1.).to_numpy(dtype=np.float32)
+        return pd.DataFrame(
+            dict(employees=(area * m["Employees_per_sqm"].fillna(0).to_numpy(dtype=float)).astype(np.float32),
+                 visitors=(area * m["Visitor_per_sqm_per_day"].fillna(0).to_numpy(dtype=float)).astype(np.float32),
+                 employee_saturday_factor=_factor("Employee_saturday_factor"),
+                 employee_sunday_factor=_factor("Employee_sunday_factor"),
+                 visitor_saturday_factor=_factor("Visitor_saturday_factor"),
+                 visitor_sunday_factor=_factor("Visitor_sunday_factor"),
+                 SLP=m["SLP"].to_numpy()),
+            index=landuse.index)
+
+    def _daily(self, capacities: pd.DataFrame):
+        '''Daily totals per day type (rows, 3) and the shape of each row.'''
+        _col = lambda c: capacities[c].to_numpy(dtype=np.float32)
+        ones = np.ones(len(capacities), dtype=np.float32)
+        employees = _col("employees")[:, None] * np.c_[ones, _col("employee_saturday_factor"),
+                                                       _col("employee_sunday_factor")]
+        visitors = _col("visitors")[:, None] * np.c_[ones, _col("visitor_saturday_factor"),
+                                                     _col("visitor_sunday_factor")]
+        slp = pd.Categorical(capacities["SLP"].astype(object), categories=self.classes)
+        codes = np.where(slp.codes < 0, len(self.classes), slp.codes)
+        return employees + visitors, codes
+
+    def expand(self, capacities: pd.DataFrame) -> np.ndarray:
+        '''Weekly profiles (rows, WEEK_HOURS) of a chunk of capacities.'''
+        daily, codes = self._daily(capacities)
+        profiles = daily[:, DAY_TYPES, None] * self.shapes[codes][:, DAY_TYPES, :]
+        return profiles.reshape(len(capacities), WEEK_HOURS)
+
+    def profiles(self, capacities: pd.DataFrame, path: Optional[str] = None) -> np.ndarray:
+        '''
+        Weekly profiles of all rows, with a path written chunk by chunk into a .npy file and returned memory-mapped.
+        '''
+        if path is None:
+            out = np.empty((len(capacities), WEEK_HOURS), dtype=np.float32)
+            for start in range(0, len(capacities), self.chunksize):
+                out[start:start + self.chunksize] = self.expand(capacities.iloc[start:start + self.chunksize])
+            return out
+        with atomic_path(path) as tmp_file:
+            out = np.lib.format.open_memmap(tmp_file, mode="w+", dtype=np.float32, shape=(len(capacities), WEEK_HOURS))
+            for start in range(0, len(capacities), self.chunksize):
+                out[start:start + self.chunksize] = self.expand(capacities.iloc[start:start + self.chunksize])
+            out.flush()
+            del out
+        return np.load(path, mmap_mode="r")
+
+    def aggregate(self, capacities: pd.DataFrame, geometry, resolution: int = 8, mask: str = "h3", path=None):
+        '''
+        Weekly profiles summed per H3/S2 cell of the building centroids, returns the sorted cell ids and the profiles
+        (cells, WEEK_HOURS). The profiles are linear in the daily totals, so these are summed per cell and SLP class
+        first and building profiles are never built. With a path, cells.npy, profiles.npy and index.json are written
+        into the directory.
+        '''
+        from ...framework.cells import latlng_to_cells
+        # Centroids in the source crs, only the points are reprojected
+        centroids = gpd.GeoSeries(shapely.centroid(np.asarray(geometry.values)), crs=geometry.crs)
+        centroids = centroids.to_crs(4326).values if geometry.crs is not None else centroids.values
+        cells = latlng_to_cells(shapely.get_y(centroids), shapely.get_x(centroids), mask, resolution)
+        cells, inverse = np.unique(cells, return_inverse=True)
+        totals = np.zeros((len(cells), len(self.shapes), len(np.unique(DAY_TYPES))))
+        for start in range(0, len(capacities), self.chunksize):
+            daily, codes = self._daily(capacities.iloc[start:start + self.chunksize])
+            np.add.at(totals, (inverse[start:start + self.chunksize], codes), daily)
+        profiles = np.einsum("ckd,kdh->cdh", totals[:, :, DAY_TYPES], self.shapes[:, DAY_TYPES, :])
+        profiles = profiles.reshape(len(cells), WEEK_HOURS).astype(np.float32)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            for name, array in (("cells.npy", cells), ("profiles.npy", profiles)):
+                with atomic_path(os.path.join(path, name)) as tmp_file:
+                    np.save(tmp_file, array)
+            with atomic_path(os.path.join(path, "index.json")) as tmp_file:
+                with open(tmp_file, "w", encoding="utf-8") as f:
+                    json.dump(dict(mask=mask, resolution=resolution, hours=WEEK_HOURS), f)
+        return cells, profiles
@@ -9,20 +9,31 @@ __maintainer__ = "David Ziegler"
 __email__ = "david.ziegler@tum.de"
 __status__ = "Production"
 
-import os
+import os, re
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-import sqlalchemy
-import json
+import shapely
+from concurrent.futures import ThreadPoolExecutor
+from shapely.geometry.base import BaseGeometry
 from ...common.config import FRAMEWORK_ROOT
 from .parser import MapnikSqlParser
-from ...common.sql import DBBase, SQLTemplateManager
+from .mappings import MappingEngine, category_vocabulary
+from .landuse import boundary_tiles
+from ...common.sql import DBBase, SQLBundle, SQLStepRunner, SQLTemplateManager, render_sql
 from ...common.config import ConfigManager
+from ...framework.persistent import BaseDataLayer, BaseLayerTypes
 
 CURRENT_ROOT = os.path.dirname(__file__)
 
 
 class OSM_POI_SETUP:
+    re_leading_set = re.compile(r"^\s*(SET search_path[^;]*;)\s*(.*)$", re.DOTALL)
+    re_view_select = re.compile(r"CREATE MATERIALIZED VIEW IF NOT EXISTS \S+\s+AS\s+(.*?)\s*WITH DATA;", re.DOTALL)
+    # Framework views in dependency order
+    framework_views = ["planet_osm_mappings", "planet_osm_buildings", "planet_osm_landuse", "planet_osm_poi_polygons"]
+    # Mapping of the full_categories of the landuse extraction
+    landuse_category = "landuse_munich_mappings"
 
     def __init__(self, config_path, external_sql_dir=None) -> None:
         self.config = ConfigManager(config_path).load().config
@@ -30,62 +41,166 @@ class OSM_POI_SETUP:
             self.db = DBBase().setupDB(**self.config.psql_auth,
                                        extensions=["postgis", "pg_trgm", "btree_gin", "btree_gist", "parray_gin"])
         self.sql_template_manager = SQLTemplateManager(os.path.join(CURRENT_ROOT, "sql"))
-        self.mapnik_parser = MapnikSqlParser(os.path.abspath(os.path.join(CURRENT_ROOT, "config", "mapnik.xml")))
+        self.mapnik_parser = MapnikSqlParser(os.path.abspath(os.path.join(CURRENT_ROOT, "config", "mapnik.xml")),
+                                             cache_dir=os.path.dirname(os.path.abspath(config_path)))
         self.mapnik_parser.load_mapnik()
         self.config = self.config.osm_mid_mappings
         self.external_sql_dir = external_sql_dir
-        self.iterator = 0
+        self.bundle = SQLBundle(external_sql_dir) if external_sql_dir is not None else None
+        self._vocabularies = {}
 
-    def execute_sql(self, sql, placeholders={}):
+    def execute_sql(self, sql, placeholders={}, name=None, depends=None, write=True):
+        '''
+        Executes the sql or, with an external_sql_dir, adds it as step to the offline bundle (see SQLBundle). With
+        write=False the bundle is not written yet, so that several steps can be added before writing it once.
+        '''
         if self.external_sql_dir is None:
             self.db.executeSQL(sql, placeholders=placeholders)
         else:
-            for key, value in placeholders.items():
-                sql = sql.replace(f"${key}", value)
-            with open(os.path.join(self.external_sql_dir, str(self.iterator) + "_setup.psql"), "w") as f:
-                f.write(sql)
-            self.iterator += 1
+            self.bundle.add(name, sql, depends=depends, placeholders=placeholders)
+            if write:
+                self.bundle.write()
 
-    def setup_osm_framework_base(self, schema="public"):
+    def setup_steps(self, schema="public"):
+        '''
+        Returns the setup steps as (name, sql, dependencies) in a valid execution order.
+        '''
         if self.mapnik_parser.mapnik_loaded is not True:
             raise Exception("Please load mapnik first.")
-        #Fn Helpers
-        _sql = self.sql_template_manager.load("setup/0_fn_helpers")
-        self.execute_sql(_sql, placeholders=dict(schema=schema))
 
-        #Load POI Polygons
-        _sql = self.sql_template_manager.load("setup/0_pre_setup_indexes")
-        self.execute_sql(_sql, placeholders=dict(schema=schema))
-
-        #Create POI extraction view based on Mapnik Configuration
-        _pois = self.mapnik_parser.get_description("amenity-points")
-        _sql = _pois["sql"]()
         _sql = f"""
         SET search_path TO $schema;
         CREATE MATERIALIZED VIEW IF NOT EXISTS $schema.planet_osm_mappings AS (
-            {_sql}
+            {self._mappings_sql()}
         );
         CREATE INDEX IF NOT EXISTS planet_osm_mappings_osm_type_osm_id_idx ON $schema.planet_osm_mappings (osm_type,osm_id);
         CLUSTER $schema.planet_osm_mappings USING planet_osm_mappings_osm_type_osm_id_idx;
         """
+        steps = [
+            ("fn_helpers", self.sql_template_manager.load("setup/0_fn_helpers"), []),
+            ("indexes_polygon", self.sql_template_manager.load("setup/0_pre_setup_indexes_polygon"), []),
+            ("indexes_point", self.sql_template_manager.load("setup/0_pre_setup_indexes_point"), []),
+            ("planet_osm_mappings", _sql, ["fn_helpers", "indexes_polygon", "indexes_point"]),
+            ("planet_osm_buildings", self.sql_template_manager.load("setup/1_view_osm_buildings"),
+             ["fn_helpers", "indexes_polygon"]),
+            ("planet_osm_landuse", self.sql_template_manager.load("setup/1_view_osm_landuse"),
+             ["planet_osm_mappings"]),
+            ("planet_osm_poi_polygons",
+             self.sql_template_manager.load("setup/2_view_osm_poi_polygons",
+                                            replacements=dict(pow_filter="", pop_filter="")),
+             ["planet_osm_mappings", "planet_osm_buildings"]),
+        ]
+        return [(name, render_sql(sql, dict(schema=schema), identifiers=True), depends) for name, sql, depends in steps]
+
+    def _mappings_sql(self):
+        #POI extraction based on Mapnik Configuration
+        if self.mapnik_parser.mapnik_loaded is not True:
+            raise Exception("Please load mapnik first.")
+        _pois = self.mapnik_parser.get_description("amenity-points")
+        return _pois["sql"]()
 
-        self.execute_sql(_sql, placeholders=dict(schema=schema))
+    def _view_select(self, template, schema, replacements=None):
+        # Select statement of a materialized view template of sql/setup
+        _sql = self.sql_template_manager.load(template, replacements=dict(replacements or {}, schema=schema))
+        return self.re_view_select.search(_sql).group(1)
 
-        #Load Buildings
-        _sql = self.sql_template_manager.load("setup/1_view_osm_buildings")
-        self.execute_sql(_sql, placeholders=dict(schema=schema))
+    def setup_osm_framework_base(self, schema="public", max_workers=None, force=False):
+        '''
+        Runs the setup steps as a dependency graph, independent steps concurrently. Finished steps are recorded in
+        $schema.smm_setup_state and skipped on a rerun, force=True runs all steps again. Returns the executed steps.
+        '''
+        steps = self.setup_steps(schema=schema)
+        if self.external_sql_dir is not None:
+            for name, sql, depends in steps:
+                self.execute_sql(sql, name=name, depends=depends, write=False)
+            self.bundle.write()
+            return [name for name, _, _ in steps]
+        runner = SQLStepRunner(self.db, schema=schema)
+        for name, sql, depends in steps:
+            runner.add(name, sql, depends=depends)
+        return runner.run(max_workers=max_workers, force=force)
 
-        #Load POI Polygons
-        _sql = self.sql_template_manager.load("setup/1_view_osm_landuse")
-        self.execute_sql(_sql, placeholders=dict(schema=schema))
+    def setup_incremental(self, schema="public"):
+        '''
+        Prepares incremental refreshes: logs the ids and geometries of points and polygons touched by osm2pgsql
+        append runs into $schema.planet_osm_changes (by triggers) and turns the framework views into tables with the
+        same content and indexes. Has to be run once after setup_osm_framework_base and before the first append run.
+        '''
+        self.execute_sql(self.sql_template_manager.load("refresh/0_change_log"),
+                         placeholders=dict(schema=schema),
+                         name="change_log",
+                         write=False)
+        self.execute_sql(self.sql_template_manager.load("refresh/1_views_to_tables"),
+                         placeholders=dict(schema=schema),
+                         name="views_to_tables")
 
-        #Load POI Polygons
-        _sql = self.sql_template_manager.load("setup/2_view_osm_poi_polygons")
-        self.execute_sql(_sql, placeholders=dict(schema=schema))
+    def _is_incremental(self, schema):
 
-    def update_framework_mappings(self, schema="public"):
+        def _query(conn):
+            with conn.cursor() as curs:
+                curs.execute("SELECT count(*) FROM pg_matviews WHERE schemaname = %s AND matviewname = ANY(%s)",
+                             (schema, self.framework_views))
+                return curs.fetchone()[0] == 0
+
+        return self.db.withConnection(_query)
+
+    def refresh_osm_framework(self, schema="public", full=False):
+        '''
+        Brings the framework views up to date after osm2pgsql append runs. After setup_incremental only the rows of
+        the logged changes are recomputed in one transaction. Otherwise (or with full=True) everything is recomputed,
+        materialized views with a unique index are refreshed CONCURRENTLY, so that they stay readable.
+        '''
+        if self.external_sql_dir is None and not self._is_incremental(schema):
+            _sql = ["SET search_path TO $schema;"]
+            for view in self.framework_views:
+                _sql.append(f"""
+                DO $do$
+                BEGIN
+                    IF EXISTS (SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indrelid JOIN pg_namespace n
+                               ON n.oid = c.relnamespace WHERE n.nspname = '$schema' AND c.relname = '{view}'
+                               AND i.indisunique) THEN
+                        REFRESH MATERIALIZED VIEW CONCURRENTLY $schema.{view};
+                    ELSE
+                        REFRESH MATERIALIZED VIEW $schema.{view};
+                    END IF;
+                END
+                $do$;""")
+            self.execute_sql("\n".join(_sql), placeholders=dict(schema=schema), name="refresh_views")
+            return self
+
+        selects = dict(planet_osm_mappings=self._mappings_sql(),
+                       planet_osm_buildings=self._view_select("setup/1_view_osm_buildings", schema),
+                       planet_osm_landuse=self._view_select("setup/1_view_osm_landuse", schema))
+        if full:
+            selects["planet_osm_poi_polygons"] = self._view_select("setup/2_view_osm_poi_polygons",
+                                                                   schema,
+                                                                   replacements=dict(pow_filter="", pop_filter=""))
+            _sql = ["SET search_path TO $schema, public;", "TRUNCATE " + ", ".join(self.framework_views) + ";"]
+            _sql += [f"INSERT INTO {view} {selects[view]};" for view in self.framework_views]
+            _sql.append("TRUNCATE planet_osm_changes;")
+            self.execute_sql("\n".join(_sql), placeholders=dict(schema=schema), name="refresh_full")
+            return self
+
+        selects["planet_osm_poi_polygons"] = self._view_select(
+            "setup/2_view_osm_poi_polygons",
+            schema,
+            replacements=dict(pow_filter="AND pow.osm_id IN (SELECT osm_id FROM _affected_neighbours)",
+                              pop_filter="AND pop.osm_id IN (SELECT osm_id FROM _affected)"))
+        _sql = self.sql_template_manager.load("refresh/2_incremental",
+                                              replacements=dict(mappings=selects["planet_osm_mappings"],
+                                                                buildings=selects["planet_osm_buildings"],
+                                                                landuse=selects["planet_osm_landuse"],
+                                                                poi_polygons=selects["planet_osm_poi_polygons"],
+                                                                schema=schema))
+        self.execute_sql(_sql, name="refresh_incremental")
+        return self
+
+    def framework_mappings(self):
+        '''
+        Returns the content of planet_osm_poi_meta: the MiD/SLP mappings with the additional mappings and derived
+        columns.
+        '''
         #Load MID Mappings
-        _target_table = "planet_osm_poi_meta"
         _df = pd.read_excel(self.config.file, sheet_name=self.config.sheet, header=0)
         _df_columns = [
             "OSM_key", "OSM_tag", "MiD", "MiD_description", "SLP", "Relevant_for_charging", "Maximum_area",
@@ -94,53 +209,179 @@ class OSM_POI_SETUP:
         ]
 
         #Load additional mappings
-        def mapping_conversion(x, mappings={}):
-            _map = mappings.get(x.OSM_key, None)
-            if isinstance(_map, dict):
-                if x.OSM_tag == "" or pd.isnull(x.OSM_tag):
-                    return _map.get("!*", None)
-                return _map.get(x.OSM_tag, _map.get("*", None))
-            elif x.OSM_tag == "" or pd.isnull(x.OSM_tag):
-                return _map
-            else:
-                return None
-
-        for _map in self.config.additional_mappings:
-            with open(_map) as f:
-                for _name, _map in json.load(f).items():
-                    _df[_name] = _df.apply(lambda x: mapping_conversion(x, mappings=_map), axis=1)
-                    _df_columns.append(_name)
+        _mappings = MappingEngine.from_files(self.config.additional_mappings)
+        _df[_mappings.names] = _mappings.apply(_df)
+        _df_columns += _mappings.names
 
-        _sql = self.sql_template_manager.load("functions/truncate_table")
-        self.execute_sql(_sql, placeholders=dict(schema=schema, table=_target_table))
+        #Derived columns, see array_to_string(ARRAY["OSM_key", NULLIF("OSM_tag", '')], '_') for the category
+        _key = _df["OSM_key"].astype("string")
+        _tag = _df["OSM_tag"].astype("string").replace("", pd.NA)
+        _df["full_category"] = _key.str.cat(_tag, sep="_").fillna(_key).fillna(_tag)
+        _df["jsonb"] = '{"' + _key + '":{"' + _tag.fillna("") + '":true}}'
+        _df_columns += ["full_category", "jsonb"]
+        return _df[_df_columns]
 
-        _df[_df_columns].to_sql(_target_table,
-                                sqlalchemy.create_engine(self.db.con_url),
-                                schema=schema,
-                                if_exists="append")
+    def update_framework_mappings(self, schema="public"):
+        _target_table = "planet_osm_poi_meta"
+        self.db.bulkUpload(self.framework_mappings(),
+                           _target_table,
+                           schema=schema,
+                           dtypes=dict(full_category="text", jsonb="jsonb"),
+                           if_exists="replace",
+                           index=True)
         _sql = f"""
             SET search_path TO $schema;
-            ALTER TABLE $table ADD COLUMN IF NOT EXISTS full_category text;
-            UPDATE $table m SET full_category = array_to_string(ARRAY[m."OSM_key" , NULLIF(m."OSM_tag", '')], '_');
             CREATE INDEX IF NOT EXISTS $table_osm_index_idx ON $table USING btree (index);
             CREATE INDEX IF NOT EXISTS $table_full_category_idx ON $table USING btree (full_category);
             CREATE INDEX IF NOT EXISTS $table_osm_key_full_category_idx ON $table USING btree("OSM_key", full_category);
             CREATE INDEX IF NOT EXISTS $table_osm_key_tag_full_category_idx ON $table USING btree ("OSM_key", "OSM_tag", full_category);
-            ALTER TABLE $table ADD COLUMN IF NOT EXISTS "jsonb" jsonb;
-            UPDATE $table SET "jsonb" = ('{{"' || "OSM_key" || '":{{"' || COALESCE("OSM_tag", '') || '":true}}}}')::jsonb
         """
-        self.execute_sql(_sql, placeholders=dict(schema=schema, table=_target_table))
+        self.execute_sql(_sql, placeholders=dict(schema=schema, table=_target_table), name="poi_meta_indexes")
 
-    def query_landuse(self, boundary, schema="public"):
-        boundary = self.sql_template_manager.load("boundary/" + boundary)
+    def _boundary_sql(self, boundary):
+        # Either a template of sql/boundary or a geometry in EPSG:4326
+        if isinstance(boundary, BaseGeometry):
+            ewkb = shapely.to_wkb(shapely.set_srid(boundary, 4326), hex=True, include_srid=True)
+            return f"SELECT '{ewkb}'::geometry shape"
+        return self.sql_template_manager.load("boundary/" + boundary)
+
+    def _landuse_sql(self, boundary, schema="public"):
+        boundary = self._boundary_sql(boundary)
         sql = self.sql_template_manager.load("query/osm_landuse_extract",
                                              replacements={
                                                  "boundary": boundary,
-                                                 "category": "landuse_munich_mappings",
+                                                 "category": self.landuse_category,
                                                  "schema": schema
                                              })
+        return sql
+
+    def category_vocabulary(self, schema="public"):
+        '''
+        Category vocabulary of planet_osm_poi_meta in the database (see mappings.category_vocabulary), which encodes
+        the category columns of the landuse extraction. Cached per schema.
+        '''
+        if schema not in self._vocabularies:
+            meta = pd.concat(self.db.fetchChunks(f'SELECT * FROM "{schema}".planet_osm_poi_meta'), ignore_index=True)
+            self._vocabularies[schema] = category_vocabulary(meta, self.landuse_category)
+        return self._vocabularies[schema]
+
+    def query_landuse_chunks(self, boundary, schema="public", chunksize=100000):
+        '''
+        Yields the landuse extraction in GeoDataFrame chunks, fetched over a server-side cursor. The geometries of a
+        chunk are decoded from WKB at once, the category columns are encoded with the shared vocabulary.
+        '''
+        setup_sql, sql = self.re_leading_set.match(self._landuse_sql(boundary, schema=schema)).groups()
+        vocabulary = self.category_vocabulary(schema)
+        crs = None
+        for df in self.db.fetchChunks(sql, chunksize=chunksize, setup_sql=setup_sql):
+            geoms = shapely.from_wkb(df["geom"].to_numpy())
+            if crs is None:
+                srid = shapely.get_srid(geoms[~shapely.is_missing(geoms)][:1])
+                crs = f"EPSG:{srid[0]}" if len(srid) > 0 and srid[0] > 0 else None
+            df["geom"] = geoms
+            yield gpd.GeoDataFrame(vocabulary.encode(df), geometry="geom", crs=crs)
+
+    def query_landuse(self, boundary, schema="public", chunksize=None, output=None):
+        '''
+        Queries the landuse of a boundary. With an output layer (or file path) the result is streamed in chunks into
+        the file and the layer is returned, .gpq files as GeoParquet row groups, all others into a GeoPackage. With
+        only a chunksize the chunks are concatenated.
+        '''
+        vocabulary = self.category_vocabulary(schema)
+        if output is not None:
+            if isinstance(output, str):
+                #File formats without dictionary columns are encoded again on loading
+                name, _ = os.path.splitext(output)
+                output = BaseDataLayer(os.path.basename(name),
+                                       BaseLayerTypes.places,
+                                       output,
+                                       vocabulary=vocabulary.save(name + ".categories.json").path)
+            return output.write_chunks(self.query_landuse_chunks(boundary, schema=schema, chunksize=chunksize or 100000))
+        if chunksize is not None:
+            chunks = self.query_landuse_chunks(boundary, schema=schema, chunksize=chunksize)
+            return vocabulary.encode(pd.concat(chunks, ignore_index=True))
+        sql = self._landuse_sql(boundary, schema=schema)
         gdf = gpd.GeoDataFrame.from_postgis(sql, con=self.db.conn, geom_col='geom')
-        return gdf
+        return vocabulary.encode(gdf)
+
+    def boundary_tiles(self, boundary, tile_size=1.):
+        return boundary_tiles(boundary, tile_size=tile_size)
+
+    def boundary_shapes(self, boundaries):
+        '''
+        Shapes of boundary templates or geometries (EPSG:4326) in EPSG:3857, in which the extraction selects the
+        buildings by their center. Templates are queried from the database.
+        '''
+        shapes = []
+        for boundary in boundaries:
+            if isinstance(boundary, BaseGeometry):
+                shapes.append(gpd.GeoSeries([boundary], crs=4326))
+            else:
+                shapes.append(
+                    gpd.GeoDataFrame.from_postgis(self._boundary_sql(boundary), con=self.db.conn,
+                                                  geom_col="shape").geometry)
+        return np.array([shapely.union_all(s.to_crs(3857).values) for s in shapes])
+
+    def query_landuse_batch(self,
+                            boundaries,
+                            schema="public",
+                            output=None,
+                            chunksize=100000,
+                            max_workers=None,
+                            tile_size=1.,
+                            extension=".gpkg"):
+        '''
+        Extracts the landuse of several regions concurrently, each over its own pooled connection. boundaries is a
+        list of boundary templates or a boundary GeoDataFrame, which is split into tiles (see boundary_tiles).
+        Buildings extracted by several regions (centers on shared edges) are kept for the first of these regions
+        only, which every region decides from its own chunks, so that the partitions are the same on every run.
+        With an output directory every region is streamed into its own partition <output>/<region><extension> (.gpkg
+        or .gpq) and the layers are returned, otherwise the concatenated GeoDataFrame.
+        '''
+        if isinstance(boundaries, gpd.GeoDataFrame):
+            boundaries = self.boundary_tiles(boundaries, tile_size=tile_size)
+        else:
+            boundaries = {b: b for b in boundaries}
+        names = list(boundaries.keys())
+        if max_workers is None:
+            max_workers = self.db.pool.maxconn if self.db.pool is not None else 1
+        #Shared by all regions, also for loading the partitions with categoricals
+        vocabulary = self.category_vocabulary(schema)
+        if output is not None:
+            os.makedirs(output, exist_ok=True)
+            vocabulary.save(os.path.join(output, "categories.json"))
+
+        #The center of a building is the centroid of its geometry, see planet_osm_poi_polygons
+        tree = shapely.STRtree(self.boundary_shapes(boundaries.values()))
+
+        def _deduplicate(chunks, region):
+            index = names.index(region)
+            for chunk in chunks:
+                centers = gpd.GeoSeries(shapely.centroid(chunk.geometry.values), crs=chunk.crs or 3857).to_crs(3857)
+                #First region containing the center, the own one if the center is off by rounding
+                owner = np.full(len(chunk), index)
+                hits = tree.query(centers.values, predicate="intersects")
+                np.minimum.at(owner, hits[0], hits[1])
+                yield chunk[owner == index]
+
+        def _extract(region):
+            chunks = _deduplicate(
+                self.query_landuse_chunks(boundaries[region], schema=schema, chunksize=chunksize), region)
+            if output is None:
+                chunks = list(chunks)
+                return pd.concat(chunks, ignore_index=True) if chunks else None
+            layer = BaseDataLayer(region,
+                                  BaseLayerTypes.places,
+                                  os.path.join(output, region + extension),
+                                  vocabulary=vocabulary.path)
+            return layer.write_chunks(chunks)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = dict(zip(names, executor.map(_extract, names)))
+        if output is not None:
+            return results
+        results = [r for r in results.values() if r is not None]
+        return vocabulary.encode(pd.concat(results, ignore_index=True)) if results else gpd.GeoDataFrame()
 
 
 if __name__ == '__main__':
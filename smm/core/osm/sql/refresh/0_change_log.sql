@@ -0,0 +1,28 @@
+SET search_path TO $schema;
+-- Ids (and old/new geometries) of the OSM objects touched by an osm2pgsql append run
+CREATE TABLE IF NOT EXISTS $schema.planet_osm_changes (
+    id bigserial PRIMARY KEY,
+    osm_type text NOT NULL,
+    osm_id bigint NOT NULL,
+    way geometry
+);
+
+CREATE
+OR REPLACE FUNCTION planet_osm_log_change () RETURNS TRIGGER LANGUAGE plpgsql AS $func$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO planet_osm_changes (osm_type, osm_id, way) VALUES (TG_ARGV[0], OLD.osm_id, OLD.way);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        INSERT INTO planet_osm_changes (osm_type, osm_id, way) VALUES (TG_ARGV[0], NEW.osm_id, NEW.way);
+    END IF;
+    RETURN NULL;
+END
+$func$;
+
+DROP TRIGGER IF EXISTS planet_osm_point_log_change ON $schema.planet_osm_point;
+CREATE TRIGGER planet_osm_point_log_change AFTER INSERT OR UPDATE OR DELETE ON $schema.planet_osm_point
+    FOR EACH ROW EXECUTE FUNCTION planet_osm_log_change ('point');
+DROP TRIGGER IF EXISTS planet_osm_polygon_log_change ON $schema.planet_osm_polygon;
+CREATE TRIGGER planet_osm_polygon_log_change AFTER INSERT OR UPDATE OR DELETE ON $schema.planet_osm_polygon
+    FOR EACH ROW EXECUTE FUNCTION planet_osm_log_change ('polygon');
@@ -0,0 +1,21 @@
+SET search_path TO $schema;
+-- Replaces the materialized views by tables with the same content and indexes, dependent views first
+DO $do$
+DECLARE
+    _name text;
+    _defs text[];
+    _def text;
+BEGIN
+    FOREACH _name IN ARRAY ARRAY['planet_osm_poi_polygons', 'planet_osm_landuse', 'planet_osm_buildings', 'planet_osm_mappings'] LOOP
+        IF EXISTS (SELECT 1 FROM pg_matviews WHERE schemaname = '$schema' AND matviewname = _name) THEN
+            SELECT array_agg(indexdef) INTO _defs FROM pg_indexes WHERE schemaname = '$schema' AND tablename = _name;
+            EXECUTE format('CREATE TABLE %I.%I AS SELECT * FROM %I.%I', '$schema', _name || '__table', '$schema', _name);
+            EXECUTE format('DROP MATERIALIZED VIEW %I.%I', '$schema', _name);
+            EXECUTE format('ALTER TABLE %I.%I RENAME TO %I', '$schema', _name || '__table', _name);
+            FOREACH _def IN ARRAY COALESCE(_defs, ARRAY[]::text[]) LOOP
+                EXECUTE _def;
+            END LOOP;
+        END IF;
+    END LOOP;
+END
+$do$;
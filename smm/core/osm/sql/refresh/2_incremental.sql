@@ -0,0 +1,35 @@
+SET search_path TO $schema, public;
+-- Consumes the logged changes, rows logged while refreshing are kept for the next run
+CREATE TEMP TABLE _changes ON COMMIT DROP AS SELECT * FROM planet_osm_changes;
+DELETE FROM planet_osm_changes WHERE id IN (SELECT id FROM _changes);
+CREATE TEMP TABLE _changed_polygons ON COMMIT DROP AS SELECT DISTINCT osm_id FROM _changes WHERE osm_type = 'polygon';
+
+-- Polygons, whose POI assignment may change: changed polygons and polygons intersecting an old or new geometry
+CREATE TEMP TABLE _affected ON COMMIT DROP AS
+    SELECT osm_id FROM _changed_polygons
+    UNION
+    SELECT pop.osm_id FROM planet_osm_polygon pop, _changes c
+    WHERE c.way IS NOT NULL AND pop.way && c.way AND ST_INTERSECTS(pop.way, c.way);
+-- Their neighbours are required for the point/way de-duplication of planet_osm_poi_polygons
+CREATE TEMP TABLE _affected_neighbours ON COMMIT DROP AS
+    SELECT osm_id FROM _affected
+    UNION
+    SELECT pop.osm_id FROM planet_osm_polygon pop, planet_osm_polygon a
+    WHERE a.osm_id IN (SELECT osm_id FROM _affected) AND pop.way && a.way AND ST_INTERSECTS(pop.way, a.way);
+ANALYZE _changes, _changed_polygons, _affected, _affected_neighbours;
+
+DELETE FROM planet_osm_mappings m USING _changes c WHERE m.osm_type = c.osm_type AND m.osm_id = c.osm_id;
+INSERT INTO planet_osm_mappings
+    SELECT * FROM ($mappings) _ WHERE (osm_type, osm_id) IN (SELECT osm_type, osm_id FROM _changes);
+
+DELETE FROM planet_osm_buildings WHERE osm_id IN (SELECT osm_id FROM _changed_polygons);
+INSERT INTO planet_osm_buildings
+    SELECT * FROM ($buildings) _ WHERE osm_id IN (SELECT osm_id FROM _changed_polygons);
+
+DELETE FROM planet_osm_landuse WHERE osm_id IN (SELECT osm_id FROM _changed_polygons);
+INSERT INTO planet_osm_landuse
+    SELECT * FROM ($landuse) _ WHERE osm_id IN (SELECT osm_id FROM _changed_polygons);
+
+DELETE FROM planet_osm_poi_polygons WHERE way_id IN (SELECT osm_id FROM _affected);
+INSERT INTO planet_osm_poi_polygons
+    SELECT * FROM ($poi_polygons) _ WHERE way_id IN (SELECT osm_id FROM _affected);
@@ -0,0 +1,3 @@
+SET search_path TO $schema;
+CREATE INDEX IF NOT EXISTS planet_osm_point_osm_id_idx ON $schema.planet_osm_point USING btree (osm_id);
+CREATE INDEX IF NOT EXISTS planet_osm_point_way_osm_id_idx ON $schema.planet_osm_point USING gist (way, osm_id);
\ No newline at end of file
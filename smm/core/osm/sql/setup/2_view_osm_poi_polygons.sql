@@ -3,7 +3,7 @@ CREATE MATERIALIZED VIEW IF NOT EXISTS osm.planet_osm_poi_polygons
 AS WITH pow AS (
           SELECT pow.osm_id, pow.way, pow.way_area
           FROM planet_osm_polygon pow, planet_osm_buildings pob 
-          WHERE pob.osm_id = pow.osm_id
+          WHERE pob.osm_id = pow.osm_id $pow_filter
         ), mp AS (
           SELECT mp.way, mp.feature, mp.shop 
           FROM planet_osm_mappings mp
@@ -27,7 +27,7 @@ AS WITH pow AS (
                         ELSE (mp.feature || '_'::text) || mp.shop
                     END AS feature
               FROM planet_osm_polygon pop
-              JOIN planet_osm_mappings mp ON mp.osm_type = 'polygon'::text AND mp.osm_id = pop.osm_id
+              JOIN planet_osm_mappings mp ON mp.osm_type = 'polygon'::text AND mp.osm_id = pop.osm_id $pop_filter
         )
  SELECT _.osm_id AS way_id,
     min(_.area) AS area,
@@ -70,7 +70,7 @@ AS WITH pow AS (
 WITH DATA;
 
 -- View indexes:
-CREATE INDEX planet_osm_poi_polygons_way_id_idx ON $schema.planet_osm_poi_polygons USING btree (way_id);
+CREATE UNIQUE INDEX planet_osm_poi_polygons_way_id_idx ON $schema.planet_osm_poi_polygons USING btree (way_id);
 CREATE INDEX planet_osm_poi_polygons_center_way_id_idx ON $schema.planet_osm_poi_polygons USING gist (center, way_id);
 CREATE INDEX planet_osm_poi_polygons_features_json_idx ON $schema.planet_osm_poi_polygons USING gin (features_json jsonb_path_ops);
 CREATE INDEX planet_osm_poi_polygons_features_json_idx1 ON $schema.planet_osm_poi_polygons USING gin (features_json);
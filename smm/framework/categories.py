@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+
+import json
+import pandas as pd
+from typing import Dict, List, Optional
+from ..common.storage import atomic_path
+
+
+class CategoryVocabulary(object):
+    '''
+    Shared, stable categories of string columns (e.g. derived from planet_osm_poi_meta). encode() converts the
+    columns to pandas categoricals, which are stored as dictionary columns in (Geo)Parquet. Values of the vocabulary
+    get the same codes in every frame. Values missing in the vocabulary are appended per frame in sorted order
+    instead of being dropped, so their codes can differ between frames; compare such columns by value.
+    '''
+
+    def __init__(self, categories: Dict[str, List[str]]) -> None:
+        self.categories = {c: list(v) for c, v in categories.items()}
+        self._dtypes = {c: pd.CategoricalDtype(v) for c, v in self.categories.items()}
+        # File the vocabulary was saved to or loaded from
+        self.path = None
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, columns: Optional[List[str]] = None, aliases: Dict[str, List[str]] = {}):
+        '''
+        Categories of the (default: all string) columns of df, sorted. An alias column gets the union of the
+        categories of its source columns.
+        '''
+        if columns is None:
+            columns = [c for c in df.columns if pd.api.types.is_string_dtype(df[c])]
+        _values = lambda c: df[c].dropna().astype(str)
+        categories = {c: sorted(_values(c).unique()) for c in columns}
+        for alias, sources in aliases.items():
+            categories[alias] = sorted(set().union(*(_values(c).unique() for c in sources)))
+        return cls(categories)
+
+    def dtype(self, column: str) -> pd.CategoricalDtype:
+        return self._dtypes[column]
+
+    def encode(self, df: pd.DataFrame, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        '''
+        Converts the vocabulary columns of df (or the given ones) to categoricals in place and returns df. Unknown
+        values follow the vocabulary categories in sorted order.
+        '''
+        for column in (columns or self.categories.keys()):
+            if column not in df.columns:
+                continue
+            dtype = self._dtypes[column]
+            values = df[column]
+            if isinstance(values.dtype, pd.CategoricalDtype) and values.dtype == dtype:
+                continue
+            values = values.astype(str).where(values.notna())
+            unknown = pd.Index(values.dropna().unique()).difference(dtype.categories)
+            if len(unknown) > 0:
+                dtype = pd.CategoricalDtype(dtype.categories.append(unknown.sort_values()))
+            df[column] = values.astype(dtype)
+        return df
+
+    def save(self, path: str):
+        with atomic_path(path) as tmp_file:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(self.categories, f, indent=1, ensure_ascii=False)
+        self.path = path
+        return self
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, encoding="utf-8") as f:
+            vocabulary = cls(json.load(f))
+        vocabulary.path = path
+        return vocabulary
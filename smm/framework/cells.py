@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+
+import os, json
+import numpy as np
+import pandas as pd
+import shapely
+from typing import Dict, List, Optional
+from ..common.storage import atomic_path
+
+# S2 cell ids have 30 levels below the 6 faces, leaf cells have the lowest bit set
+S2_MAX_LEVEL = 30
+S2_MAX_SIZE = 1 << S2_MAX_LEVEL
+# H3 resolution field and the 3 bit digits of resolution 1 to 15
+H3_RES_OFFSET = 52
+H3_MAX_RES = 15
+
+
+def _s2_leaf_cells(lat, lng):
+    '''Vectorized s2sphere.CellId.from_lat_lng, leaf cell ids of coordinates in degrees.'''
+    from s2sphere import LOOKUP_POS, LOOKUP_BITS, SWAP_MASK, INVERT_MASK
+    lat, lng = np.radians(lat), np.radians(lng)
+    xyz = np.stack([np.cos(lat) * np.cos(lng), np.cos(lat) * np.sin(lng), np.sin(lat)])
+    axis = np.argmax(np.abs(xyz), axis=0)
+    _rows = np.arange(xyz.shape[1])
+    face = np.where(xyz[axis, _rows] < 0, axis + 3, axis)
+    x, y, z = xyz
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.choose(face, [y / x, -x / y, -x / z, z / x, z / y, -y / z])
+        v = np.choose(face, [z / x, z / y, -y / z, y / x, -x / y, -x / z])
+    #Quadratic projection of s2sphere uv_to_st
+    _st = lambda w: np.where(w >= 0, 0.5 * np.sqrt(1 + 3 * np.abs(w)), 1 - 0.5 * np.sqrt(1 + 3 * np.abs(w)))
+    _ij = lambda s: np.clip(np.floor(S2_MAX_SIZE * s), 0, S2_MAX_SIZE - 1).astype(np.uint64)
+    i, j = _ij(_st(u)), _ij(_st(v))
+
+    lookup = np.asarray(LOOKUP_POS, dtype=np.uint64)
+    mask = np.uint64((1 << LOOKUP_BITS) - 1)
+    n = face.astype(np.uint64) << np.uint64(2 * S2_MAX_LEVEL)
+    bits = face.astype(np.uint64) & np.uint64(SWAP_MASK)
+    for k in range(7, -1, -1):
+        bits = bits + (((i >> np.uint64(k * LOOKUP_BITS)) & mask) << np.uint64(LOOKUP_BITS + 2))
+        bits = bits + (((j >> np.uint64(k * LOOKUP_BITS)) & mask) << np.uint64(2))
+        bits = lookup[bits]
+        n |= (bits >> np.uint64(2)) << np.uint64(k * 2 * LOOKUP_BITS)
+        bits &= np.uint64(SWAP_MASK | INVERT_MASK)
+    return n * np.uint64(2) + np.uint64(1)
+
+
+def _s2_face_ij(cells):
+    '''Vectorized s2sphere.CellId.to_face_ij_orientation without the orientation.'''
+    from s2sphere import LOOKUP_IJ, LOOKUP_BITS, SWAP_MASK, INVERT_MASK
+    lookup = np.asarray(LOOKUP_IJ, dtype=np.uint64)
+    mask = np.uint64((1 << LOOKUP_BITS) - 1)
+    face = cells >> np.uint64(2 * S2_MAX_LEVEL + 1)
+    bits = face & np.uint64(SWAP_MASK)
+    i, j = np.zeros_like(cells), np.zeros_like(cells)
+    for k in range(7, -1, -1):
+        nbits = S2_MAX_LEVEL - 7 * LOOKUP_BITS if k == 7 else LOOKUP_BITS
+        bits = bits + (((cells >> np.uint64(k * 2 * LOOKUP_BITS + 1)) & np.uint64((1 << 2 * nbits) - 1)) << np.uint64(2))
+        bits = lookup[bits]
+        i += (bits >> np.uint64(LOOKUP_BITS + 2)) << np.uint64(k * LOOKUP_BITS)
+        j += ((bits >> np.uint64(2)) & mask) << np.uint64(k * LOOKUP_BITS)
+        bits &= np.uint64(SWAP_MASK | INVERT_MASK)
+    return face, i, j
+
+
+def _s2_polygons(cells):
+    '''Polygons of the 4 vertices of S2 cells of any level, like s2sphere.Cell.get_vertex.'''
+    face, i, j = _s2_face_ij(cells)
+    lsb = cells & (~cells + np.uint64(1))
+    size = np.uint64(1) << (np.log2(lsb).astype(np.uint64) // np.uint64(2))
+    i, j = i & ~(size - np.uint64(1)), j & ~(size - np.uint64(1))
+    #Vertices counterclockwise in (u, v), then quadratic projection of s2sphere st_to_uv
+    _i = np.stack([i, i + size, i + size, i], axis=1).astype(float) / S2_MAX_SIZE
+    _j = np.stack([j, j, j + size, j + size], axis=1).astype(float) / S2_MAX_SIZE
+    _uv = lambda s: np.where(s >= 0.5, (4 * s * s - 1) / 3, (1 - 4 * (1 - s) * (1 - s)) / 3)
+    u, v, one = _uv(_i), _uv(_j), np.ones(_i.shape)
+    face = np.broadcast_to(face[:, None], _i.shape).astype(int)
+    x = np.choose(face, [one, -u, -u, -one, v, v])
+    y = np.choose(face, [u, one, -v, -v, -one, u])
+    z = np.choose(face, [v, v, one, -u, -u, -one])
+    lat, lng = np.degrees(np.arctan2(z, np.hypot(x, y))), np.degrees(np.arctan2(y, x))
+    return shapely.polygons(np.stack([lng, lat], axis=-1))
+
+
+def cell_polygons(cells, mask):
+    '''Vectorized polygons (EPSG:4326) of H3/S2 cell ids (uint64) of any resolution.'''
+    cells = np.asarray(cells, dtype=np.uint64)
+    if mask == "h3":
+        import pyarrow as pa
+        from h3ronpy.vector import cells_to_wkb_polygons
+        return shapely.from_wkb(pa.array(cells_to_wkb_polygons(cells)).to_numpy(zero_copy_only=False))
+    return _s2_polygons(cells)
+
+
+def s2_parent(cells, level):
+    lsb = np.uint64(1 << (2 * (S2_MAX_LEVEL - level)))
+    return (cells & ~(lsb - np.uint64(1))) | lsb
+
+
+def h3_parent(cells, resolution):
+    cells = cells & ~np.uint64(0xF << H3_RES_OFFSET) | np.uint64(resolution << H3_RES_OFFSET)
+    # Digits below the resolution are unused (7)
+    return cells | np.uint64((1 << ((H3_MAX_RES - resolution) * 3)) - 1)
+
+
+def latlng_to_cells(lat, lng, mask, resolution):
+    '''Vectorized H3/S2 cell ids (uint64) of coordinates in degrees.'''
+    lat, lng = np.asarray(lat, dtype=float), np.asarray(lng, dtype=float)
+    if mask == "h3":
+        from h3ronpy.vector import coordinates_to_cells
+        return np.asarray(coordinates_to_cells(lat, lng, resolution), dtype=np.uint64)
+    return s2_parent(_s2_leaf_cells(lat, lng), resolution)
+
+
+def parent_cells(cells, mask, resolution):
+    return h3_parent(cells, resolution) if mask == "h3" else s2_parent(cells, resolution)
+
+
+def parse_cells(region_ids, mask):
+    '''Cell ids of srai region ids, hex strings for H3 and S2 tokens (hex without trailing zeros).'''
+    if mask == "h3":
+        return np.array([int(r, 16) for r in region_ids], dtype=np.uint64)
+    return np.array([int(r.ljust(16, "0"), 16) for r in region_ids], dtype=np.uint64)
+
+
+def format_cells(cells, mask):
+    '''srai region ids of cell ids, inverse of parse_cells.'''
+    if mask == "h3":
+        return np.array([format(c, "x") for c in cells.tolist()], dtype=object)
+    return np.array([format(c, "016x").rstrip("0") for c in cells.tolist()], dtype=object)
+
+
+def to_cell_frame(gdf, mask, region_column: str = "region_id") -> pd.DataFrame:
+    '''Tesselation result without geometry, the region ids are replaced by the uint64 column "cell".'''
+    df = pd.DataFrame(gdf.drop(columns=gdf.geometry.name))
+    if region_column not in df.columns:
+        df = df.reset_index()
+    df.insert(0, "cell", parse_cells(df.pop(region_column).to_numpy(), mask))
+    return df.reset_index(drop=True)
+
+
+def from_cell_frame(df: pd.DataFrame, mask, region_column: str = "region_id", crs="EPSG:4326"):
+    '''Inverse of to_cell_frame with the cell polygons as geometry.'''
+    import geopandas as gpd
+    cells = df["cell"].to_numpy(dtype=np.uint64)
+    gdf = gpd.GeoDataFrame(df.drop(columns="cell"), geometry=cell_polygons(cells, mask), crs=crs)
+    gdf.insert(0, region_column, format_cells(cells, mask))
+    return gdf
+
+
+class CellIndex(object):
+    '''
+    Lookup of tesselated metrics by coordinates without geometry operations. Holds a sorted uint64 array of H3/S2
+    cell ids and one value array per column. Besides the cells of the tesselation, up to `levels` parent resolutions
+    hold the mean of their non-empty children, which answer lookups for coordinates in empty cells.
+    '''
+    masks = ("h3", "s2")
+
+    def __init__(self, cells: np.ndarray, values: Dict[str, np.ndarray], mask: str, resolution: int,
+                 levels: int = 0) -> None:
+        assert mask in self.masks, f"Unknown mask, use one of {self.masks}."
+        self.cells = cells
+        self.values = values
+        self.mask = mask
+        self.resolution = resolution
+        self.levels = levels
+
+    @classmethod
+    def from_frame(cls,
+                   df: pd.DataFrame,
+                   mask: str,
+                   resolution: int,
+                   columns: List[str],
+                   region_column: str = "region_id",
+                   aggregation: str = "sum",
+                   levels: int = 2):
+        '''
+        Builds the index from a tesselation result with one or more rows per cell (e.g. SpatialTesselatorMeta),
+        rows of a cell are aggregated by sum or mean. Cell frames (see to_cell_frame) are used without parsing.
+        '''
+        assert aggregation in ("sum", "mean"), "Unknown aggregation, use either sum or mean."
+        frame = pd.DataFrame({c: df[c].to_numpy(dtype=float) for c in columns})
+        if "cell" in df.columns and region_column not in df.columns:
+            frame["cell"] = df["cell"].to_numpy(dtype=np.uint64)
+        else:
+            df = df.reset_index() if region_column not in df.columns else df
+            frame["cell"] = parse_cells(df[region_column].to_numpy(), mask)
+        frame = frame.groupby("cell").agg(aggregation)
+        frames = [frame]
+        for level in range(1, levels + 1):
+            if resolution - level < 0:
+                break
+            _frame = frames[-1]
+            _frame = _frame.groupby(parent_cells(_frame.index.to_numpy(dtype=np.uint64), mask,
+                                                 resolution - level)).mean()
+            frames.append(_frame)
+        frame = pd.concat(frames).sort_index()
+        return cls(frame.index.to_numpy(dtype=np.uint64), {c: frame[c].to_numpy() for c in columns},
+                   mask,
+                   resolution,
+                   levels=len(frames) - 1)
+
+    @classmethod
+    def from_layer(cls, layer, columns: List[str], aggregation: str = "sum", levels: int = 2, **kwargs):
+        '''Builds the index from a DataLayer with a SpatialTesselatorMeta operator.'''
+        operator = layer.operator
+        return cls.from_frame(layer.cells if getattr(layer, "storage", None) == "cells" else layer.content,
+                              mask=kwargs.pop("mask", operator.mask),
+                              resolution=kwargs.pop("resolution", operator.resolution),
+                              columns=columns,
+                              aggregation=aggregation,
+                              levels=levels,
+                              **kwargs)
+
+    def lookup(self, lat, lng, columns: Optional[List[str]] = None) -> Dict[str, np.ndarray]:
+        '''
+        Values of the cells of the coordinates (degrees), NaN if neither the cell nor one of its parents has a value.
+        '''
+        cells = latlng_to_cells(lat, lng, self.mask, self.resolution)
+        rows = np.full(len(cells), -1, dtype=np.int64)
+        missing = np.arange(len(cells))
+        for level in range(self.levels + 1):
+            _cells = cells[missing] if level == 0 else parent_cells(cells[missing], self.mask,
+                                                                    self.resolution - level)
+            pos = np.minimum(np.searchsorted(self.cells, _cells), max(len(self.cells) - 1, 0))
+            found = self.cells[pos] == _cells if len(self.cells) else np.zeros(len(_cells), dtype=bool)
+            rows[missing[found]] = pos[found]
+            missing = missing[~found]
+            if len(missing) == 0:
+                break
+        hit = rows >= 0
+        result = {}
+        for column in (columns or list(self.values.keys())):
+            values = np.full(len(cells), np.nan)
+            values[hit] = self.values[column][rows[hit]]
+            result[column] = values
+        return result
+
+    def save(self, path: str):
+        '''Stores the index as directory of .npy arrays, which load() can memory-map.'''
+        os.makedirs(path, exist_ok=True)
+        columns = list(self.values.keys())
+        arrays = {"cells.npy": self.cells, **{f"column_{i}.npy": self.values[c] for i, c in enumerate(columns)}}
+        for name, array in arrays.items():
+            with atomic_path(os.path.join(path, name)) as tmp_file:
+                np.save(tmp_file, np.ascontiguousarray(array))
+        with atomic_path(os.path.join(path, "index.json")) as tmp_file:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(dict(mask=self.mask, resolution=self.resolution, levels=self.levels, columns=columns), f)
+        return self
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        with open(os.path.join(path, "index.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        mmap_mode = "r" if mmap else None
+        cells = np.load(os.path.join(path, "cells.npy"), mmap_mode=mmap_mode)
+        values = {
+            c: np.load(os.path.join(path, f"column_{i}.npy"), mmap_mode=mmap_mode)
+            for i, c in enumerate(meta["columns"])
+        }
+        return cls(cells, values, meta["mask"], meta["resolution"], levels=meta["levels"])
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+
+import hashlib
+import numpy as np
+import pandas as pd
+from typing import List, Optional
+from ..common.storage import atomic_path
+
+
+class Crosswalk(object):
+    '''
+    Sparse area weights between source and target geometries (target x source), computed once from the area
+    intersection of SpatialDiscretizer and applied to any number of columns by sparse matrix products.
+    Extensive columns (counts) are split by the l1_l2_scale weights, which include the hull clip. Intensive columns
+    (rates, densities) are averaged by intersection area. Rows are identified by the index of the source and target
+    frames, which is checked on apply. The fingerprint identifies the geometries and settings it was computed from.
+    '''
+    version = 1
+
+    def __init__(self,
+                 weights,
+                 areas,
+                 source_index: pd.Index,
+                 target_index: pd.Index,
+                 fingerprint: Optional[str] = None) -> None:
+        assert weights.shape == areas.shape == (len(target_index), len(source_index)), "Shape doesn't match indexes."
+        self.weights = weights.tocsr()
+        self.areas = areas.tocsr()
+        self.source_index = pd.Index(source_index)
+        self.target_index = pd.Index(target_index)
+        self.fingerprint = fingerprint
+
+    @staticmethod
+    def fingerprint_of(source, target, crs, hull_clip: bool) -> str:
+        '''Hash of the WKB geometries and CRS of both frames, the intersection CRS and hull_clip.'''
+        import shapely
+        from pyproj import CRS
+        _crs = lambda c: "" if c is None else CRS.from_user_input(c).to_wkt()
+        h = hashlib.sha256(f"{hull_clip}|{_crs(crs)}".encode())
+        for gdf in (source, target):
+            wkb = shapely.to_wkb(np.asarray(gdf.geometry.values))
+            h.update(_crs(gdf.crs).encode())
+            h.update(np.array([len(g) for g in wkb], dtype=np.int64).tobytes())
+            h.update(b"".join(wkb))
+        return h.hexdigest()
+
+    @classmethod
+    def from_intersection(cls, joined: pd.DataFrame, source_index: pd.Index, target_index: pd.Index):
+        '''
+        Builds the matrices from SpatialDiscretizer.area_intersection, where l1 is the target (mask) and l2 the
+        source. The fids of the geopackages are the 1-based row positions of the frames.
+        '''
+        from scipy import sparse
+        shape = (len(target_index), len(source_index))
+        rows = joined["l1_fid"].to_numpy(dtype=np.int64) - 1
+        columns = joined["l2_fid"].to_numpy(dtype=np.int64) - 1
+        _matrix = lambda values: sparse.csr_matrix((values.to_numpy(dtype=float), (rows, columns)), shape=shape)
+        return cls(_matrix(joined["l1_l2_scale"].fillna(0)), _matrix(joined["intersect_area"]), source_index,
+                   target_index)
+
+    @classmethod
+    def from_frames(cls, source, target, crs=None, hull_clip: bool = True, **kwargs):
+        '''Computes the crosswalk of two GeoDataFrames, see SpatialDiscretizer.area_intersection.'''
+        from .operators import SpatialDiscretizer
+        return SpatialDiscretizer(**kwargs).crosswalk(source, target, crs or source.crs, hull_clip=hull_clip)
+
+    def matches(self, source: pd.DataFrame, target: pd.DataFrame, fingerprint: Optional[str] = None) -> bool:
+        '''Same rows and, if given, the same fingerprint (see fingerprint_of).'''
+        if fingerprint is not None and fingerprint != self.fingerprint:
+            return False
+        return self.source_index.equals(source.index) and self.target_index.equals(target.index)
+
+    def apply(self,
+              source: pd.DataFrame,
+              extensive: Optional[List[str]] = None,
+              intensive: Optional[List[str]] = None) -> pd.DataFrame:
+        '''
+        Reapportions the columns of source to the targets. Target rows without intersection get 0 for extensive and
+        NaN for intensive columns, NaN source values are ignored.
+        '''
+        assert self.source_index.equals(source.index), "Source rows don't match the crosswalk."
+        extensive, intensive = list(extensive or []), list(intensive or [])
+        parts = [np.empty((len(self.target_index), 0))]
+        if extensive:
+            values = source[extensive].to_numpy(dtype=float)
+            parts.append(self.weights @ np.nan_to_num(values))
+        if intensive:
+            values = source[intensive].to_numpy(dtype=float)
+            covered = self.areas @ (~np.isnan(values)).astype(float)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                parts.append((self.areas @ np.nan_to_num(values)) / covered)
+        return pd.DataFrame(np.hstack(parts), index=self.target_index, columns=extensive + intensive)
+
+    def save(self, path: str):
+        '''Stores both matrices and the indexes in one .npz file.'''
+        with atomic_path(path) as tmp_file:
+            with open(tmp_file, "wb") as f:
+                matrices = {f"{name}_{key}": getattr(getattr(self, name), key)
+                            for name in ("weights", "areas") for key in ("data", "indices", "indptr")}
+                np.savez_compressed(f,
+                                    version=self.version,
+                                    shape=np.array(self.weights.shape),
+                                    source_index=self.source_index.to_numpy(),
+                                    target_index=self.target_index.to_numpy(),
+                                    fingerprint=self.fingerprint or "",
+                                    **matrices)
+        return self
+
+    @classmethod
+    def load(cls, path: str):
+        from scipy import sparse
+        with np.load(path, allow_pickle=True) as data:
+            assert int(data["version"]) == cls.version, "Crosswalk file of another version."
+            shape = tuple(data["shape"])
+            _matrix = lambda name: sparse.csr_matrix(
+                (data[f"{name}_data"], data[f"{name}_indices"], data[f"{name}_indptr"]), shape=shape)
+            # Files without fingerprint never match and are recomputed
+            fingerprint = str(data["fingerprint"]) if "fingerprint" in data.files else None
+            return cls(_matrix("weights"), _matrix("areas"), data["source_index"], data["target_index"], fingerprint
+                       or None)
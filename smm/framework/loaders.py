@@ -1,17 +1,46 @@
 from __future__ import annotations
-import os, fiona
+import os, io, json
 import pandas as pd
 import geopandas as gpd
 import numpy as np
-import rasterio
-import rioxarray as rxr
-import geofileops as gfo
+import shapely
 import inspect
-from shapely.geometry import shape, Point
+from shapely.geometry import Point
 from typing import List, Optional, Literal, Dict, Union
-from pydantic import BaseModel
 
 from ..common.config import TEST_ROOT
+from ..common.storage import atomic_path
+from .profiling import profiler
+from .cells import to_cell_frame, from_cell_frame
+
+
+# Empty frame written for no chunks
+EMPTY_FRAME = lambda: gpd.GeoDataFrame(geometry=gpd.GeoSeries([]))
+
+# Spatial sort orders on save
+SPATIAL_SORTS = ("hilbert", "h3")
+H3_SORT_RESOLUTION = 12
+
+
+def spatial_order(gdf: gpd.GeoDataFrame, method: str = "hilbert") -> np.ndarray:
+    '''
+    Row positions of gdf ordered by the centroids of the geometries along a Hilbert curve over the total bounds or by
+    their H3 cell, missing and empty geometries last.
+    '''
+    assert method in SPATIAL_SORTS, f"Unknown spatial sort, use one of {SPATIAL_SORTS}."
+    geoms = gdf.geometry
+    valid = (geoms.notna() & ~geoms.is_empty).to_numpy()
+    keys = np.full(len(gdf), np.iinfo(np.uint64).max, dtype=np.uint64)
+    if valid.any():
+        if method == "hilbert":
+            keys[valid] = geoms[valid].hilbert_distance().to_numpy(dtype=np.uint64)
+        else:
+            from .cells import latlng_to_cells
+            # Centroids in the source crs, only the points are reprojected
+            centroids = gpd.GeoSeries(shapely.centroid(geoms[valid].values), crs=geoms.crs)
+            centroids = centroids.to_crs(4326) if geoms.crs is not None else centroids
+            keys[valid] = latlng_to_cells(centroids.y.to_numpy(), centroids.x.to_numpy(), "h3", H3_SORT_RESOLUTION)
+    return np.argsort(keys, kind="stable")
 
 
 #Base loader class
@@ -19,8 +48,15 @@ class GeoPandasBase(object):
     extension: str = None
     enable: bool = True
 
-    def __init__(self, path: Union[str, any]) -> None:
+    def __init__(self, path: Union[str, any], spatial_sort: Optional[str] = None, vocabulary=None) -> None:
+        '''
+        spatial_sort (hilbert/h3) writes the rows in spatial order (see spatial_order), the content itself is kept.
+        The columns of a vocabulary (categories.CategoryVocabulary) are loaded as categoricals.
+        '''
+        assert spatial_sort in (None, ) + SPATIAL_SORTS, f"Unknown spatial sort, use one of {SPATIAL_SORTS}."
         self._content = None
+        self.spatial_sort = spatial_sort
+        self.vocabulary = vocabulary
         assert (self.extension is not None)
         if isinstance(path, tuple(loader_classes.values())):
             self._content = path
@@ -53,10 +89,55 @@ class GeoPandasBase(object):
 
     def load(self):
         if isinstance(self._content, tuple(loader_classes.values())):
-            self._content = self._content.content
+            self._content = self._encoded(self._content.content)
+        if self._content is None and os.path.isfile(self.file):
+            with profiler.span(os.path.basename(self.file), "load", loader=type(self).__name__) as span:
+                self._content = self._encoded(self._read(self.file))
+                span.update(rows_out=len(self._content), bytes_read=os.path.getsize(self.file))
         return self
 
+    def _encoded(self, df):
+        return self.vocabulary.encode(df) if self.vocabulary is not None else df
+
     def save(self):
+        with profiler.span(os.path.basename(self.file), "save", loader=type(self).__name__) as span:
+            content = self.content
+            with atomic_path(self.file) as tmp_file:
+                self._write(self._sorted(content), tmp_file)
+            span.update(rows_in=len(content), bytes_written=os.path.getsize(self.file))
+        return self
+
+    def write_chunks(self, chunks):
+        '''
+        Writes an iterable of (Geo)DataFrame chunks to the file without holding more than one chunk in memory. The
+        content is not kept in the loader and is loaded from the file on the next access. A spatial sort applies
+        within each chunk only.
+        '''
+        with profiler.span(os.path.basename(self.file), "save", loader=type(self).__name__) as span:
+            with atomic_path(self.file) as tmp_file:
+                rows = self._write_chunks(map(self._sorted, chunks), tmp_file)
+            span.update(rows_in=rows, bytes_written=os.path.getsize(self.file))
+        self._content = None
+        return self
+
+    def _write_chunks(self, chunks, file: str):
+        # Fallback for formats without append support
+        chunks = list(chunks)
+        gdf = pd.concat(chunks, ignore_index=True) if chunks else EMPTY_FRAME()
+        self._write(gdf, file)
+        return len(gdf)
+
+    def _sorted(self, gdf):
+        if self.spatial_sort is None or not isinstance(gdf, gpd.GeoDataFrame) or len(gdf) == 0:
+            return gdf
+        with profiler.span(os.path.basename(self.file), "spatial_sort", method=self.spatial_sort) as span:
+            span.update(rows_in=len(gdf))
+            return gdf.iloc[spatial_order(gdf, self.spatial_sort)]
+
+    def _read(self, file: str):
+        raise Exception("Not implemented yet")
+
+    def _write(self, gdf: Union[gpd.GeoDataFrame, pd.DataFrame], file: str):
         raise Exception("Not implemented yet")
 
     def has_content(self):
@@ -67,115 +148,249 @@ class GeoPandasBase(object):
 class GeoFileOpsLoader(GeoPandasBase):
     extension: str = ".gpkg"
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    def __init__(self, path, **kwargs) -> None:
+        super().__init__(path, **kwargs)
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                self._content = gfo.read_file(self.file)
-        return self
+    def _read(self, file):
+        import geofileops as gfo
+        return gfo.read_file(file)
 
-    def save(self):
-        gfo.to_file(self.content, self.file)
-        return self
+    def _write(self, gdf, file):
+        import geofileops as gfo
+        gfo.to_file(gdf, file)
+
+    def _write_chunks(self, chunks, file):
+        import geofileops as gfo
+        rows = 0
+        for chunk in chunks:
+            gfo.to_file(chunk, file, append=rows > 0)
+            rows += len(chunk)
+        return rows
 
 
 # Geoparquet Loader
 class GeoparquetLoader(GeoPandasBase):
+    '''
+    GeoParquet 1.1 with a bbox covering column, so that the row group statistics allow bbox filtered reads (see
+    read_bbox). Row groups of row_group_size rows are local, if the rows are spatially sorted on save.
+    '''
     extension: str = ".gpq"
+    schema_version: str = "1.1.0"
+
+    def __init__(self, path, row_group_size: int = 65536, **kwargs) -> None:
+        super().__init__(path, **kwargs)
+        self.row_group_size = row_group_size
+
+    def _read(self, file):
+        return gpd.read_parquet(file)
+
+    def read_bbox(self, bbox):
+        '''Reads the rows intersecting the bbox (minx, miny, maxx, maxy) only, without keeping them as content.'''
+        with profiler.span(os.path.basename(self.file), "load", loader=type(self).__name__, bbox=list(bbox)) as span:
+            gdf = gpd.read_parquet(self.file, bbox=bbox)
+            span.update(rows_out=len(gdf))
+        return gdf
+
+    def _write(self, gdf, file):
+        gdf.to_parquet(file,
+                       schema_version=self.schema_version,
+                       write_covering_bbox=True,
+                       row_group_size=self.row_group_size)
+
+    def _to_arrow(self, gdf):
+        '''
+        Arrow table with GeoParquet metadata of a chunk. The private geopandas conversion may change between
+        versions, the fallback writes the chunk with the public to_parquet into memory and reads it back.
+        '''
+        import pyarrow.parquet as pq
+        kwargs = dict(index=False, schema_version=self.schema_version, write_covering_bbox=True)
+        try:
+            from geopandas.io.arrow import _geopandas_to_arrow
+            return _geopandas_to_arrow(gdf, **kwargs)
+        except (ImportError, TypeError):
+            buffer = io.BytesIO()
+            gdf.to_parquet(buffer, **kwargs)
+            return pq.read_table(buffer)
+
+    def _write_chunks(self, chunks, file):
+        '''
+        Streams the chunks into row groups. Columns that are all null in the first chunks get the type of the first
+        chunk with values, the row groups written so far are rewritten once then.
+        '''
+        import pyarrow.parquet as pq
+        writer, schema, rows = None, None, 0
+        try:
+            for chunk in chunks:
+                table = self._to_arrow(chunk)
+                if schema is None:
+                    # Bbox and geometry types of the first chunk don't hold for the whole file
+                    geo = json.loads(table.schema.metadata[b"geo"])
+                    for column in geo["columns"].values():
+                        column.pop("bbox", None)
+                        column["geometry_types"] = []
+                    schema = table.schema.with_metadata({**table.schema.metadata, b"geo": json.dumps(geo)})
+                widened = self._widened(schema, table.schema)
+                if widened is not schema:
+                    schema = widened
+                    if writer is not None:
+                        writer.close()
+                        writer = self._rewrite(file, schema)
+                if writer is None:
+                    writer = pq.ParquetWriter(file, schema)
+                writer.write_table(table.cast(schema), row_group_size=self.row_group_size)
+                rows += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+        if writer is None:
+            self._write(EMPTY_FRAME(), file)
+        return rows
+
+    @staticmethod
+    def _widened(schema, other):
+        '''schema with the null typed fields replaced by the typed fields of other, schema itself if none is.'''
+        import pyarrow as pa
+        _typed = lambda f: f.name in other.names and not pa.types.is_null(other.field(f.name).type)
+        fields = [other.field(f.name) if pa.types.is_null(f.type) and _typed(f) else f for f in schema]
+        if all(f is g for f, g in zip(fields, schema)):
+            return schema
+        return pa.schema(fields, metadata=schema.metadata)
+
+    def _rewrite(self, file, schema):
+        '''Rewrites the row groups of file with schema and returns a writer to append further row groups.'''
+        import pyarrow.parquet as pq
+        part = file + ".part"
+        os.replace(file, part)
+        try:
+            writer = pq.ParquetWriter(file, schema)
+            source = pq.ParquetFile(part)
+            for i in range(source.num_row_groups):
+                writer.write_table(source.read_row_group(i).cast(schema))
+            source.close()
+        finally:
+            os.remove(part)
+        return writer
+
+
+# Geometry-free H3/S2 cell Loader
+class CellParquetLoader(GeoPandasBase):
+    '''
+    Parquet storage of H3/S2 tesselations without geometries, the region ids are stored as uint64 column "cell".
+    Reading keeps the plain cell frame (see cells) and rebuilds the region ids and the cell polygons on the first
+    access of content only. Intersection geometries of the tesselation are replaced by their cell polygons.
+    '''
+    extension: str = ".cpq"
+    metadata_key: bytes = b"smm_cells"
+
+    def __init__(self, path, mask: Optional[str] = None, region_column: str = "region_id", **kwargs) -> None:
+        super().__init__(path, **kwargs)
+        self.mask = mask
+        self.region_column = region_column
+        self.crs = "EPSG:4326"
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    @property
+    def content(self):
+        self.load()
+        if self._content is not None and not isinstance(self._content, gpd.GeoDataFrame):
+            with profiler.span(os.path.basename(self.file), "cell_geometry", mask=self.mask) as span:
+                self._content = from_cell_frame(self._content, self.mask, self.region_column, self.crs)
+                span.update(rows_out=len(self._content))
+        return super().content
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                self._content = gpd.read_parquet(self.file)
-        return self
+    @content.setter
+    def content(self, gdf: Union[gpd.GeoDataFrame, pd.DataFrame]):
+        self.set(gdf)
 
-    def save(self):
-        self._content.to_parquet(self.file)
-        return self
+    @property
+    def cells(self) -> pd.DataFrame:
+        '''Content without geometries and region ids, for consumers of the metrics only.'''
+        self.load()
+        if isinstance(self._content, gpd.GeoDataFrame):
+            return to_cell_frame(self._content, self.mask, self.region_column)
+        return self._content if self._content is not None else pd.DataFrame({"cell": np.array([], dtype=np.uint64)})
+
+    def _sorted(self, gdf):
+        # Cell ids are hierarchical, S2 ids follow a Hilbert curve already
+        if self.spatial_sort is None:
+            return gdf
+        df = to_cell_frame(gdf, self.mask, self.region_column) if isinstance(gdf, gpd.GeoDataFrame) else gdf
+        return df.sort_values("cell", kind="stable")
+
+    def _read(self, file):
+        import pyarrow.parquet as pq
+        table = pq.read_table(file)
+        meta = json.loads(table.schema.metadata[self.metadata_key])
+        self.mask, self.region_column, self.crs = meta["mask"], meta["region_column"], meta["crs"]
+        return table.to_pandas()
+
+    def _write(self, gdf, file):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        df = to_cell_frame(gdf, self.mask, self.region_column) if isinstance(gdf, gpd.GeoDataFrame) else gdf
+        if isinstance(gdf, gpd.GeoDataFrame) and gdf.crs is not None:
+            self.crs = gdf.crs.to_string()
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        meta = dict(mask=self.mask, region_column=self.region_column, crs=self.crs)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), self.metadata_key: json.dumps(meta)})
+        pq.write_table(table, file, compression="zstd")
 
 
 # GeoJSON Loader
 class GeoJSONLoader(GeoPandasBase):
     extension: str = ".geojson"
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    def __init__(self, path, **kwargs) -> None:
+        super().__init__(path, **kwargs)
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                self._content = gpd.read_file(self.file)
-        return self
+    def _read(self, file):
+        return gpd.read_file(file)
 
-    def save(self):
-        self._content.to_parquet(self.file)
-        return self
+    def _write(self, gdf, file):
+        gdf.to_parquet(file)
 
 
 # Shapefile Loader
 class ShapeFileLoader(GeoPandasBase):
     extension: str = ".shp"
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    def __init__(self, path, **kwargs) -> None:
+        super().__init__(path, **kwargs)
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                self._content = gpd.read_file(self.file)
-        return self
+    def _read(self, file):
+        return gpd.read_file(file)
 
-    def save(self):
-        self._content.to_parquet(self.file)
-        return self
+    def _write(self, gdf, file):
+        gdf.to_parquet(file)
 
 
 # KML Loader
 class KmlLoader(GeoPandasBase):
     extension: str = ".kml"
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    def __init__(self, path, **kwargs) -> None:
+        super().__init__(path, **kwargs)
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                fiona.supported_drivers['KML'] = 'rw'
-                self._content = gpd.read_file(self.file, driver='KML')
-        return self
+    def _read(self, file):
+        import fiona
+        fiona.supported_drivers['KML'] = 'rw'
+        return gpd.read_file(file, driver='KML')
 
-    def save(self):
-        self._content.to_parquet(self.file)
-        return self
+    def _write(self, gdf, file):
+        gdf.to_parquet(file)
 
 
 # GML Loader
 class GmlLoader(GeoPandasBase):
     extension: str = ".gml"
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    def __init__(self, path, **kwargs) -> None:
+        super().__init__(path, **kwargs)
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                self._content = gpd.read_file(self.file)
-        return self
+    def _read(self, file):
+        return gpd.read_file(file)
 
-    def save(self):
-        self._content.to_parquet(self.file)
-        return self
+    def _write(self, gdf, file):
+        gdf.to_parquet(file)
 
 
 # GPKG Loader alternative
@@ -183,45 +398,33 @@ class GpkgLoader(GeoPandasBase):
     extension: str = ".gpkg"
     enable: bool = False
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    def __init__(self, path, **kwargs) -> None:
+        super().__init__(path, **kwargs)
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                self._content = gpd.read_file(self.file)
-        return self
+    def _read(self, file):
+        return gpd.read_file(file)
 
-    def save(self):
-        self._content.to_parquet(self.file)
-        return self
+    def _write(self, gdf, file):
+        gdf.to_parquet(file)
 
 
 # TIFF
 class TiffLoader(GeoPandasBase):
     extension: str = ".tif"
 
-    def __init__(self, path) -> None:
-        super().__init__(path)
+    def __init__(self, path, **kwargs) -> None:
+        super().__init__(path, **kwargs)
 
-    def load(self):
-        super().load()
-        if self._content is None:
-            if os.path.isfile(self.file):
-                dataarray = rxr.open_rasterio(self.file)
-                x, y, values = dataarray.x.values, dataarray.y.values, dataarray.values
-                x, y = np.meshgrid(x, y)
-                x, y, values = x.flatten(), y.flatten(), values.flatten()
-                self._content = gpd.GeoDataFrame.from_dict({
-                    'geometry': [Point(x, y) for x, y in zip(y, x)],
-                    'value': values
-                })
-        return self
+    def _read(self, file):
+        import rioxarray as rxr
+        dataarray = rxr.open_rasterio(file)
+        x, y, values = dataarray.x.values, dataarray.y.values, dataarray.values
+        x, y = np.meshgrid(x, y)
+        x, y, values = x.flatten(), y.flatten(), values.flatten()
+        return gpd.GeoDataFrame.from_dict({'geometry': [Point(x, y) for x, y in zip(y, x)], 'value': values})
 
-    def save(self):
-        self._content.to_parquet(self.file)
-        return self
+    def _write(self, gdf, file):
+        gdf.to_parquet(file)
 
 
 class GeoTiffLoader(TiffLoader):
@@ -233,11 +436,11 @@ loader_classes = {
 }
 
 
-def FileLoader(path: str):
+def FileLoader(path: str, **kwargs):
     _, tail = os.path.splitext(path)
     assert tail, "Need an extension inside the file path."
     assert tail in loader_classes, "Unknown file extension, no automatic loading supported."
-    return loader_classes[tail](path)
+    return loader_classes[tail](path, **kwargs)
 
 
 if __name__ == "__main__":
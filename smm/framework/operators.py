@@ -8,14 +8,12 @@ __status__ = "Production"
 import os
 import pandas as pd
 import geopandas as gpd
-import geofileops as gfo
 
 from enum import unique, Enum, IntEnum
 from typing import Annotated, List, Optional, Literal, Dict, Union
 from pydantic import BaseModel, Field, FilePath, DirectoryPath, computed_field
-from srai.joiners import IntersectionJoiner
-from srai.regionalizers import H3Regionalizer, S2Regionalizer
 from ..common.config import TMP_ROOT
+from .profiling import profiler
 
 DataLayers = Union["BaseDataLayer", "DataLayer"]
 
@@ -25,14 +23,16 @@ class SpatialDiscretizer(BaseModel):
     type: Literal['discretize'] = "discretize"
     _tmp_dir: str
 
-    def __init__(self, tmp_dir: str = TMP_ROOT) -> None:
-        self._tmp_dir = tmp_dir
+    def __init__(self, *args, tmp_dir: str = TMP_ROOT, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.__setattr__('_tmp_dir', tmp_dir)
 
     def area_intersection(self,
                           base_df: Union[str, gpd.GeoDataFrame],
                           mask_df: Union[str, gpd.GeoDataFrame],
                           crs,
                           hull_clip=True):
+        import geofileops as gfo
         #TODO: Add direct path support
         # Define paths
         target_data_gpkg = os.path.join(self._tmp_dir, "input1.gpkg")
@@ -54,30 +54,35 @@ class SpatialDiscretizer(BaseModel):
             _df["geom_area"] = _df.geometry.area
             if "geometry" not in _df:
                 _df.rename_geometry("geometry", inplace=True)
-            gfo.to_file(_df, _path)
+            with profiler.span("to_file", "geofileops") as span:
+                span.update(rows_in=len(_df))
+                gfo.to_file(_df, _path)
 
         # Calculate join
-        gfo.join_by_location(mask_data_gpkg,
-                             target_data_gpkg,
-                             output_path=output_path,
-                             area_inters_column_name="intersect_area",
-                             input1_columns=["fid"] + list(filter(lambda x: x != "geometry", df2.columns)),
-                             input2_columns=["fid"] + list(filter(lambda x: x != "geometry", df1.columns)),
-                             force=True)
-        joined = gfo.read_file(output_path)
-
-        # Calculate hull and join
-        joined["l1_l2_scale"] = joined["intersect_area"] / joined.groupby(by="l2_fid").transform(
-            "sum", "intersect_area")["intersect_area"]
-        if hull_clip:
-            gfo.join_by_location(target_data_gpkg,
-                                 mask_data_hull_gpkg,
+        with profiler.span("join_by_location", "geofileops") as span:
+            gfo.join_by_location(mask_data_gpkg,
+                                 target_data_gpkg,
                                  output_path=output_path,
                                  area_inters_column_name="intersect_area",
-                                 input1_columns=["fid"],
-                                 input2_columns=["fid"],
+                                 input1_columns=["fid"] + list(filter(lambda x: x != "geometry", df2.columns)),
+                                 input2_columns=["fid"] + list(filter(lambda x: x != "geometry", df1.columns)),
                                  force=True)
-            joined_hull = gfo.read_file(output_path)
+            joined = gfo.read_file(output_path)
+            span.update(rows_out=len(joined), bytes_written=os.path.getsize(output_path))
+
+        # Calculate hull and join
+        joined["l1_l2_scale"] = joined["intersect_area"] / joined.groupby(by="l2_fid")["intersect_area"].transform("sum")
+        if hull_clip:
+            with profiler.span("join_by_location", "geofileops") as span:
+                gfo.join_by_location(target_data_gpkg,
+                                     mask_data_hull_gpkg,
+                                     output_path=output_path,
+                                     area_inters_column_name="intersect_area",
+                                     input1_columns=["fid"],
+                                     input2_columns=["fid"],
+                                     force=True)
+                joined_hull = gfo.read_file(output_path)
+                span.update(rows_out=len(joined_hull), bytes_written=os.path.getsize(output_path))
             joined = pd.merge(joined,
                               joined_hull[["l1_fid",
                                            "intersect_area"]].rename(columns={"intersect_area": "l2_hull_area"}),
@@ -88,19 +93,65 @@ class SpatialDiscretizer(BaseModel):
             joined["l1_l2_scale"] *= joined["l2_hull_area"] / joined["l2_geom_area"]
         return joined
 
-    def discretize(self, input: Union[str, gpd.GeoDataFrame], mask: Union[str, gpd.GeoDataFrame], crs, hull_clip=True):
+    def crosswalk(self, input: gpd.GeoDataFrame, mask: gpd.GeoDataFrame, crs, hull_clip=True):
+        '''Sparse area weights from the input to the mask geometries, see crosswalk.Crosswalk.'''
+        from .crosswalk import Crosswalk
         intersection = self.area_intersection(input, mask, crs=crs, hull_clip=hull_clip)
-        columns = [c for c in intersection.columns if c.startswith8("l2_")]
-        intersection[columns] *= intersection["l1_l2_scale"]
-        return intersection[columns + ["l1_l2_scale"]].rename({c: c.substring(3, None) for c in columns})
+        crosswalk = Crosswalk.from_intersection(intersection, input.index, mask.index)
+        crosswalk.fingerprint = Crosswalk.fingerprint_of(input, mask, crs, hull_clip)
+        return crosswalk
+
+    def discretize(self,
+                   input: gpd.GeoDataFrame,
+                   mask: gpd.GeoDataFrame,
+                   crs,
+                   hull_clip=True,
+                   extensive: Optional[List[str]] = None,
+                   intensive: Optional[List[str]] = None,
+                   crosswalk=None):
+        '''
+        Reapportions the given extensive and intensive columns of input to the mask geometries, ids and codes must
+        not be split by area. A precomputed crosswalk skips the area intersection.
+        '''
+        assert extensive or intensive, "Requires at least one extensive or intensive column."
+        if crosswalk is None:
+            crosswalk = self.crosswalk(input, mask, crs, hull_clip=hull_clip)
+        result = crosswalk.apply(input, extensive=extensive, intensive=intensive)
+        return gpd.GeoDataFrame(result, geometry=mask.geometry.values, crs=mask.crs)
 
 
 class SpatialDiscretizerMeta(SpatialDiscretizer):
     mask: DataLayers
     hull_clip: bool = True
+    extensive: Optional[List[str]] = None
+    intensive: Optional[List[str]] = None
+    # Crosswalk file (.npz), computed on the first apply and reused as long as the geometries, crs and hull_clip are
+    # the same
+    crosswalk_file: Optional[str] = None
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        assert self.extensive or self.intensive, "Requires at least one extensive or intensive column."
+
+    def load_crosswalk(self, input: gpd.GeoDataFrame, mask: gpd.GeoDataFrame):
+        from .crosswalk import Crosswalk
+        if self.crosswalk_file is not None and os.path.isfile(self.crosswalk_file):
+            crosswalk = Crosswalk.load(self.crosswalk_file)
+            if crosswalk.matches(input, mask, Crosswalk.fingerprint_of(input, mask, input.crs, self.hull_clip)):
+                return crosswalk
+        crosswalk = self.crosswalk(input, mask, input.crs, hull_clip=self.hull_clip)
+        if self.crosswalk_file is not None:
+            crosswalk.save(self.crosswalk_file)
+        return crosswalk
 
     def apply(self, input: DataLayers):
-        return self.discretize(input.content, self.mask, input.content.crs, hull_clip=self.hull_clip)
+        source, mask = input.content, getattr(self.mask, "content", self.mask)
+        return self.discretize(source,
+                               mask,
+                               source.crs,
+                               extensive=self.extensive,
+                               intensive=self.intensive,
+                               crosswalk=self.load_crosswalk(source, mask))
 
     class Config:
         use_enum_values = True
@@ -121,13 +172,19 @@ class SpatialTesselator(BaseModel):
     type: Literal['tesselate'] = "tesselate"
 
     def tesselate(self, data: DataLayers, mask, resolution):
+        from srai.joiners import IntersectionJoiner
+        from srai.regionalizers import H3Regionalizer, S2Regionalizer
         assert TesselationMethodsMeta.has_value(mask), "Tesselation Method doesn't exist."
         if mask == TesselationMethodsMeta.h3:
             regionalizer = H3Regionalizer(resolution=resolution)
         elif mask == TesselationMethodsMeta.s2:
             regionalizer = S2Regionalizer(resolution=resolution)
-        regions = regionalizer.transform(data.content)
-        joint_gdf = IntersectionJoiner().transform(regions, data.content, return_geom=True).reset_index()
+        with profiler.span("regionalize", "srai", mask=mask, resolution=resolution) as span:
+            regions = regionalizer.transform(data.content)
+            span.update(rows_out=len(regions))
+        with profiler.span("intersection_join", "srai") as span:
+            joint_gdf = IntersectionJoiner().transform(regions, data.content, return_geom=True).reset_index()
+            span.update(rows_out=len(joint_gdf))
         return joint_gdf
 
 
@@ -152,6 +209,7 @@ class SpatialJoin(BaseModel):
         self.__setattr__('_tmp_dir', tmp_dir)
 
     def layer_join(self, base_df: Union[str, gpd.GeoDataFrame], join_df: Union[str, gpd.GeoDataFrame], crs):
+        import geofileops as gfo
         #TODO: Add direct path support
         # Define paths
         target_data_gpkg = os.path.join(self._tmp_dir, "input1.gpkg")
@@ -168,17 +226,21 @@ class SpatialJoin(BaseModel):
             _df["geom_area"] = _df.geometry.area
             if "geometry" not in _df:
                 _df.rename_geometry("geometry", inplace=True)
-            gfo.to_file(_df, _path)
+            with profiler.span("to_file", "geofileops") as span:
+                span.update(rows_in=len(_df))
+                gfo.to_file(_df, _path)
 
         # Calculate join
-        gfo.join_by_location(join_data_gpkg,
-                             target_data_gpkg,
-                             output_path=output_path,
-                             area_inters_column_name="intersect_area",
-                             input1_columns=["fid"] + list(filter(lambda x: x != "geometry", df2.columns)),
-                             input2_columns=["fid"] + list(filter(lambda x: x != "geometry", df1.columns)),
-                             force=True)
-        joined = gfo.read_file(output_path)
+        with profiler.span("join_by_location", "geofileops") as span:
+            gfo.join_by_location(join_data_gpkg,
+                                 target_data_gpkg,
+                                 output_path=output_path,
+                                 area_inters_column_name="intersect_area",
+                                 input1_columns=["fid"] + list(filter(lambda x: x != "geometry", df2.columns)),
+                                 input2_columns=["fid"] + list(filter(lambda x: x != "geometry", df1.columns)),
+                                 force=True)
+            joined = gfo.read_file(output_path)
+            span.update(rows_out=len(joined), bytes_written=os.path.getsize(output_path))
         return joined
 
 
@@ -11,12 +11,18 @@ import pandas as pd
 import geopandas as gpd
 from datetime import datetime
 from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
 from typing import Annotated, List, Optional, Literal, Dict, Union, get_args
 from enum import unique, Enum, IntEnum
 from pydantic import BaseModel, Field, FilePath, DirectoryPath, computed_field
 from ..common.config import TEST_ROOT
-from ..framework.loaders import GeoFileOpsLoader, FileLoader
+from ..common.storage import atomic_path, FileLock, ConcurrentModificationError
+from ..framework.loaders import GeoPandasBase, GeoFileOpsLoader, FileLoader, CellParquetLoader
+from ..framework.profiling import profiler, Profiler
+from ..framework.cells import to_cell_frame
+from ..framework.categories import CategoryVocabulary
 from ..framework.operators import SpatialOperatorAnnotated, SpatialOperator, SpatialTesselatorMeta, TesselationMethodsMeta
+from ..framework.operators import SpatialDiscretizerMeta, SpatialJoinMeta
 
 
 # Base DataLayers
@@ -30,6 +36,10 @@ class BaseDataLayer(BaseModel):
     type: BaseLayerTypes = None
     mode: Literal['BaseDataLayer'] = 'BaseDataLayer'
     path_is_relative: bool = False
+    # Row order of the saved file, see loaders.spatial_order
+    spatial_sort: Optional[Literal['hilbert', 'h3']] = None
+    # Json file of a categories.CategoryVocabulary, whose columns are loaded as categoricals
+    vocabulary: Optional[str] = None
 
     _path: Union[None, FilePath] = None
     _path_base: Union[None, DirectoryPath] = None
@@ -48,19 +58,63 @@ class BaseDataLayer(BaseModel):
             self.load()
             self._loader.set(data)
 
-    def export(self, path: str):
-        FileLoader(path).set(self._loader.content).save()
+    def export(self, path: str, spatial_sort: Optional[str] = None):
+        FileLoader(path, spatial_sort=spatial_sort or self.spatial_sort).set(self._loader.content).save()
         return self
 
     def save(self):
         assert self._loader is not None, "No path defined on initializing for saving."
         self._loader.save()
 
-    def load(self):
-        path = self._path
+    def export_tiles(self, path: str, min_zoom: int = 0, max_zoom: int = 12, columns: List[str] = None, **kwargs):
+        '''
+        Exports the layer as vector tiles into a .pmtiles or .mbtiles archive, see visualize.TileExporter.
+        '''
+        from .visualize import TileExporter
+        TileExporter(min_zoom=min_zoom, max_zoom=max_zoom, columns=columns, **kwargs).export(self.content,
+                                                                                           path,
+                                                                                           name=self.name)
+        return self
+
+    def export_raster(self, path: str, column: str, resolution: float, aggregation: str = "sum", **kwargs):
+        '''
+        Rasterizes a numeric column of the layer into a Cloud-Optimized GeoTIFF, see raster.RasterExporter.
+        '''
+        from .raster import RasterExporter
+        RasterExporter(resolution, aggregation=aggregation, **kwargs).export(self.content, column, path, name=self.name)
+        return self
+
+    def _full_path(self, path=None):
+        path = path or self._path
         if self.path_is_relative:
-            path = os.path.join(self._path_base, path)
-        self.__setattr__("_loader", GeoFileOpsLoader(FileLoader(path)))
+            return os.path.join(self._path_base, path)
+        return path
+
+    def _loader_kwargs(self):
+        vocabulary = CategoryVocabulary.load(self._full_path(self.vocabulary)) if self.vocabulary else None
+        return dict(spatial_sort=self.spatial_sort, vocabulary=vocabulary)
+
+    def load(self):
+        #The outer loader encodes the content of the file loader once
+        inner = FileLoader(self._full_path(), spatial_sort=self.spatial_sort)
+        self.__setattr__("_loader", GeoFileOpsLoader(inner, **self._loader_kwargs()))
+
+    def write_chunks(self, chunks):
+        '''
+        Streams chunks of a large (Geo)DataFrame directly into the layer file, e.g. from a chunked database query.
+        Formats with streaming support (.gpq) are written by their own loader, all others into the GeoPackage of the
+        layer loader.
+        '''
+        assert self._path is not None, "No path defined on initializing for saving."
+        loader = FileLoader(self._full_path(), spatial_sort=self.spatial_sort)
+        if type(loader)._write_chunks is GeoPandasBase._write_chunks:
+            if self._loader is None:
+                self.load()
+            self._loader.write_chunks(chunks)
+        else:
+            loader.write_chunks(chunks)
+            self.load()
+        return self
 
     def unpersist(self):
         self._cache = self._loader.content
@@ -110,6 +164,8 @@ class DataLayer(BaseDataLayer):
     _path: Union[None, FilePath] = None
     operator: SpatialOperatorAnnotated
     mode: Literal['DataLayer'] = 'DataLayer'
+    # "cells" persists tesselations by cell id without geometries, see loaders.CellParquetLoader
+    storage: Literal['geometry', 'cells'] = 'geometry'
 
     def __init__(self,
                  name: str,
@@ -121,28 +177,67 @@ class DataLayer(BaseDataLayer):
         if type is None:
             type = origin.type
         # Quick hack for preventing faulty type error problem..
+        join = getattr(operator, "_join", None)
         if not isinstance(operator, dict):
             operator = operator.model_dump(exclude_none=True)
         super().__init__(name=name, type=type, operator=operator, path=path, **kwargs)
         self.__setattr__('_origin', origin)
+        # The dump only keeps the name of the joined layer
+        if join is not None and not isinstance(join, str):
+            self.operator._join = join
 
     def apply_operation(self):
-        if self._loader:
-            self._loader.set(self.operator(self._origin))
-        else:
-            self._cache = self.operator.apply(self._origin)
+        with profiler.span(self.name, "layer", layer=self.name, operator=self.operator.type) as span:
+            span.update(rows_in=len(self._origin.content))
+            if self._loader:
+                self._loader.set(self.operator.apply(self._origin))
+                span.update(rows_out=len(self._loader.get()))
+            else:
+                self._cache = self.operator.apply(self._origin)
+                span.update(rows_out=len(self._cache))
         return self
 
+    def load(self):
+        if self.storage == "cells":
+            assert isinstance(self.operator, SpatialTesselatorMeta), "Cell storage needs a tesselation operator."
+            path, _ = os.path.splitext(self._full_path())
+            self.__setattr__("_loader", CellParquetLoader(path, mask=self.operator.mask, **self._loader_kwargs()))
+        else:
+            super().load()
+
     def make_persistent(self, path=None):
         self.__setattr__('_path', path)
         self.load()
 
     @property
     def content(self):
-        if (self._loader is not None and self._loader.has_content() == False) or (self._cache is None):
+        if self._path is not None and self._loader is None:
+            self.load()
+        # Only evaluate the operator if there is neither a persisted nor a cached result, a missing file loads empty
+        if self._loader is not None:
+            if self._loader.load().has_content() == False or self._loader.get().empty:
+                self.apply_operation()
+        elif self._cache is None:
             self.apply_operation()
         return super().content
 
+    @property
+    def cells(self) -> pd.DataFrame:
+        '''
+        Content of a cell stored tesselation without geometries (uint64 column "cell" and the attributes), cell
+        polygons are never built.
+        '''
+        assert self.storage == "cells", "Only available for the cell storage."
+        if self._path is not None and self._loader is None:
+            self.load()
+        if self._loader is not None:
+            if self._loader.load().has_content() == False:
+                self.apply_operation()
+            return self._loader.cells
+        if self._cache is None:
+            self.apply_operation()
+        return to_cell_frame(self._cache, self.operator.mask)
+
     @computed_field
     @property
     def origin(self) -> str:
@@ -179,13 +274,21 @@ class YamlConfigDefinition(BaseModel):
                 layer.set_base_path(base_path)
 
 
+#Resolve the forward references to the layer types in the operators and the config
+for _model in (SpatialDiscretizerMeta, SpatialTesselatorMeta, SpatialJoinMeta):
+    _model.model_rebuild(_types_namespace=dict(BaseDataLayer=BaseDataLayer, DataLayer=DataLayer))
+YamlConfigDefinition.model_rebuild()
+
+
 # Configuration Manager
 class PersistentManager:
     extension: str = ".ymlsmm"
 
-    def __init__(self, path=None) -> None:
+    def __init__(self, path=None, lock_timeout: float = 60.) -> None:
         self.root = None
         self.path = None
+        self.lock_timeout = lock_timeout
+        self._disk_version = None
         if path is not None:
             self.load(path)
         else:
@@ -214,24 +317,70 @@ class PersistentManager:
         if os.path.isfile(path):
             with open(path, mode="r", encoding="utf-8") as yaml_file:
                 self.config = YamlConfigDefinition(base_path=self.root, **yaml.safe_load(yaml_file))
+            self._disk_version = self.config.version
         else:
             print("Configuration doesn't exist yet. Creating new one.")
             self.config = YamlConfigDefinition()
+            self._disk_version = None
         return self
 
-    def save(self, path=None):
+    def materialize(self, names: Optional[List[str]] = None):
+        '''
+        Evaluates the given (default: all) layers of the configuration, e.g. to profile a whole config run.
+        '''
+        for name in (names or list(self.config.layers.keys())):
+            self.get(name).content
+        return self
+
+    @property
+    def profiler(self) -> Profiler:
+        return profiler
+
+    def run_report(self, path: Optional[str] = None, trace_path: Optional[str] = None):
+        '''
+        Returns the structured run report with the recorded spans of layers, operators and loaders. Optionally the
+        report is written as json and as chrome trace.
+        '''
+        if path is not None:
+            profiler.to_json(path)
+        if trace_path is not None:
+            profiler.to_chrome_trace(trace_path)
+        return profiler.report()
+
+    def _read_disk_version(self, path):
+        if not os.path.isfile(path):
+            return None
+        with open(path, mode="r", encoding="utf-8") as yaml_file:
+            return (yaml.safe_load(yaml_file) or {}).get("version", 0)
+
+    def save(self, path=None, max_workers=None):
+        '''
+        Saves all persistent layers and the configuration. Files are written to a temporary file first and renamed
+        afterwards, so readers never see partially written files. The whole save is guarded by a lock file and fails
+        with a ConcurrentModificationError, if the configuration was changed by someone else since it was loaded.
+        '''
         #Check path
         path = path or self.path
         assert path is not None, "Path to save config not set."
-        #Save layers
-        for _, layer in self.config.layers.items():
-            if layer.persistent == True:
-                layer.save()
-        #Save config
-        self.config.version += 1
-        self.config.last_update = datetime.now()
-        with open(path, mode="w", encoding="utf-8") as yaml_file:
-            yaml.dump(self.config.model_dump(exclude_none=True), yaml_file)
+        with FileLock(os.path.abspath(path), timeout=self.lock_timeout):
+            #Optimistic concurrency check on the version, saving to another path overwrites it
+            disk_version = self._read_disk_version(path)
+            if path == self.path and disk_version != self._disk_version:
+                raise ConcurrentModificationError(
+                    f"Configuration '{path}' was modified concurrently (version on disk {disk_version}, "
+                    f"expected {self._disk_version}). Please reload and reapply your changes.")
+            #Save layers in parallel, as they are I/O-bound
+            layers = [layer for layer in self.config.layers.values() if layer.persistent == True]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(lambda layer: layer.save(), layers))
+            #Save config, the version is only increased in memory once the file is written
+            update = dict(version=self.config.version + 1, last_update=datetime.now())
+            with atomic_path(path) as tmp_path:
+                with open(tmp_path, mode="w", encoding="utf-8") as yaml_file:
+                    yaml.dump({**self.config.model_dump(exclude_none=True), **update}, yaml_file)
+            self.config.version, self.config.last_update = update["version"], update["last_update"]
+            if path == self.path:
+                self._disk_version = self.config.version
         return self
 
 
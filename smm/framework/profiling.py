@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+__author__ = "David Ziegler"
+
+import os, time, json, threading, itertools, logging
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:    # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def _peak_rss():
+    '''Peak resident set size of the process in bytes, None if not available on this platform.'''
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports KiB, macOS bytes
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset
+    except (ImportError, AttributeError):
+        return None
+
+
+def _cpu_time():
+    '''
+    CPU time of the calling thread plus the waited-for child processes (e.g. geofileops workers). Thread time keeps
+    the spans of layers saved in parallel apart.
+    '''
+    t = os.times()
+    return time.thread_time() + t.children_user + t.children_system
+
+
+class Span(dict):
+    '''
+    Single measurement of a pipeline step. Metrics that are only known inside the block (rows, bytes) can be
+    added with update(). Meta keys named like a field are stored with a "meta_" prefix.
+    '''
+    fields = ("id", "name", "category", "parent", "thread", "pid", "start", "wall_time", "cpu_time", "peak_rss_delta",
+              "rows_in", "rows_out", "bytes_read", "bytes_written")
+
+    def __init__(self, id, name, category, parent=None, meta: Optional[Dict] = None):
+        super().__init__(id=id,
+                         name=name,
+                         category=category,
+                         parent=parent,
+                         thread=threading.get_ident(),
+                         pid=os.getpid(),
+                         start=None,
+                         wall_time=None,
+                         cpu_time=None,
+                         peak_rss_delta=None,
+                         rows_in=None,
+                         rows_out=None,
+                         bytes_read=None,
+                         bytes_written=None,
+                         **{f"meta_{k}" if k in self.fields else k: v for k, v in (meta or {}).items()})
+
+
+class Profiler(object):
+    '''
+    Records spans for layer evaluations, operators and loaders. Subscribers are called with every finished span.
+    '''
+
+    def __init__(self, enabled: bool = True, max_records: int = 100000) -> None:
+        self.enabled = enabled
+        self._records = deque(maxlen=max_records)
+        self._subscribers: List[Callable[[Span], None]] = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+
+    def subscribe(self, callback: Callable[[Span], None]):
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback: Callable[[Span], None]):
+        self._subscribers.remove(callback)
+
+    def reset(self):
+        with self._lock:
+            self._records.clear()
+        return self
+
+    @property
+    def records(self) -> List[Span]:
+        with self._lock:
+            return list(self._records)
+
+    @contextmanager
+    def span(self, name: str, category: str, **meta):
+        if not self.enabled:
+            yield Span(None, name, category, meta=meta)
+            return
+        stack = self._local.__dict__.setdefault("stack", [])
+        span = Span(next(self._ids), name, category, parent=stack[-1]["id"] if stack else None, meta=meta)
+        stack.append(span)
+        rss, cpu, start = _peak_rss(), _cpu_time(), time.perf_counter()
+        try:
+            yield span
+        finally:
+            span["start"] = start - self._origin
+            span["wall_time"] = time.perf_counter() - start
+            span["cpu_time"] = _cpu_time() - cpu
+            _rss = _peak_rss()
+            span["peak_rss_delta"] = None if rss is None else _rss - rss
+            stack.pop()
+            with self._lock:
+                self._records.append(span)
+            #Failing subscribers must not replace the exception of the profiled operation
+            for subscriber in list(self._subscribers):
+                try:
+                    subscriber(span)
+                except Exception:
+                    logger.exception(f"Profiler subscriber {subscriber!r} failed on span {span['name']}.")
+
+    def report(self) -> Dict:
+        records = self.records
+        summary = {}
+        for r in records:
+            key = f"{r['category']}:{r['name']}"
+            s = summary.setdefault(key, dict(category=r["category"], name=r["name"], calls=0, wall_time=0., cpu_time=0.))
+            s["calls"] += 1
+            s["wall_time"] += r["wall_time"]
+            s["cpu_time"] += r["cpu_time"]
+        return dict(spans=records, summary=sorted(summary.values(), key=lambda x: x["wall_time"], reverse=True))
+
+    def to_json(self, path: Optional[str] = None):
+        report = json.dumps(self.report(), indent=2, default=str)
+        if path is not None:
+            with open(path, mode="w", encoding="utf-8") as f:
+                f.write(report)
+        return report
+
+    def to_chrome_trace(self, path: Optional[str] = None):
+        '''
+        Exports the spans in the chrome trace event format, viewable in chrome://tracing or ui.perfetto.dev.
+        '''
+        events = []
+        for r in self.records:
+            args = {k: v for k, v in r.items() if k not in ("name", "category", "start", "wall_time", "thread", "pid")}
+            events.append(
+                dict(name=r["name"],
+                     cat=r["category"],
+                     ph="X",
+                     ts=r["start"] * 1e6,
+                     dur=r["wall_time"] * 1e6,
+                     pid=r["pid"],
+                     tid=r["thread"],
+                     args=args))
+        trace = json.dumps(dict(traceEvents=events, displayTimeUnit="ms"), default=str)
+        if path is not None:
+            with open(path, mode="w", encoding="utf-8") as f:
+                f.write(trace)
+        return trace
+
+
+# Default profiler used by layers, loaders and operators
+profiler = Profiler()
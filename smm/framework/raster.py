@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+__license__ = "MIT"
+__version__ = "0.1"
+__status__ = "Production"
+
+import os, math, tempfile
+import numpy as np
+import geopandas as gpd
+import shapely
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Optional
+from ..common.storage import atomic_path
+from .profiling import profiler
+
+
+class RasterExporter(object):
+    '''
+    Burns a numeric column of a polygon layer (e.g. H3/S2 tesselations) into a regular grid of `resolution` crs units
+    and writes it as tiled, compressed Cloud-Optimized GeoTIFF with overviews. Extensive values (aggregation="sum")
+    are divided evenly over the cells whose centre the polygon covers, so that the raster sums up to the column
+    total. Intensive values (aggregation="mean") are averaged over the polygons covering a cell. Polygons that cover
+    no cell centre (smaller than a cell or thin strips) are burned at their representative point. The grid is
+    rasterized in windows of block_size cells in parallel.
+    '''
+    aggregations = ("sum", "mean")
+
+    def __init__(self,
+                 resolution: float,
+                 aggregation: str = "sum",
+                 crs=None,
+                 block_size: int = 512,
+                 compress: str = "deflate",
+                 overview_resampling: str = "average",
+                 max_workers: Optional[int] = None) -> None:
+        assert aggregation in self.aggregations, f"Unknown aggregation, use one of {self.aggregations}."
+        assert block_size % 16 == 0, "The block size of tiled GeoTIFFs has to be a multiple of 16."
+        self.resolution = resolution
+        self.aggregation = aggregation
+        self.crs = crs
+        self.block_size = block_size
+        self.compress = compress
+        self.overview_resampling = overview_resampling
+        self.max_workers = max_workers or os.cpu_count()
+
+    def grid(self, bounds):
+        '''Transform, width and height of the grid covering the bounds, aligned to multiples of the resolution.'''
+        from rasterio.transform import from_origin
+        res = self.resolution
+        minx, miny = math.floor(bounds[0] / res) * res, math.floor(bounds[1] / res) * res
+        maxx, maxy = math.ceil(bounds[2] / res) * res, math.ceil(bounds[3] / res) * res
+        width, height = max(int(round((maxx - minx) / res)), 1), max(int(round((maxy - miny) / res)), 1)
+        return from_origin(minx, maxy, res, res), width, height
+
+    def covered_cells(self, geoms) -> np.ndarray:
+        '''
+        Number of cells of the aligned grid (see grid) whose centre lies inside each geometry, the cells rasterize
+        burns it into. The cell centres inside the bounds of the geometries are tested in batches of a window
+        (block_size x block_size), so that large polygons don't need memory for all their cells at once.
+        '''
+        res = self.resolution
+        bounds = shapely.bounds(geoms)
+        # Cell centres lie at (k + 0.5) * res
+        low = np.ceil(bounds[:, :2] / res - .5).astype(np.int64)
+        high = np.floor(bounds[:, 2:] / res - .5).astype(np.int64)
+        nx, ny = np.maximum(high - low + 1, 0).T
+        n = nx * ny
+        end = np.cumsum(n)
+        cells = np.zeros(len(geoms), dtype=np.int64)
+        for start in range(0, int(end[-1]) if len(end) else 0, self.block_size**2):
+            #Geometry and position inside its bounds of each centre of the batch
+            position = np.arange(start, min(start + self.block_size**2, end[-1]))
+            ids = np.searchsorted(end, position, side="right")
+            offset = position - (end - n)[ids]
+            x = (low[ids, 0] + offset % nx[ids] + .5) * res
+            y = (low[ids, 1] + offset // nx[ids] + .5) * res
+            inside = shapely.contains_xy(geoms[ids], x, y)
+            cells += np.bincount(ids[inside], minlength=len(geoms))
+        return cells
+
+    def burn_values(self, gdf: gpd.GeoDataFrame, column: str):
+        '''Geometries and the values burned into the cells they cover.'''
+        geoms = gdf.geometry.values
+        values = gdf[column].to_numpy(dtype=float)
+        cells = self.covered_cells(np.asarray(geoms))
+        point = cells == 0
+        geoms = np.where(point, shapely.point_on_surface(geoms), geoms)
+        if self.aggregation == "sum":
+            # Value per cell, so that the cells covered by a polygon add up to its value
+            values = values / np.maximum(cells, 1)
+        return geoms, values
+
+    def _rasterize_window(self, window, transform, tree, geoms, values):
+        from rasterio.features import rasterize
+        from rasterio.enums import MergeAlg
+        from rasterio.windows import bounds as window_bounds, transform as window_transform
+
+        shape = (int(window.height), int(window.width))
+        hits = tree.query(shapely.box(*window_bounds(window, transform)))
+        if len(hits) == 0:
+            return window, np.full(shape, np.nan, dtype="float32")
+        _transform = window_transform(window, transform)
+        _geoms = geoms[np.sort(hits)]
+        total = rasterize(zip(_geoms, values[np.sort(hits)]),
+                          out_shape=shape,
+                          transform=_transform,
+                          fill=0,
+                          merge_alg=MergeAlg.add,
+                          dtype="float64")
+        count = rasterize(((g, 1) for g in _geoms),
+                          out_shape=shape,
+                          transform=_transform,
+                          fill=0,
+                          merge_alg=MergeAlg.add,
+                          dtype="uint32")
+        with np.errstate(invalid="ignore", divide="ignore"):
+            result = total / count if self.aggregation == "mean" else total
+        return window, np.where(count > 0, result, np.nan).astype("float32")
+
+    def _windows(self, width, height):
+        from rasterio.windows import Window
+        for row in range(0, height, self.block_size):
+            for col in range(0, width, self.block_size):
+                yield Window(col, row, min(self.block_size, width - col), min(self.block_size, height - row))
+
+    def export(self, gdf: gpd.GeoDataFrame, column: str, path: str, name: str = "layer"):
+        import rasterio
+        from rasterio.shutil import copy as raster_copy
+
+        with profiler.span(name, "raster", column=column, aggregation=self.aggregation) as span:
+            gdf = gdf[[column, gdf.geometry.name]].dropna()
+            gdf = gdf[~gdf.geometry.is_empty]
+            gdf = gdf.to_crs(self.crs or gdf.estimate_utm_crs())
+            span.update(rows_in=len(gdf))
+            assert len(gdf) > 0, "No features to rasterize."
+            geoms, values = self.burn_values(gdf, column)
+            tree = shapely.STRtree(geoms)
+            transform, width, height = self.grid(gdf.total_bounds)
+            profile = dict(driver="GTiff",
+                           width=width,
+                           height=height,
+                           count=1,
+                           dtype="float32",
+                           nodata=np.nan,
+                           crs=gdf.crs,
+                           transform=transform,
+                           tiled=True,
+                           blockxsize=self.block_size,
+                           blockysize=self.block_size,
+                           BIGTIFF="IF_SAFER")
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                tmp_tif = os.path.join(tmp_dir, "raster.tif")
+                with rasterio.open(tmp_tif, "w", **profile) as dst, ThreadPoolExecutor(self.max_workers) as executor:
+                    # Bounded number of windows in flight, finished windows are written right away
+                    pending = set()
+                    for window in self._windows(width, height):
+                        if len(pending) >= 2 * self.max_workers:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                dst.write(future.result()[1], 1, window=future.result()[0])
+                        pending.add(executor.submit(self._rasterize_window, window, transform, tree, geoms, values))
+                    for future in pending:
+                        dst.write(future.result()[1], 1, window=future.result()[0])
+                with atomic_path(path) as tmp_file:
+                    raster_copy(tmp_tif,
+                                tmp_file,
+                                driver="COG",
+                                compress=self.compress,
+                                blocksize=self.block_size,
+                                overview_resampling=self.overview_resampling,
+                                BIGTIFF="IF_SAFER")
+            span.update(rows_out=width * height, bytes_written=os.path.getsize(path))
+        return path
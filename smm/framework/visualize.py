@@ -2,3 +2,256 @@
 __license__ = "MIT"
 __version__ = "0.1"
 __status__ = "Production"
+
+import os, json, gzip, sqlite3
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+from ..common.storage import atomic_path
+from .profiling import profiler
+
+# Half of the web mercator (EPSG:3857) world width
+WORLD_HALF = 20037508.342789244
+
+
+def tile_bounds(z, x, y):
+    '''Bounds (minx, miny, maxx, maxy) of a XYZ tile in EPSG:3857.'''
+    size = 2 * WORLD_HALF / 2**z
+    return (-WORLD_HALF + x * size, WORLD_HALF - (y + 1) * size, -WORLD_HALF + (x + 1) * size, WORLD_HALF - y * size)
+
+
+def tile_ranges(bounds, z, buffer=0.):
+    '''
+    Ranges of the XYZ tiles at zoom z, which the bounds (n x 4 array in EPSG:3857) overlap, as arrays of
+    x_min, x_max, y_min, y_max (inclusive). buffer is given as share of the tile size.
+    '''
+    n = 2**z
+    size = 2 * WORLD_HALF / n
+    _clip = lambda v: np.clip(np.floor(v).astype(np.int64), 0, n - 1)
+    return (_clip((bounds[:, 0] + WORLD_HALF) / size - buffer), _clip((bounds[:, 2] + WORLD_HALF) / size + buffer),
+            _clip((WORLD_HALF - bounds[:, 3]) / size - buffer), _clip((WORLD_HALF - bounds[:, 1]) / size + buffer))
+
+
+def assign_tiles(bounds, z, buffer=0., branch=None):
+    '''
+    Assigns features to the tiles at zoom z by their bounds without a spatial join. Returns arrays of feature
+    position, x and y. With a branch (z, x, y), only the tiles below that tile are returned.
+    '''
+    x0, x1, y0, y1 = tile_ranges(bounds, z, buffer=buffer)
+    if branch is not None:
+        _z, _x, _y = branch
+        scale = 2**(z - _z)
+        x0, x1 = np.maximum(x0, _x * scale), np.minimum(x1, (_x + 1) * scale - 1)
+        y0, y1 = np.maximum(y0, _y * scale), np.minimum(y1, (_y + 1) * scale - 1)
+    nx, ny = np.maximum(x1 - x0 + 1, 0), np.maximum(y1 - y0 + 1, 0)
+    counts = nx * ny
+    feature = np.repeat(np.arange(len(bounds)), counts)
+    #Position of each pair inside the tile range of its feature
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    _nx = np.repeat(nx, counts)
+    return feature, np.repeat(x0, counts) + offset % np.maximum(_nx, 1), np.repeat(y0, counts) + offset // np.maximum(
+        _nx, 1)
+
+
+def _properties(df):
+    records = df.astype(object).where(df.notna(), None).to_dict("records")
+    _value = lambda v: v if isinstance(v, (str, bool, int, float)) else str(v)
+    return [{k: _value(v) for k, v in r.items() if v is not None} for r in records]
+
+
+def pixel_size(z, extent):
+    '''Size of a tile pixel at zoom z in EPSG:3857 units.'''
+    return 2 * WORLD_HALF / 2**z / extent
+
+
+def visible(geoms, size):
+    '''
+    Mask of the geometries that are visible at a pixel size: all points, lines longer than a pixel and polygons
+    larger than a pixel. Empty geometries are never visible.
+    '''
+    dimensions = shapely.get_dimensions(geoms)
+    return ~shapely.is_empty(geoms) & ((dimensions == 0) | ((dimensions == 1) & (shapely.length(geoms) > size)) |
+                                       ((dimensions == 2) & (shapely.area(geoms) > size**2)))
+
+
+def _render_branch(gdf, zooms, branch, name, extent, buffer, simplify):
+    '''
+    Renders the tiles of the given zooms below a branch tile (None for whole zoom levels). Features below a pixel
+    are dropped per zoom, the others are simplified once to the pixel size of the zoom, clipped per tile and encoded
+    as gzipped MVT. Runs in worker processes.
+    '''
+    import mapbox_vector_tile
+
+    tiles = []
+    bounds = shapely.bounds(gdf.geometry.values)
+    properties = _properties(gdf.drop(columns=gdf.geometry.name))
+    for z in zooms:
+        pixel = pixel_size(z, extent)
+        shown = np.flatnonzero(visible(gdf.geometry.values, pixel))
+        geoms = np.array(gdf.geometry.values, dtype=object)
+        if simplify > 0:
+            geoms[shown] = shapely.simplify(geoms[shown], pixel * simplify, preserve_topology=False)
+        feature, xs, ys = assign_tiles(bounds[shown], z, buffer=buffer / extent, branch=branch)
+        feature = shown[feature]
+        order = np.lexsort((feature, ys, xs))
+        feature, xs, ys = feature[order], xs[order], ys[order]
+        starts = np.flatnonzero(np.r_[True, (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])]) if len(xs) else []
+        for start, end in zip(starts, np.r_[starts[1:], len(xs)] if len(xs) else []):
+            x, y = int(xs[start]), int(ys[start])
+            minx, miny, maxx, maxy = tile_bounds(z, x, y)
+            _buffer = pixel * buffer
+            _features = feature[start:end]
+            clipped = shapely.clip_by_rect(geoms[_features], minx - _buffer, miny - _buffer, maxx + _buffer,
+                                           maxy + _buffer)
+            #Quantize all geometries of the tile at once instead of per feature in the encoder
+            scale = np.array([extent / (maxx - minx), extent / (maxy - miny)])
+            clipped = shapely.transform(clipped, lambda c: np.round((c - [minx, miny]) * scale))
+            #Geometries collapsed by the quantization
+            keep = visible(clipped, 0)
+            if not keep.any():
+                continue
+            layer = dict(name=name,
+                         features=[dict(geometry=g, properties=properties[i])
+                                   for g, i in zip(clipped[keep], _features[keep])])
+            data = mapbox_vector_tile.encode([layer], default_options=dict(extents=extent))
+            tiles.append((z, x, y, gzip.compress(data, mtime=0)))
+    return tiles
+
+
+class TileExporter(object):
+    '''
+    Exports a DataLayer as Mapbox Vector Tiles for a zoom range into a single PMTiles (.pmtiles) or MBTiles
+    (.mbtiles) archive. Zoom levels below branch_zoom are rendered as one job per zoom, the tiles below each occupied
+    tile of branch_zoom as one job per branch in a process pool, so that every worker only receives the features
+    visible at its zoom or of its branch.
+    '''
+    formats = (".pmtiles", ".mbtiles")
+
+    def __init__(self,
+                 min_zoom: int = 0,
+                 max_zoom: int = 12,
+                 columns: Optional[List[str]] = None,
+                 extent: int = 4096,
+                 buffer: int = 64,
+                 simplify: float = 1.,
+                 branch_zoom: Optional[int] = None,
+                 max_workers: Optional[int] = None) -> None:
+        assert 0 <= min_zoom <= max_zoom, "Requires 0 <= min_zoom <= max_zoom."
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.columns = columns
+        self.extent = extent
+        self.buffer = buffer
+        self.simplify = simplify
+        self.branch_zoom = branch_zoom
+        self.max_workers = max_workers or os.cpu_count()
+
+    def _branch_zoom(self, bounds):
+        # Smallest zoom with enough occupied tiles to keep all workers busy
+        if self.branch_zoom is not None:
+            return min(max(self.branch_zoom, self.min_zoom), self.max_zoom)
+        for z in range(self.min_zoom, self.max_zoom + 1):
+            _, xs, ys = assign_tiles(bounds, z)
+            if len(np.unique(xs * 2**z + ys)) >= 4 * self.max_workers:
+                return z
+        return self.max_zoom
+
+    def _jobs(self, gdf, bounds):
+        z_b = self._branch_zoom(bounds)
+        for z in range(self.min_zoom, z_b):
+            #Only the features visible at the zoom are sent to the worker
+            yield gdf[visible(gdf.geometry.values, pixel_size(z, self.extent))], [z], None
+        feature, xs, ys = assign_tiles(bounds, z_b, buffer=self.buffer / self.extent)
+        order = np.lexsort((feature, ys, xs))
+        feature, xs, ys = feature[order], xs[order], ys[order]
+        starts = np.flatnonzero(np.r_[True, (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])]) if len(xs) else []
+        for start, end in zip(starts, np.r_[starts[1:], len(xs)] if len(xs) else []):
+            yield gdf.iloc[feature[start:end]], list(range(z_b, self.max_zoom + 1)), (z_b, int(xs[start]),
+                                                                                     int(ys[start]))
+
+    def render(self, gdf: gpd.GeoDataFrame, name: str):
+        '''
+        Renders all tiles of a GeoDataFrame, returns a list of (z, x, y, gzipped mvt) sorted by zoom, x and y.
+        '''
+        columns = [c for c in (self.columns or gdf.columns) if c != gdf.geometry.name]
+        gdf = gdf[columns + [gdf.geometry.name]].to_crs(3857)
+        gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)].reset_index(drop=True)
+        bounds = shapely.bounds(gdf.geometry.values)
+        options = (name, self.extent, self.buffer, self.simplify)
+        tiles = []
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [
+                executor.submit(_render_branch, _gdf, zooms, branch, *options)
+                for _gdf, zooms, branch in self._jobs(gdf, bounds)
+            ]
+            for future in futures:
+                tiles += future.result()
+        return sorted(tiles, key=lambda t: t[:3])
+
+    def _metadata(self, gdf, name):
+        _type = lambda dtype: "Number" if pd.api.types.is_numeric_dtype(dtype) else (
+            "Boolean" if pd.api.types.is_bool_dtype(dtype) else "String")
+        fields = {c: _type(gdf[c].dtype) for c in (self.columns or gdf.columns) if c != gdf.geometry.name}
+        minx, miny, maxx, maxy = gdf.to_crs(4326).total_bounds if len(gdf) else (-180., -85., 180., 85.)
+        return dict(name=name,
+                    bounds=[float(minx), float(miny), float(maxx), float(maxy)],
+                    vector_layers=[dict(id=name, fields=fields, minzoom=self.min_zoom, maxzoom=self.max_zoom)])
+
+    def _write_pmtiles(self, tiles, metadata, file):
+        from pmtiles.tile import zxy_to_tileid, TileType, Compression
+        from pmtiles.writer import Writer
+
+        minx, miny, maxx, maxy = metadata["bounds"]
+        with open(file, "wb") as f:
+            writer = Writer(f)
+            for tile_id, data in sorted((zxy_to_tileid(z, x, y), data) for z, x, y, data in tiles):
+                writer.write_tile(tile_id, data)
+            header = dict(tile_type=TileType.MVT,
+                          tile_compression=Compression.GZIP,
+                          min_lon_e7=int(minx * 1e7),
+                          min_lat_e7=int(miny * 1e7),
+                          max_lon_e7=int(maxx * 1e7),
+                          max_lat_e7=int(maxy * 1e7),
+                          center_zoom=self.min_zoom,
+                          center_lon_e7=int((minx + maxx) / 2 * 1e7),
+                          center_lat_e7=int((miny + maxy) / 2 * 1e7))
+            writer.finalize(header, metadata)
+
+    def _write_mbtiles(self, tiles, metadata, file):
+        minx, miny, maxx, maxy = metadata["bounds"]
+        con = sqlite3.connect(file)
+        try:
+            con.execute("CREATE TABLE metadata (name text, value text)")
+            con.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+            con.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+            con.executemany(
+                "INSERT INTO metadata VALUES (?, ?)",
+                [("name", metadata["name"]), ("format", "pbf"), ("minzoom", str(self.min_zoom)),
+                 ("maxzoom", str(self.max_zoom)), ("bounds", f"{minx},{miny},{maxx},{maxy}"),
+                 ("center", f"{(minx + maxx) / 2},{(miny + maxy) / 2},{self.min_zoom}"),
+                 ("json", json.dumps(dict(vector_layers=metadata["vector_layers"])))])
+            #MBTiles rows are counted from the bottom (TMS)
+            con.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                            [(z, x, 2**z - 1 - y, sqlite3.Binary(data)) for z, x, y, data in tiles])
+            con.commit()
+        finally:
+            con.close()
+
+    def export(self, gdf: gpd.GeoDataFrame, path: str, name: str = "layer"):
+        _, ext = os.path.splitext(path)
+        assert ext in self.formats, f"Unknown tile archive format, use one of {self.formats}."
+        with profiler.span(name, "tiles", min_zoom=self.min_zoom, max_zoom=self.max_zoom) as span:
+            span.update(rows_in=len(gdf))
+            tiles = self.render(gdf, name)
+            assert len(tiles) > 0, "No features to export."
+            metadata = self._metadata(gdf, name)
+            with atomic_path(path) as tmp_file:
+                if ext == ".pmtiles":
+                    self._write_pmtiles(tiles, metadata, tmp_file)
+                else:
+                    self._write_mbtiles(tiles, metadata, tmp_file)
+            span.update(rows_out=len(tiles), bytes_written=os.path.getsize(path))
+        return path
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import pytest
+
+from smm.common.config import FRAMEWORK_ROOT, TEST_ROOT
+from smm.core.osm.parser import MapnikSqlParser
+
+MAPNIK_FILE = os.path.join(FRAMEWORK_ROOT, "core", "osm", "config", "mapnik.xml")
+GOLDEN_FILE = os.path.join(TEST_ROOT, "mapnik_sql_golden.json")
+with open(GOLDEN_FILE, encoding="utf-8") as f:
+    GOLDEN = json.load(f)
+
+
+@pytest.fixture(scope="module")
+def parser():
+    return MapnikSqlParser(MAPNIK_FILE)
+
+
+@pytest.fixture(scope="module")
+def layers(parser):
+    return {name: sql for name, sql, _ in parser.iter_mapnik()}
+
+
+def test_golden_covers_all_layers(layers):
+    assert sorted(layers) == sorted(GOLDEN)
+
+
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_parse_mapnik_sql_golden(parser, layers, name):
+    assert parser.parse_mapnik_sql(layers[name], label=name) == GOLDEN[name]
+
+
+def _ast(sql):
+    from sqlglot import parse_one
+    return parse_one(sql, read=MapnikSqlParser.dialect)
+
+
+def _table_selects(ast):
+    '''Closest select of every osm table and the selects around it, by osm type.'''
+    from sqlglot import exp
+    inner, outer = {}, {}
+    for table in ast.find_all(exp.Table):
+        if table.name not in MapnikSqlParser.osm_tables:
+            continue
+        _type = MapnikSqlParser.osm_tables[table.name]
+        selects, node = [], table.parent
+        while node is not None:
+            if isinstance(node, exp.Select):
+                selects.append(node)
+            node = node.parent
+        inner.setdefault(_type, []).append(selects[0])
+        outer.setdefault(_type, []).extend(selects[1:])
+    return inner, outer
+
+
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_osm_id_and_type_are_selected(layers, parser, name):
+    inner, outer = _table_selects(_ast(parser.parse_mapnik_sql(layers[name], label=name)))
+    for _type, selects in inner.items():
+        for select in selects + outer[_type]:
+            assert select.is_star or {"osm_id", "osm_type"} <= set(select.named_selects)
+        #The type is set where the table is read, unless the select passes it through
+        for select in selects:
+            if not select.is_star and select not in outer[_type]:
+                _literal = [e for e in select.expressions if e.alias_or_name == "osm_type"]
+                assert [e.this.this for e in _literal] == [_type]
+
+
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_no_duplicate_columns(layers, parser, name):
+    from sqlglot import exp
+    for select in _ast(parser.parse_mapnik_sql(layers[name], label=name)).find_all(exp.Select):
+        assert len(select.named_selects) == len(set(select.named_selects))
+
+
+@pytest.mark.parametrize("name", ["stations", "placenames-medium"])
+def test_existing_osm_id_is_not_added_again(layers, parser, name):
+    from sqlglot import exp
+    for select in _ast(parser.parse_mapnik_sql(layers[name], label=name)).find_all(exp.Select):
+        assert select.named_selects.count("osm_id") <= 1
+        assert select.named_selects.count("osm_type") <= 1
+
+
+@pytest.mark.parametrize("name", sorted(GOLDEN))
+def test_placeholders_are_removed(layers, parser, name):
+    assert "__" not in parser.parse_mapnik_sql(layers[name], label=name)
+
+
+def _feature_coalesce(sql):
+    from sqlglot import exp
+    return [a.this for a in _ast(sql).find_all(exp.Alias) if a.alias == "feature" and isinstance(a.this, exp.Coalesce)]
+
+
+def test_amenity_points_building_feature(layers, parser):
+    coalesce = _feature_coalesce(parser.parse_mapnik_sql(layers["amenity-points"], label="amenity-points"))
+    assert len(coalesce) > 0
+    assert coalesce[0].expressions[-1] == _ast(f"SELECT {MapnikSqlParser.building_feature}").expressions[0]
+    assert sum("'building_'" in e.sql(dialect="postgres") for e in coalesce[0].expressions) == 1
+
+
+@pytest.mark.parametrize("name", sorted(set(GOLDEN) - {"amenity-points"}))
+def test_building_feature_only_for_amenity_points(layers, parser, name):
+    for coalesce in _feature_coalesce(parser.parse_mapnik_sql(layers[name], label=name)):
+        assert coalesce.expressions[-1] != _ast(f"SELECT {MapnikSqlParser.building_feature}").expressions[0]